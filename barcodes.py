@@ -0,0 +1,88 @@
+"""
+Vectorized helpers for working with index (barcode) sequences.
+
+Barcodes are encoded as rows of a uint8 matrix (one column per base) so that comparisons against a whole
+set of sample barcodes can be done with numpy broadcasting rather than Python loops.
+"""
+
+import numpy as np
+
+BASES = 'ACGTN'
+
+# code used to pad barcodes of differing lengths.  Never equal to a real base, so padding always counts as a mismatch
+PAD = len(BASES)
+
+# maps a byte (as an integer) to its base code.  Anything that is not A/C/G/T is treated as N
+ENCODING = np.empty(256, dtype=np.uint8)
+ENCODING.fill(BASES.index('N'))
+for i, b in enumerate(BASES):
+	ENCODING[ord(b)] = i
+	ENCODING[ord(b.lower())] = i
+
+COMPLEMENT = {'A':'T', 'C':'G', 'G':'C', 'T':'A', 'N':'N'}
+
+# the number of barcodes compared against the sample barcodes at once.  Bounds the size of the intermediate
+# (reads x samples x bases) comparison array
+BLOCK_SIZE = 100000
+
+
+def reverse_complement(seq):
+	return ''.join([COMPLEMENT.get(b, 'N') for b in reversed(seq.upper())])
+
+
+def encode(barcodes, length = None):
+	"""
+	Encodes a list of barcode strings as a (n x length) uint8 matrix.  Shorter barcodes are padded, longer ones truncated.
+	If length is not given, the longest barcode sets the width.
+	"""
+	if length is None:
+		length = max([len(b) for b in barcodes]) if len(barcodes) > 0 else 0
+	m = np.empty((len(barcodes), length), dtype=np.uint8)
+	m.fill(PAD)
+	for i, b in enumerate(barcodes):
+		b = b[:length]
+		m[i, :len(b)] = ENCODING[np.frombuffer(b.encode('ascii'), dtype=np.uint8)]
+	return m
+
+
+def hamming_distance_matrix(a, b):
+	"""
+	a and b are encoded barcode matrices (n x L) and (k x L).  Returns the (n x k) matrix of Hamming distances.
+	An N in either barcode counts as a mismatch, as it does for bcl2fastq.
+	"""
+	n_code = BASES.index('N')
+	b_valid = (b != n_code)
+	distances = np.empty((a.shape[0], b.shape[0]), dtype=np.int32)
+	for start in range(0, a.shape[0], BLOCK_SIZE):
+		block = a[start:start + BLOCK_SIZE]
+		matches = (block[:, None, :] == b[None, :, :]) & (block != n_code)[:, None, :] & b_valid[None, :, :]
+		distances[start:start + BLOCK_SIZE] = a.shape[1] - matches.sum(axis=2)
+	return distances
+
+
+def assign(read_barcodes, sample_barcodes, max_mismatches):
+	"""
+	Assigns each read barcode (encoded, n x L) to the closest sample barcode (encoded, k x L).
+	Returns an array of length n with the index of the assigned sample, or -1 if no sample is within max_mismatches
+	or if the closest match is not unique.
+	"""
+	assignments = np.empty(read_barcodes.shape[0], dtype=np.int64)
+	assignments.fill(-1)
+	if sample_barcodes.shape[0] == 0:
+		return assignments
+	distances = hamming_distance_matrix(read_barcodes, sample_barcodes)
+	best = distances.argmin(axis=1)
+	best_distance = distances[np.arange(distances.shape[0]), best]
+	# a match is ambiguous if more than one sample shares the best distance
+	ties = (distances == best_distance[:, None]).sum(axis=1) > 1
+	accepted = (best_distance <= max_mismatches) & ~ties
+	assignments[accepted] = best[accepted]
+	return assignments
+
+
+def header_barcode(header):
+	"""
+	Extracts the index sequence(s) from a fastq header line written by bcl2fastq, e.g.
+	'@NS500749:2:H5GMMBGXX:1:11101:10000:1000 1:N:0:ATCACG+GTTACA' gives 'ATCACGGTTACA'
+	"""
+	return header.rstrip().rsplit(':', 1)[-1].replace('+', '')
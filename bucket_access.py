@@ -0,0 +1,107 @@
+"""
+Access to the delivery buckets, granted once per bucket through the bucket's IAM policy rather than per object.
+
+The clients are given read access to the objects (roles/storage.objectViewer) and the CCCB staff full control of the
+objects (roles/storage.objectAdmin, like the OWNER ACLs they had on each object before, but not the right to change the
+bucket or its policy) as bucket-level bindings, so objects uploaded later are
+covered without any further requests.  The live policy is read each time (one request) and written only if some of
+the members are missing from it, so a bucket which was deleted and created again under the same name is granted
+access again.  Grants are only ever added: members are never removed, whoever granted them.
+"""
+
+import json
+import logging
+
+IAM_URL = 'https://storage.googleapis.com/storage/v1/b/%s/iam'
+
+# policies with conditional bindings are only given (and can only be written back) as version 3
+POLICY_VERSION = 3
+
+READER_ROLE = 'roles/storage.objectViewer'
+OWNER_ROLE = 'roles/storage.objectAdmin'
+
+# attempts at writing the policy when it was changed by someone else in between (the etag did not match)
+MAX_POLICY_ATTEMPTS = 3
+
+
+class AccessException(Exception):
+	pass
+
+
+def desired_grants(users, staff):
+	"""
+	Returns a dict of role to the sorted list of members for the given emails (staff are the CCCB staff emails)
+	"""
+	grants = {READER_ROLE: set(), OWNER_ROLE: set()}
+	for user in users:
+		if user in staff:
+			grants[OWNER_ROLE].add('user:%s' % user)
+		else:
+			grants[READER_ROLE].add('user:%s' % user)
+	return dict([(role, sorted(members)) for role, members in grants.items() if members])
+
+
+def missing_members(policy, desired):
+	"""
+	Returns a dict of role to the set of desired members which the policy's bindings (without conditions) do not have
+	"""
+	present = {}
+	for binding in policy.get('bindings', []):
+		if 'condition' not in binding:
+			present.setdefault(binding['role'], set()).update(binding.get('members', []))
+	missing = {}
+	for role, members in desired.items():
+		new = set(members) - present.get(role, set())
+		if new:
+			missing[role] = new
+	return missing
+
+
+def add_bindings(policy, add):
+	"""
+	Adds the members to the policy's bindings (leaving bindings with conditions alone)
+	"""
+	bindings = dict([(b['role'], b) for b in policy.get('bindings', []) if 'condition' not in b])
+	for role, members in add.items():
+		binding = bindings.get(role)
+		if binding is None:
+			binding = {'role': role, 'members': []}
+			policy.setdefault('bindings', []).append(binding)
+			bindings[role] = binding
+		binding['members'] = sorted(set(binding['members']) | members)
+	return policy
+
+
+class BucketAccess(object):
+	"""
+	client makes the (authorized) requests, e.g. a cloud_uploader.Uploader
+	"""
+	def __init__(self, client):
+		self.client = client
+
+	def grant(self, bucket_name, users, staff):
+		"""
+		Makes sure the users have access to the bucket.  Returns True if the bucket's policy was changed.
+		"""
+		desired = desired_grants(users, staff)
+		url = IAM_URL % bucket_name
+		for attempt in range(MAX_POLICY_ATTEMPTS):
+			read = lambda: self.client.request('GET', url, params = {'optionsRequestedPolicyVersion': POLICY_VERSION})
+			response = self.client.with_retries('Reading the IAM policy of %s' % bucket_name, read)
+			policy = self.client.check(response, 'Reading the IAM policy of %s' % bucket_name).json()
+			add = missing_members(policy, desired)
+			if not add:
+				logging.info('Access to gs://%s was already granted to %s' % (bucket_name, ', '.join(users)))
+				return False
+			# the policy is written back whole, with its version and etag
+			policy = add_bindings(policy, add)
+			headers = {'Content-Type': 'application/json; charset=UTF-8'}
+			send = lambda: self.client.request('PUT', url, headers = headers, data = json.dumps(policy))
+			response = self.client.with_retries('Setting the IAM policy of %s' % bucket_name, send)
+			if response.status_code == 412:
+				logging.info('The IAM policy of %s changed while it was updated.  Trying again.' % bucket_name)
+				continue
+			self.client.check(response, 'Setting the IAM policy of %s' % bucket_name)
+			logging.info('Updated access to gs://%s: added %s' % (bucket_name, dict([(r, sorted(m)) for r, m in add.items()])))
+			return True
+		raise AccessException('Could not update the IAM policy of %s' % bucket_name)
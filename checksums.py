@@ -0,0 +1,146 @@
+"""
+Checksums (MD5 and CRC32C) for the final fastq files.
+
+The checksums are computed while the data streams through the concatenation (see fastq_concat.concatenate), so
+no separate read pass is needed.  They are kept in a per-project manifest (a JSON file in the project directory)
+keyed by the path of each file relative to the project directory, and are used to verify the cloud uploads and to
+give clients an md5sum-format file for checking their downloads.
+
+CRC32C needs the crcmod package (with its C extension, for speed).  If it is not installed, only MD5 is computed.
+"""
+
+import os
+import json
+import base64
+import struct
+import hashlib
+import logging
+import threading
+
+try:
+	import crcmod.predefined
+	# make sure the fast C implementation is there- the pure-python version would be far too slow for fastq files
+	import crcmod._crcfunext
+	HAVE_CRC32C = True
+except ImportError:
+	HAVE_CRC32C = False
+
+# the size of the reads when hashing an existing file
+CHUNK_SIZE = 16*1024*1024
+
+# guards the read-modify-write of each manifest file, since several samples of a project can be processed at once
+_manifest_locks = {}
+_manifest_locks_guard = threading.Lock()
+
+
+class Checksummer(object):
+	"""
+	Accumulates the MD5 (and CRC32C, if available) and size of a stream of data passed to update()
+	"""
+	def __init__(self):
+		self.md5 = hashlib.md5()
+		self.crc32c = crcmod.predefined.Crc('crc-32c') if HAVE_CRC32C else None
+		self.size = 0
+
+	def update(self, data):
+		self.md5.update(data)
+		if self.crc32c:
+			self.crc32c.update(data)
+		self.size += len(data)
+
+	def result(self):
+		"""
+		Returns a dict with the md5 (hex, as md5sum shows it), the crc32c (base64 of the big-endian value, as
+		google storage shows it) and the size in bytes
+		"""
+		d = {'md5': self.md5.hexdigest(), 'size': self.size}
+		if self.crc32c:
+			d['crc32c'] = base64.b64encode(struct.pack('>I', self.crc32c.crcValue))
+		return d
+
+
+def file_checksums(path):
+	"""
+	Computes the checksums of an existing file (used when the data did not stream through a concatenation)
+	"""
+	c = Checksummer()
+	with open(path, 'rb') as fin:
+		while True:
+			data = fin.read(CHUNK_SIZE)
+			if not data:
+				break
+			c.update(data)
+	return c.result()
+
+
+def md5_hex_to_base64(md5_hex):
+	return base64.b64encode(md5_hex.decode('hex'))
+
+
+class ChecksumManifest(object):
+	"""
+	The checksum manifest of a project.  Entries are keyed by the path relative to the project directory.
+	"""
+	def __init__(self, project_dir, manifest_name):
+		self.project_dir = project_dir
+		self.path = os.path.join(project_dir, manifest_name)
+		with _manifest_locks_guard:
+			self.lock = _manifest_locks.setdefault(os.path.realpath(self.path), threading.Lock())
+
+	def relative_path(self, path):
+		return os.path.relpath(path, self.project_dir)
+
+	def load(self):
+		if os.path.isfile(self.path):
+			return json.load(open(self.path))
+		return {}
+
+	def save(self, entries):
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as fout:
+			json.dump(entries, fout, indent = 2, sort_keys = True)
+		os.rename(tmp_path, self.path)
+
+	def get(self, path):
+		return self.load().get(self.relative_path(path))
+
+	def set(self, path, checksums):
+		with self.lock:
+			entries = self.load()
+			entries[self.relative_path(path)] = checksums
+			self.save(entries)
+		logging.info('Checksums for %s: %s' % (path, checksums))
+
+	def copy(self, source_path, destination_path, remove_source = False):
+		"""
+		Gives destination_path the checksums of source_path (e.g. for a renamed file, or a link)
+		"""
+		with self.lock:
+			entries = self.load()
+			source = self.relative_path(source_path)
+			if source in entries:
+				entries[self.relative_path(destination_path)] = entries[source]
+				if remove_source:
+					del entries[source]
+				self.save(entries)
+
+	def rename(self, source_path, destination_path):
+		self.copy(source_path, destination_path, remove_source = True)
+
+	def write_md5sum_file(self, path_to_name, md5sum_path):
+		"""
+		Writes a file which can be checked with 'md5sum -c'.  path_to_name maps the local paths of the files to the names
+		the clients will see.  Returns the list of files with no known checksum.
+		"""
+		entries = self.load()
+		missing = []
+		lines = []
+		for path, name in sorted(path_to_name.items(), key = lambda x: x[1]):
+			entry = entries.get(self.relative_path(path))
+			if entry:
+				lines.append('%s  %s' % (entry['md5'], name))
+			else:
+				missing.append(path)
+		with open(md5sum_path, 'w') as fout:
+			fout.write('\n'.join(lines) + '\n')
+		return missing
@@ -0,0 +1,679 @@
+"""
+Uploads files to google storage from within the pipeline process, through the storage JSON API.
+
+gsutil starts a new process (and new TLS connections) for each command.  Here, a pool of threads uploads the files,
+each thread keeping its own HTTP session (so its connection is re-used from one file to the next).  The largest files
+are started first, so the upload does not end with one large file running alone.  The files are read straight from
+their paths, so no symlink directory is needed.
+
+Files smaller than the chunk size are sent in a single request.  Larger ones use a resumable upload session and are
+sent in chunks, so an interrupted request only re-sends the current chunk.  Files larger than the composite threshold
+(the final fastq files can be tens of GB) are split into parts which are uploaded in parallel, as temporary objects
+under PART_PREFIX, and then composed into the final object by the server.  The parts are removed once composed, or if
+the compose fails.  Parts left by an attempt which failed part-way are kept so the next attempt can use them, and that
+attempt removes any it does not need.
+
+The progress of the resumable and composite uploads (the session URLs, and the parts which are complete) is saved in a
+state file for each object, so when an upload is tried again (e.g. the next attempt of the project's upload), only the
+parts and chunks which are missing are sent.  A record of the uploaded objects (an UploadManifest) is kept for each
+bucket, and files which are unchanged since their last upload are not sent again, as long as the bucket still has the
+objects as they were recorded (see UploadManifest.check_remote).
+
+The metadata of each object (Content-Type, Content-Disposition and custom metadata such as checksums) is sent in the
+request which creates it, so no second request per object is needed.  Metadata changes to existing objects are sent
+as batch requests (up to 100 objects per request).
+
+Requests are authorized with an OAuth2 access token: from the google-auth package (application default credentials)
+if it is installed, otherwise the token printed by a command (e.g. 'gcloud auth print-access-token').
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import urllib
+import logging
+import mimetypes
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+try:
+	import google.auth
+	import google.auth.transport.requests
+	HAVE_GOOGLE_AUTH = True
+except ImportError:
+	HAVE_GOOGLE_AUTH = False
+
+UPLOAD_URL = 'https://storage.googleapis.com/upload/storage/v1/b/%s/o'
+LIST_URL = 'https://storage.googleapis.com/storage/v1/b/%s/o'
+OBJECT_URL = 'https://storage.googleapis.com/storage/v1/b/%s/o/%s'
+COMPOSE_URL = 'https://storage.googleapis.com/storage/v1/b/%s/o/%s/compose'
+BATCH_URL = 'https://storage.googleapis.com/batch/storage/v1'
+# full control is needed to set the buckets' IAM policies (see bucket_access.py)
+SCOPE = 'https://www.googleapis.com/auth/devstorage.full_control'
+
+# resumable uploads must be sent in multiples of 256 KiB (except the last chunk)
+CHUNK_UNIT = 256 * 1024
+
+# responses worth retrying, with the attempts made (and the base of the exponential backoff, in seconds)
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+MAX_ATTEMPTS = 5
+BACKOFF = 1.0
+
+MEGABYTE = 1024 * 1024
+
+# a compose request takes at most 32 source objects
+MAX_COMPOSE_PARTS = 32
+
+# a batch request takes at most 100 requests
+MAX_BATCH_SIZE = 100
+
+# the temporary objects for the parts of a composite upload are named like this (object name, part number), apart from
+# the delivered objects
+PART_PREFIX = '.upload_parts/'
+PART_NAME = PART_PREFIX + '%s.part%03d'
+
+
+class UploadException(Exception):
+	pass
+
+
+class AccessToken(object):
+	"""
+	An OAuth2 access token, shared by the upload threads.  refresh() is called when a request is refused (the token
+	expired), and only fetches a new token if another thread has not done so already.
+	"""
+	def __init__(self, token_command = 'gcloud auth print-access-token'):
+		self.token_command = token_command
+		self.token = None
+		self.credentials = None
+		self.lock = threading.Lock()
+
+	def get(self):
+		with self.lock:
+			if self.token is None:
+				self.token = self.fetch()
+			return self.token
+
+	def refresh(self, stale_token):
+		with self.lock:
+			if self.token == stale_token:
+				self.token = self.fetch()
+			return self.token
+
+	def fetch(self):
+		if HAVE_GOOGLE_AUTH:
+			if self.credentials is None:
+				self.credentials, project = google.auth.default(scopes = [SCOPE])
+			self.credentials.refresh(google.auth.transport.requests.Request())
+			return self.credentials.token
+		process = subprocess.Popen(self.token_command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+		stdout, stderr = process.communicate()
+		if process.returncode != 0:
+			raise UploadException('Could not get an access token with "%s": %s' % (self.token_command, stderr))
+		return stdout.strip()
+
+
+class UploadState(object):
+	"""
+	The progress of the upload of a file to an object, kept in a JSON file (if state_file is given) so an interrupted
+	upload can be continued.  Each part (the whole file is part 0, if it is not split) records its resumable session
+	URL and whether it is complete.  The saved state is only used if the file's size and modification time, and the
+	part size, are unchanged.
+	"""
+	def __init__(self, state_file, path, object_name, part_size):
+		self.state_file = state_file
+		self.lock = threading.Lock()
+		st = os.stat(path)
+		self.record = {'path': path, 'object': object_name, 'size': st.st_size, 'mtime': st.st_mtime, 
+				'part_size': part_size, 'parts': {}}
+		if state_file and os.path.isfile(state_file):
+			try:
+				saved = json.load(open(state_file))
+				if all([saved.get(k) == self.record[k] for k in ['path', 'object', 'size', 'mtime', 'part_size']]):
+					self.record['parts'] = saved['parts']
+					logging.info('Continuing the upload of %s from %s' % (path, state_file))
+				else:
+					logging.info('%s has changed since its last upload attempt, so it will be uploaded from the start' % path)
+			except (IOError, ValueError, KeyError) as ex:
+				logging.warning('Could not read the upload state in %s: %s' % (state_file, ex))
+
+	def part(self, number):
+		with self.lock:
+			return dict(self.record['parts'].get(str(number), {}))
+
+	def update(self, number, **values):
+		with self.lock:
+			self.record['parts'].setdefault(str(number), {}).update(values)
+			self.save()
+
+	def save(self):
+		if not self.state_file:
+			return
+		tmp = self.state_file + '.tmp'
+		with open(tmp, 'w') as fout:
+			json.dump(self.record, fout)
+		os.rename(tmp, self.state_file)
+
+	def remove(self):
+		if self.state_file and os.path.isfile(self.state_file):
+			os.remove(self.state_file)
+
+
+class UploadManifest(object):
+	"""
+	A local record of the objects uploaded to a bucket (size, md5, crc32c and generation, and the modification time of
+	the source file), kept in a JSON file which may hold the records of several buckets.  A file is unchanged if its
+	size and md5 (both base64, as the storage API gives them) match the record; if the md5 of the file is not known
+	(it would take too long to compute), its size and modification time are compared instead.  The record is only
+	trusted for the objects which are still in the bucket as recorded (see check_remote).
+	"""
+	def __init__(self, path, bucket_name):
+		self.path = path
+		self.bucket_name = bucket_name
+		self.lock = threading.Lock()
+		self.entries = self.load().get(bucket_name, {})
+
+	def load(self):
+		if os.path.isfile(self.path):
+			return json.load(open(self.path))
+		return {}
+
+	def entry(self, object_name):
+		with self.lock:
+			e = self.entries.get(object_name)
+			return dict(e) if e else None
+
+	def info(self, object_name):
+		"""
+		Returns the recorded object, in the form given by object_info
+		"""
+		e = self.entry(object_name)
+		info = {'name': object_name, 'size': e['size'], 'generation': e.get('generation')}
+		for k in ['md5', 'crc32c']:
+			if e.get(k):
+				info[k] = e[k]
+		return info
+
+	def unchanged(self, path, object_name, md5 = None):
+		e = self.entry(object_name)
+		if e is None:
+			return False
+		st = os.stat(path)
+		if e['size'] != st.st_size:
+			return False
+		if md5 and e.get('md5'):
+			return md5 == e['md5']
+		return e.get('mtime') == st.st_mtime
+
+	def record(self, path, info, md5 = None):
+		"""
+		Records the upload of the file at path, given the object's info (see object_info) and the file's md5, if known
+		"""
+		entry = {'size': info['size'], 'md5': info.get('md5') or md5, 'generation': info.get('generation'), 
+			'mtime': os.stat(path).st_mtime}
+		if info.get('crc32c'):
+			entry['crc32c'] = info['crc32c']
+		with self.lock:
+			self.entries[info['name']] = entry
+			self.save()
+
+	def check_remote(self, objects):
+		"""
+		Drops the records of the objects which are no longer in the bucket as recorded: missing, or with another 
+		generation, size or md5 (e.g. removed or overwritten by someone else).  objects are those of a listing of the
+		bucket, in the form given by object_info.  Returns the names of the dropped records.
+		"""
+		remote = dict([(o['name'], o) for o in objects])
+		with self.lock:
+			stale = sorted([name for name, e in self.entries.items() if not matches_record(e, remote.get(name))])
+			if stale:
+				logging.info('Objects of gs://%s which changed since their upload, and will be sent again: %s' % (self.bucket_name, ', '.join(stale)))
+				for name in stale:
+					del self.entries[name]
+				self.save()
+		return stale
+
+	def forget(self):
+		"""
+		Drops the records of all the objects (e.g. when the bucket was just created)
+		"""
+		with self.lock:
+			if self.entries:
+				logging.info('Dropping the upload records of gs://%s' % self.bucket_name)
+				self.entries = {}
+				self.save()
+
+	def save(self):
+		# called with the lock held
+		manifest = self.load()
+		manifest[self.bucket_name] = self.entries
+		tmp = self.path + '.tmp'
+		with open(tmp, 'w') as fout:
+			json.dump(manifest, fout, indent = 2, sort_keys = True)
+		os.rename(tmp, self.path)
+
+
+def matches_record(entry, info):
+	"""
+	Returns True if the object (info, as given by object_info, or None if there is no such object) is the one recorded
+	in the manifest entry
+	"""
+	if info is None or info['size'] != entry['size']:
+		return False
+	if entry.get('generation') and info.get('generation') and str(entry['generation']) != str(info['generation']):
+		return False
+	if entry.get('md5') and info.get('md5'):
+		return entry['md5'] == info['md5']
+	return True
+
+
+def plan_parts(size, min_part_size, max_parts = MAX_COMPOSE_PARTS):
+	"""
+	Splits a file of the given size into at most max_parts parts of at least min_part_size bytes (each a multiple of
+	CHUNK_UNIT).  Returns a list of (start, length)
+	"""
+	part_size = max(min_part_size, -(-size // max_parts))
+	part_size = -(-part_size // CHUNK_UNIT) * CHUNK_UNIT
+	return [(start, min(part_size, size - start)) for start in range(0, size, part_size)]
+
+
+def object_info(resource):
+	"""
+	Returns the size, hashes (base64, as gsutil shows them) and generation from an object resource of the JSON API
+	"""
+	info = {'name': resource.get('name'), 'size': int(resource.get('size', 0)), 'generation': resource.get('generation')}
+	if 'md5Hash' in resource:
+		info['md5'] = resource['md5Hash']
+	if 'crc32c' in resource:
+		info['crc32c'] = resource['crc32c']
+	return info
+
+
+def content_type(path):
+	guessed, encoding = mimetypes.guess_type(path)
+	return guessed or 'application/octet-stream'
+
+
+def object_resource(path, object_name, metadata = None):
+	"""
+	Returns the object resource (of the JSON API) for a new object: its name, content type, and the given metadata
+	(e.g. {'contentDisposition': ..., 'metadata': {custom key: value}})
+	"""
+	resource = {'name': object_name, 'contentType': content_type(path)}
+	resource.update(metadata or {})
+	return resource
+
+
+def multipart_body(parts, boundary):
+	"""
+	Joins (headers dict, body) parts into a multipart body with the given boundary
+	"""
+	lines = []
+	for headers, body in parts:
+		lines.append('--%s\r\n' % boundary)
+		lines.extend(['%s: %s\r\n' % (k, v) for k, v in sorted(headers.items())])
+		lines.append('\r\n')
+		lines.append(body)
+		lines.append('\r\n')
+	lines.append('--%s--\r\n' % boundary)
+	return ''.join(lines)
+
+
+def parse_batch_response(response):
+	"""
+	Returns a dict of Content-ID to the HTTP status of each response in a batch response
+	"""
+	match = re.search(r'boundary=([^;\s]+)', response.headers.get('Content-Type', ''))
+	if match is None:
+		return {}
+	statuses = {}
+	for part in response.text.split('--' + match.group(1).strip('"')):
+		content_id = re.search(r'Content-ID:\s*<?response-([^>\s]+)>?', part, re.IGNORECASE)
+		status = re.search(r'HTTP/1\.1 (\d+)', part)
+		if content_id and status:
+			statuses[content_id.group(1)] = int(status.group(1))
+	return statuses
+
+
+class Uploader(object):
+	"""
+	Uploads files to a bucket with a pool of threads.  session_factory makes the HTTP session for each thread.
+	"""
+	def __init__(self, bucket_name, token, workers = 8, chunk_size = 64 * MEGABYTE, session_factory = requests.Session,
+			composite_threshold = 2048 * MEGABYTE, state_dir = None):
+		self.bucket_name = bucket_name
+		self.token = token
+		self.workers = workers
+		self.chunk_size = max(CHUNK_UNIT, chunk_size - chunk_size % CHUNK_UNIT)
+		self.session_factory = session_factory
+		self.composite_threshold = composite_threshold
+		self.state_dir = state_dir
+		if state_dir and not os.path.isdir(state_dir):
+			os.makedirs(state_dir)
+		self.local = threading.local()
+
+	def session(self):
+		if getattr(self.local, 'session', None) is None:
+			self.local.session = self.session_factory()
+		return self.local.session
+
+	def request(self, method, url, headers = None, **kwargs):
+		"""
+		Makes an authorized request.  If the token has expired, it is refreshed and the request is made again.
+		"""
+		headers = dict(headers or {})
+		token = self.token.get()
+		headers['Authorization'] = 'Bearer %s' % token
+		response = self.session().request(method, url, headers = headers, **kwargs)
+		if response.status_code == 401:
+			headers['Authorization'] = 'Bearer %s' % self.token.refresh(token)
+			if hasattr(kwargs.get('data'), 'seek'):
+				kwargs['data'].seek(0)
+			response = self.session().request(method, url, headers = headers, **kwargs)
+		return response
+
+	def with_retries(self, description, function):
+		"""
+		Calls function (which makes a request and returns the response) until it gives a response which is not
+		worth retrying, or MAX_ATTEMPTS have been made
+		"""
+		for attempt in range(MAX_ATTEMPTS):
+			try:
+				response = function()
+				if response.status_code not in RETRY_STATUS:
+					return response
+				problem = 'status %s' % response.status_code
+			except requests.exceptions.RequestException as ex:
+				problem = str(ex)
+			logging.warning('%s failed (attempt %d of %d): %s' % (description, attempt + 1, MAX_ATTEMPTS, problem))
+			time.sleep(BACKOFF * 2 ** attempt)
+		raise UploadException('%s failed after %d attempts' % (description, MAX_ATTEMPTS))
+
+	def check(self, response, description):
+		if response.status_code not in (200, 201):
+			raise UploadException('%s failed with status %s: %s' % (description, response.status_code, response.text))
+		return response
+
+	def state(self, path, object_name, part_size):
+		state_file = None
+		if self.state_dir:
+			key = hashlib.sha1('%s/%s' % (self.bucket_name, object_name)).hexdigest()
+			state_file = os.path.join(self.state_dir, key + '.json')
+		return UploadState(state_file, path, object_name, part_size)
+
+	def upload_file(self, path, object_name, metadata = None):
+		"""
+		Uploads a file (in a single stream) to object_name in the bucket, with the given metadata (see object_resource).
+		Returns the object's info (see object_info)
+		"""
+		size = os.path.getsize(path)
+		if size <= self.chunk_size:
+			resource = self.multipart_upload(path, object_name, metadata)
+		else:
+			state = self.state(path, object_name, size)
+			resource = self.resumable_upload(path, object_name, 0, size, state, 0, metadata)
+			state.remove()
+		return object_info(resource)
+
+	def multipart_upload(self, path, object_name, metadata = None):
+		"""
+		Uploads a (small) file and its metadata in a single request
+		"""
+		url = UPLOAD_URL % self.bucket_name
+		params = {'uploadType': 'multipart'}
+		boundary = uuid.uuid4().hex
+		headers = {'Content-Type': 'multipart/related; boundary=%s' % boundary}
+		body = multipart_body([({'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(object_resource(path, object_name, metadata))),
+				({'Content-Type': content_type(path)}, open(path, 'rb').read())], boundary)
+		send = lambda: self.request('POST', url, params = params, headers = headers, data = body)
+		response = self.check(self.with_retries('Upload of %s' % path, send), 'Upload of %s' % path)
+		return response.json()
+
+	def start_session(self, path, object_name, size, metadata = None):
+		"""
+		Starts a resumable upload session (for an object with the given metadata) and returns its URL
+		"""
+		url = UPLOAD_URL % self.bucket_name
+		params = {'uploadType': 'resumable', 'name': object_name}
+		headers = {'X-Upload-Content-Type': content_type(path), 'X-Upload-Content-Length': str(size),
+				'Content-Type': 'application/json; charset=UTF-8'}
+		resource = json.dumps(object_resource(path, object_name, metadata))
+		send = lambda: self.request('POST', url, params = params, headers = headers, data = resource)
+		response = self.check(self.with_retries('Starting the upload of %s' % path, send), 'Starting the upload of %s' % path)
+		return response.headers['Location']
+
+	def committed(self, session_url, size):
+		"""
+		Asks the upload session how much it has received.  Returns (bytes received, the object resource if complete)
+		"""
+		headers = {'Content-Range': 'bytes */%d' % size, 'Content-Length': '0'}
+		response = self.with_retries('Status of %s' % session_url, lambda: self.request('PUT', session_url, headers = headers))
+		if response.status_code in (200, 201):
+			return size, response.json()
+		if response.status_code == 308:
+			received = response.headers.get('Range')
+			return (int(received.split('-')[1]) + 1 if received else 0), None
+		raise UploadException('Upload session %s failed with status %s: %s' % (session_url, response.status_code, response.text))
+
+	def resumable_upload(self, path, object_name, start, length, state, part, metadata = None):
+		"""
+		Sends length bytes of the file (from start) in chunks through a resumable upload session.  After a failed chunk,
+		the session is asked how much it received, and the upload carries on from there.  The session URL is kept in
+		the state (as the given part), so a session from a previous attempt is continued if it is still open.
+		"""
+		session_url = state.part(part).get('session_url')
+		offset = 0
+		if session_url:
+			try:
+				offset, resource = self.committed(session_url, length)
+				if resource is not None:
+					return resource
+				logging.info('Resuming the upload of %s at byte %d' % (object_name, offset))
+			except UploadException as ex:
+				logging.info('Could not resume the upload session of %s (%s).  Starting again.' % (object_name, ex))
+				session_url = None
+				offset = 0
+		if session_url is None:
+			session_url = self.start_session(path, object_name, length, metadata)
+			state.update(part, session_url = session_url)
+
+		failures = 0
+		with open(path, 'rb') as fin:
+			while True:
+				fin.seek(start + offset)
+				chunk = fin.read(min(self.chunk_size, length - offset))
+				end = offset + len(chunk) - 1
+				headers = {'Content-Range': 'bytes %d-%d/%d' % (offset, end, length)}
+				try:
+					response = self.request('PUT', session_url, headers = headers, data = chunk)
+					status = response.status_code
+				except requests.exceptions.RequestException as ex:
+					response = None
+					status = str(ex)
+				if response is not None and response.status_code in (200, 201):
+					return response.json()
+				if response is not None and response.status_code == 308:
+					received = response.headers.get('Range')
+					offset = int(received.split('-')[1]) + 1 if received else 0
+					failures = 0
+					continue
+				if response is not None and response.status_code not in RETRY_STATUS:
+					raise UploadException('Upload of %s failed with status %s: %s' % (path, response.status_code, response.text))
+				failures += 1
+				if failures >= MAX_ATTEMPTS:
+					raise UploadException('Upload of %s failed after %d attempts at byte %d' % (path, MAX_ATTEMPTS, offset))
+				logging.warning('Chunk at byte %d of %s failed (%s).  Resuming.' % (offset, object_name, status))
+				time.sleep(BACKOFF * 2 ** (failures - 1))
+				offset, resource = self.committed(session_url, length)
+				if resource is not None:
+					return resource
+
+	def upload_part(self, task):
+		"""
+		Uploads one part of a composite upload to its temporary object, and marks it complete in the state
+		"""
+		path, object_name, part, start, length, state = task
+		resource = self.resumable_upload(path, PART_NAME % (object_name, part), start, length, state, part)
+		state.update(part, done = True, name = resource['name'])
+
+	def compose(self, path, object_name, parts, state, metadata = None):
+		"""
+		Composes the uploaded parts into the final object (with the given metadata), then removes the parts and the state.
+		Returns the object's info
+		"""
+		url = COMPOSE_URL % (self.bucket_name, urllib.quote(object_name, safe = ''))
+		headers = {'Content-Type': 'application/json; charset=UTF-8'}
+		body = {'sourceObjects': [{'name': PART_NAME % (object_name, part)} for part in range(len(parts))], 
+			'destination': object_resource(path, object_name, metadata)}
+		send = lambda: self.request('POST', url, headers = headers, data = json.dumps(body))
+		try:
+			resource = self.check(self.with_retries('Composing %s' % object_name, send), 'Composing %s' % object_name).json()
+		finally:
+			# whether or not it worked (e.g. a part has gone missing), the parts are not left in the bucket, and the
+			# file is uploaded again from the start next time
+			for part in range(len(parts)):
+				self.delete(PART_NAME % (object_name, part))
+			state.remove()
+		return object_info(resource)
+
+	def list_objects(self, prefix = None):
+		"""
+		Returns the resources of the objects in the bucket (whose names start with prefix, if given)
+		"""
+		url = LIST_URL % self.bucket_name
+		params = {'fields': 'items(name,size,generation,md5Hash,crc32c),nextPageToken'}
+		if prefix:
+			params['prefix'] = prefix
+		objects = []
+		while True:
+			send = lambda: self.request('GET', url, params = dict(params))
+			page = self.check(self.with_retries('Listing gs://%s' % self.bucket_name, send), 'Listing gs://%s' % self.bucket_name).json()
+			objects.extend(page.get('items', []))
+			if not page.get('nextPageToken'):
+				return objects
+			params['pageToken'] = page['nextPageToken']
+
+	def remove_stale_parts(self, keep):
+		"""
+		Removes the part objects (e.g. of an earlier attempt which failed) other than those named in keep
+		"""
+		for resource in self.list_objects(PART_PREFIX):
+			if resource['name'] not in keep:
+				logging.info('Removing the part gs://%s/%s, left by an earlier upload' % (self.bucket_name, resource['name']))
+				self.delete(resource['name'])
+
+	def delete(self, object_name):
+		url = OBJECT_URL % (self.bucket_name, urllib.quote(object_name, safe = ''))
+		response = self.with_retries('Removing %s' % object_name, lambda: self.request('DELETE', url))
+		if response.status_code not in (200, 204, 404):
+			logging.warning('Could not remove %s (status %s)' % (object_name, response.status_code))
+
+	def upload_job(self, job):
+		path, object_name, metadata = job
+		start = time.time()
+		info = self.upload_file(path, object_name, metadata)
+		info['path'] = path
+		info['seconds'] = time.time() - start
+		logging.info('Uploaded %s to gs://%s/%s: %.1f MB in %.1f s (%.1f MB/s)' % (path, self.bucket_name, object_name,
+				float(info['size']) / MEGABYTE, info['seconds'], float(info['size']) / MEGABYTE / max(info['seconds'], 1e-6)))
+		return info
+
+	def upload_all(self, jobs, manifest = None, md5s = None):
+		"""
+		jobs is a list of (path, object name) or (path, object name, metadata).  Uploads them and returns their object
+		infos.  The files larger than the composite threshold are split into parts.  The files and parts all go through
+		the same pool of threads, the largest first, and the parts which were completed by a previous attempt are skipped.
+		If an UploadManifest is given, the files which are unchanged since their last upload are skipped (their recorded
+		infos are returned), and the uploads are recorded in it.  md5s gives the (base64) md5 of the files, where known.
+		"""
+		md5s = md5s or {}
+		start = time.time()
+		tasks = []
+		composites = []
+		skipped = []
+		for job in jobs:
+			path, object_name = job[:2]
+			metadata = job[2] if len(job) > 2 else None
+			size = os.path.getsize(path)
+			if manifest is not None and manifest.unchanged(path, object_name, md5s.get(path)):
+				skipped.append(manifest.info(object_name))
+			elif size > self.composite_threshold:
+				parts = plan_parts(size, self.chunk_size)
+				state = self.state(path, object_name, parts[0][1])
+				pending = [(path, object_name, i, part_start, length, state) for i, (part_start, length) in enumerate(parts)
+						if not state.part(i).get('done')]
+				logging.info('Uploading %s as %d parts (%d already uploaded)' % (path, len(parts), len(parts) - len(pending)))
+				tasks.extend([(length, self.upload_part, task) for task in pending])
+				composites.append((path, object_name, parts, state, metadata))
+			else:
+				tasks.append((size, self.upload_job, (path, object_name, metadata)))
+		tasks.sort(key = lambda t: t[0], reverse = True)
+		if composites:
+			self.remove_stale_parts(set([PART_NAME % (object_name, i) for path, object_name, parts, state, metadata in composites
+					for i in range(len(parts))]))
+
+		results = []
+		pool = ThreadPool(max(1, min(self.workers, len(tasks))))
+		try:
+			for info in pool.imap_unordered(lambda t: t[1](t[2]), tasks):
+				if info is not None:
+					results.append(info)
+					if manifest is not None:
+						manifest.record(info['path'], info, md5s.get(info['path']))
+		finally:
+			pool.close()
+			pool.join()
+		for path, object_name, parts, state, metadata in composites:
+			info = self.compose(path, object_name, parts, state, metadata)
+			info['seconds'] = time.time() - start
+			logging.info('Uploaded %s to gs://%s/%s in %d parts: %.1f MB' % (path, self.bucket_name, object_name, len(parts),
+					float(info['size']) / MEGABYTE))
+			results.append(info)
+			if manifest is not None:
+				manifest.record(path, info, md5s.get(path))
+
+		seconds = time.time() - start
+		total = sum([r['size'] for r in results])
+		logging.info('Uploaded %d files to gs://%s: %.1f MB in %.1f s (%.1f MB/s)' % (len(results), self.bucket_name,
+				float(total) / MEGABYTE, seconds, float(total) / MEGABYTE / max(seconds, 1e-6)))
+		if skipped:
+			logging.info('Skipped %d files which were unchanged since their last upload to gs://%s' % (len(skipped), self.bucket_name))
+		return results + skipped
+
+	def patch_metadata(self, object_name, metadata):
+		"""
+		Updates the metadata (e.g. contentDisposition) of an object in the bucket
+		"""
+		url = OBJECT_URL % (self.bucket_name, urllib.quote(object_name, safe = ''))
+		headers = {'Content-Type': 'application/json; charset=UTF-8'}
+		send = lambda: self.request('PATCH', url, headers = headers, data = json.dumps(metadata))
+		return self.check(self.with_retries('Metadata update of %s' % object_name, send), 'Metadata update of %s' % object_name).json()
+
+	def patch_metadata_batch(self, updates):
+		"""
+		Updates the metadata of existing objects.  updates is a list of (object name, metadata).  They are sent in batch
+		requests of up to MAX_BATCH_SIZE, and any which fail in the batch are tried again one at a time.
+		"""
+		for i in range(0, len(updates), MAX_BATCH_SIZE):
+			batch = updates[i:i + MAX_BATCH_SIZE]
+			boundary = 'batch_' + uuid.uuid4().hex
+			parts = []
+			for j, (object_name, metadata) in enumerate(batch):
+				request = 'PATCH /storage/v1/b/%s/o/%s HTTP/1.1\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n%s' % (self.bucket_name, 
+						urllib.quote(object_name, safe = ''), json.dumps(metadata))
+				parts.append(({'Content-Type': 'application/http', 'Content-ID': '<%d>' % j}, request))
+			headers = {'Content-Type': 'multipart/mixed; boundary=%s' % boundary}
+			body = multipart_body(parts, boundary)
+			send = lambda: self.request('POST', BATCH_URL, headers = headers, data = body)
+			response = self.check(self.with_retries('Batch metadata update', send), 'Batch metadata update')
+			statuses = parse_batch_response(response)
+			failed = [batch[j] for j in range(len(batch)) if statuses.get(str(j)) != 200]
+			logging.info('Updated the metadata of %d objects in gs://%s in a batch request' % (len(batch) - len(failed), self.bucket_name))
+			for object_name, metadata in failed:
+				self.patch_metadata(object_name, metadata)
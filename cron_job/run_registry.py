@@ -0,0 +1,211 @@
+"""
+A small SQLite-backed registry of the flowcell directories the scanner has seen, and what state they are in.
+
+This replaces the flat pipeline_cache file, which had to be read (and each entry resolved with realpath)
+and rewritten in full on every scan.  Here, each lookup/update is an indexed query, and state changes are
+single UPDATE statements guarded by the expected current state, so two scanners cannot both claim the same run.
+"""
+
+import os
+import sqlite3
+import time
+import logging
+
+DISCOVERED = 'discovered'
+QUEUED = 'queued'
+RUNNING = 'running'
+FAILED = 'failed'
+DONE = 'done'
+
+STATES = [DISCOVERED, QUEUED, RUNNING, FAILED, DONE]
+
+# an instrument directory's mtime is only trusted once it is older than this (in seconds).  Otherwise a directory
+# created in the same timestamp 'tick' as our listing (e.g. on filesystems with 1s resolution) could be missed
+MTIME_SETTLE_TIME = 2
+
+# a discovered directory that is still not ready this long (in seconds) after it was found is considered stale (e.g. an
+# aborted sequencing run).  Its readiness checks are then spaced out, doubling each time up to the given maximum
+STALE_TIME = 3 * 24 * 3600
+MAX_CHECK_INTERVAL = 24 * 3600
+
+
+class InvalidStateException(Exception):
+	pass
+
+
+class RunRegistry(object):
+
+	def __init__(self, db_path, legacy_cache = None, instrument_dirs = (), in_progress_file = None):
+		"""
+		db_path is the path to the sqlite database file (created if it does not exist)
+		legacy_cache is the path to an old-style pipeline_cache file.  If given (and the registry is new), the directories
+			listed there are imported as already done.  Directories in instrument_dirs which are not listed there but
+			contain the in_progress_file were started and never finished, so they are imported as failed.
+		"""
+		self.db_path = db_path
+		self._connection = None
+		self.create_tables()
+		if legacy_cache and os.path.isfile(legacy_cache) and self.count() == 0:
+			self.import_legacy_cache(legacy_cache, instrument_dirs, in_progress_file)
+
+	@property
+	def connection(self):
+		"""
+		The connection is opened on first use, so that close() can be called before forking and the parent simply 
+		reconnects afterwards-- the child never holds an open sqlite connection
+		"""
+		if self._connection is None:
+			# isolation_level=None puts the connection in autocommit mode; multi-statement changes use explicit transactions
+			self._connection = sqlite3.connect(self.db_path, timeout = 60, isolation_level = None)
+		return self._connection
+
+	def close(self):
+		if self._connection is not None:
+			self._connection.close()
+			self._connection = None
+
+	def create_tables(self):
+		c = self.connection
+		c.execute('CREATE TABLE IF NOT EXISTS runs (path TEXT PRIMARY KEY, instrument TEXT, mtime REAL, state TEXT NOT NULL, returncode INTEGER, updated REAL)')
+		# registries created before the readiness checks were spaced out do not have the checks/next_check columns
+		columns = [r[1] for r in c.execute('PRAGMA table_info(runs)')]
+		if 'next_check' not in columns:
+			c.execute('ALTER TABLE runs ADD COLUMN checks INTEGER NOT NULL DEFAULT 0')
+			c.execute('ALTER TABLE runs ADD COLUMN next_check REAL')
+		c.execute('CREATE INDEX IF NOT EXISTS runs_by_state_mtime ON runs (state, mtime)')
+		c.execute('CREATE INDEX IF NOT EXISTS runs_by_mtime ON runs (mtime)')
+		# maps the paths as they are listed in the instrument directories to the resolved path, so that known
+		# entries never need to be resolved again
+		c.execute('CREATE TABLE IF NOT EXISTS aliases (listed_path TEXT PRIMARY KEY, path TEXT NOT NULL)')
+		c.execute('CREATE TABLE IF NOT EXISTS instruments (path TEXT PRIMARY KEY, mtime REAL)')
+
+	def count(self):
+		return self.connection.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+
+	def import_legacy_cache(self, legacy_cache, instrument_dirs = (), in_progress_file = None):
+		logging.info('Importing previously processed directories from %s' % legacy_cache)
+		paths = [d.strip() for d in open(legacy_cache) if len(d.strip()) > 0]
+		imported = [(p, DONE) for p in paths]
+
+		# the old cache only recorded successful runs.  A failed run was left out of it, and was only kept from being
+		# restarted by its progress file.  Import those as failed, rather than discovering them as new.
+		if in_progress_file:
+			done = set(map(os.path.realpath, paths))
+			for instrument in instrument_dirs:
+				for d in os.listdir(instrument):
+					p = os.path.join(instrument, d)
+					if os.path.realpath(p) not in done and os.path.isfile(os.path.join(p, in_progress_file)):
+						logging.info('Importing %s as failed' % p)
+						imported.append((p, FAILED))
+
+		now = time.time()
+		c = self.connection
+		c.execute('BEGIN IMMEDIATE')
+		try:
+			for p, state in imported:
+				c.execute('INSERT OR IGNORE INTO runs (path, instrument, mtime, state, updated) VALUES (?,?,?,?,?)',
+					(os.path.realpath(p), os.path.dirname(p), None, state, now))
+				c.execute('INSERT OR IGNORE INTO aliases (listed_path, path) VALUES (?,?)', (p, os.path.realpath(p)))
+			c.execute('COMMIT')
+		except:
+			c.execute('ROLLBACK')
+			raise
+
+	def is_known(self, listed_path):
+		return self.connection.execute('SELECT 1 FROM aliases WHERE listed_path=?', (listed_path,)).fetchone() is not None
+
+	def add(self, listed_path, instrument, mtime):
+		"""
+		Registers a newly found flowcell directory as discovered.  Returns the resolved path.
+		"""
+		path = os.path.realpath(listed_path)
+		c = self.connection
+		c.execute('BEGIN IMMEDIATE')
+		try:
+			c.execute('INSERT OR IGNORE INTO runs (path, instrument, mtime, state, updated) VALUES (?,?,?,?,?)',
+				(path, instrument, mtime, DISCOVERED, time.time()))
+			c.execute('INSERT OR IGNORE INTO aliases (listed_path, path) VALUES (?,?)', (listed_path, path))
+			c.execute('COMMIT')
+		except:
+			c.execute('ROLLBACK')
+			raise
+		return path
+
+	def get_state(self, path):
+		row = self.connection.execute('SELECT state FROM runs WHERE path=?', (path,)).fetchone()
+		if row:
+			return row[0]
+		return None
+
+	def in_state(self, state):
+		"""
+		Returns the paths of the runs in the given state, oldest directories first
+		"""
+		return [r[0] for r in self.connection.execute('SELECT path FROM runs WHERE state=? ORDER BY mtime', (state,))]
+
+	def due_for_check(self, now = None):
+		"""
+		Returns the discovered directories whose readiness should be checked now, oldest directories first.  Stale
+		directories which were checked recently are left out (see not_ready).
+		"""
+		if now is None:
+			now = time.time()
+		return [r[0] for r in self.connection.execute('SELECT path FROM runs WHERE state=? AND (next_check IS NULL OR next_check<=?) ORDER BY mtime',
+			(DISCOVERED, now))]
+
+	def not_ready(self, path, now = None):
+		"""
+		Records a readiness check which found the directory not ready.  Once the directory has been waiting for longer
+		than STALE_TIME, the next check is put off by an interval which doubles with each check, up to MAX_CHECK_INTERVAL.
+		"""
+		if now is None:
+			now = time.time()
+		# for a discovered run, 'updated' is the time it was found
+		row = self.connection.execute('SELECT checks, updated FROM runs WHERE path=? AND state=?', (path, DISCOVERED)).fetchone()
+		if row is None or now - row[1] < STALE_TIME:
+			return
+		checks = row[0] + 1
+		next_check = now + min(MAX_CHECK_INTERVAL, 60 * 2 ** min(checks, 16))
+		self.connection.execute('UPDATE runs SET checks=?, next_check=? WHERE path=? AND state=?', (checks, next_check, path, DISCOVERED))
+
+	def transition(self, path, from_state, to_state, returncode = None):
+		"""
+		Moves a run from from_state to to_state.  Returns True if this call made the change, or False if the run
+		was not in from_state (e.g. another scanner already claimed it).
+		"""
+		if to_state not in STATES:
+			raise InvalidStateException('Unknown state: %s' % to_state)
+		cursor = self.connection.execute('UPDATE runs SET state=?, returncode=?, updated=? WHERE path=? AND state=?',
+					(to_state, returncode, time.time(), path, from_state))
+		return cursor.rowcount == 1
+
+	def instrument_mtime(self, instrument):
+		row = self.connection.execute('SELECT mtime FROM instruments WHERE path=?', (instrument,)).fetchone()
+		if row:
+			return row[0]
+		return None
+
+	def set_instrument_mtime(self, instrument, mtime):
+		if time.time() - mtime < MTIME_SETTLE_TIME:
+			mtime = None
+		self.connection.execute('INSERT OR REPLACE INTO instruments (path, mtime) VALUES (?,?)', (instrument, mtime))
+
+	def scan_instrument(self, instrument):
+		"""
+		Registers any new flowcell directories in the instrument directory.  If the instrument directory has not been
+		modified since the last scan, no new directories can have been created and the listing is skipped entirely.
+		Only entries not seen before are stat'd and resolved.
+
+		Returns the resolved paths of the newly discovered directories.
+		"""
+		mtime = os.stat(instrument).st_mtime
+		if mtime == self.instrument_mtime(instrument):
+			return []
+		new_dirs = []
+		for d in os.listdir(instrument):
+			listed_path = os.path.join(instrument, d)
+			if not self.is_known(listed_path) and os.path.isdir(listed_path):
+				logging.info('Discovered new flowcell directory at %s' % listed_path)
+				new_dirs.append(self.add(listed_path, instrument, os.stat(listed_path).st_mtime))
+		self.set_instrument_mtime(instrument, mtime)
+		return new_dirs
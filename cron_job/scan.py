@@ -8,6 +8,15 @@ import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import datetime
+import time
+import logging
+import run_registry
+
+try:
+	import pyinotify
+except ImportError:
+	# without inotify support the daemon falls back to periodically listing the instrument directories
+	pyinotify = None
 
 
 def send_error_email(subscribers, flowcell_directory, server, port):
@@ -74,61 +83,381 @@ def create_progress_file(f, command):
 		out.write(command)
 
 
-def main(params):
-	# Get the absolute path to this directory
-	this_dir = os.path.dirname(os.path.abspath(__file__))
+def create_run_args(d, params, subscribers):
+	"""
+	Writes the progress file into the flowcell directory and returns the commandline args for the demux script
+	"""
+	progress_file = os.path.join(d, params.get('in_progress_file'))
+	args = ['-r', d, '-i', 'nextseq', '-e', ','.join(subscribers)]
+	create_progress_file(progress_file, params.get('demux_script') + ' ' + ' '.join(args))
+	os.chmod(progress_file, 0775)
+	return args
+
+
+def launch_run(d, params, this_dir, subscribers):
+	"""
+	Starts the demux process for a single flowcell directory and returns the (non-blocking) Popen instance
+	"""
+	args = create_run_args(d, params, subscribers)
+	command = os.path.realpath(os.path.join(this_dir, os.pardir, params.get('demux_script'))) + ' '
+	command += ' '.join(args)
+
+	# the demux process writes its own log, so we do not keep its stdout.  Sending it to a pipe that nobody
+	# reads would eventually block the child once the pipe buffer fills up
+	# the child has its own copy of the descriptor, so ours is closed straight away
+	with open(os.devnull, 'w') as devnull:
+		return subprocess.Popen(command, shell = True, stderr=subprocess.STDOUT, stdout=devnull)
+
+
+class ForkedRun(object):
+	"""
+	Used by the daemon.  Rather than starting a new interpreter (and re-importing the pipeline and its
+	dependencies) for every flowcell, fork the already-loaded daemon process and call the demux script's
+	process() function directly in the child.
+
+	Mimics the poll()/returncode parts of the Popen interface so the scheduler can treat both the same way.
+	"""
+	def __init__(self, demux_module, args):
+		self.returncode = None
+		self.pid = os.fork()
+		if self.pid == 0:
+			code = 0
+			try:
+				sys.argv = [demux_module.__file__] + args
+				# the demux script configures its own log file via logging.basicConfig, which is a no-op
+				# if the root logger already has handlers (as it does in the daemon)
+				logging.root.handlers = []
+				demux_module.process()
+			except SystemExit as ex:
+				if ex.code is None:
+					code = 0
+				elif isinstance(ex.code, int):
+					code = ex.code
+				else:
+					code = 1
+			except BaseException:
+				code = 1
+			finally:
+				sys.stdout.flush()
+				os._exit(code)
+
+	def poll(self):
+		if self.returncode is None:
+			pid, status = os.waitpid(self.pid, os.WNOHANG)
+			if pid != 0:
+				if os.WIFEXITED(status):
+					self.returncode = os.WEXITSTATUS(status)
+				else:
+					self.returncode = 1
+		return self.returncode
+
+
+class RunScheduler(object):
+	"""
+	Keeps a bounded number of demux processes running.  Each child is tracked on its own-- as soon as one 
+	finishes, on_success (or the error email) is handled for that directory and the freed slot is given 
+	to the next waiting directory.
+	"""
+	def __init__(self, params, this_dir, subscribers, comp_subscribers, on_success, launcher = None, on_start = None, on_failure = None):
+		self.params = params
+		self.this_dir = this_dir
+		self.subscribers = subscribers
+		self.comp_subscribers = comp_subscribers
+		self.on_success = on_success
+		self.launcher = launcher
+		self.on_start = on_start
+		self.on_failure = on_failure
+		self.max_concurrent_runs = max(1, int(params.get('max_concurrent_runs', 1)))
+		self.waiting = []
+		self.running = {}
+
+	def __contains__(self, d):
+		return d in self.running or d in self.waiting
 
+	def busy(self):
+		return len(self.waiting) > 0 or len(self.running) > 0
+
+	def submit(self, d):
+		if d not in self:
+			self.waiting.append(d)
+
+	def step(self):
+		"""
+		Starts waiting runs if there are open slots and handles any runs that have finished
+		"""
+		# module-level lookup at call time, so the launcher can be swapped out (e.g. for testing)
+		launcher = self.launcher or launch_run
+		while self.waiting and len(self.running) < self.max_concurrent_runs:
+			d = self.waiting.pop(0)
+			logging.info('Starting processing of %s' % d)
+			if self.on_start:
+				self.on_start(d)
+			self.running[d] = launcher(d, self.params, self.this_dir, self.subscribers)
+
+		for d, process in self.running.items():
+			if process.poll() is not None:
+				self.running.pop(d)
+				logging.info('Processing of %s finished with return code %s' % (d, process.returncode))
+				if process.returncode == 0:
+					self.on_success(d)
+				else:
+					if self.on_failure:
+						self.on_failure(d, process.returncode)
+					try:
+						send_error_email(self.comp_subscribers, d, self.params.get('smtp_server'), self.params.get('smtp_port'))
+					except (smtplib.SMTPException, IOError) as ex:
+						# a mail server problem should not stop the processing of other runs
+						logging.error('Could not send the error email for %s: %s' % (d, ex))
+
+
+def schedule_runs(ready_dirs, params, this_dir, subscribers, comp_subscribers, on_success, on_start = None, on_failure = None):
+	"""
+	Processes the flowcell directories in ready_dirs using a bounded number of concurrent processes.
+	Returns once all of them have finished.
+	"""
+	poll_interval = float(params.get('poll_interval', 30))
+	scheduler = RunScheduler(params, this_dir, subscribers, comp_subscribers, on_success, on_start = on_start, on_failure = on_failure)
+	for d in ready_dirs:
+		scheduler.submit(d)
+	while scheduler.busy():
+		scheduler.step()
+		if scheduler.running:
+			time.sleep(poll_interval)
+
+
+def get_instrument_dirs(params):
 	instrument_dirs = params.get('instrument_dirs')
 
 	# if only checking a single directory, this is a string-- to use properly in a 'for' loop
 	# make this into a list:
 	if isinstance(instrument_dirs, str):
 		instrument_dirs = [instrument_dirs,]
+	return instrument_dirs
+
+
+def is_ready(d, params):
+	"""
+	A flowcell directory is ready once the instrument has written the target file and we have not already started on it
+	"""
+	progress_file = os.path.join(d, params.get('in_progress_file'))
+	return os.path.isfile(os.path.join(d, params.get('target_file'))) and not os.path.isfile(progress_file)
+
+
+def open_registry(params, this_dir):
+	"""
+	Opens the run registry.  The first time, any directories listed in the old pipeline_cache file are imported as done,
+	and those which were started but are not listed there are imported as failed.
+	"""
+	return run_registry.RunRegistry(os.path.join(this_dir, params.get('run_registry')), 
+					legacy_cache = os.path.join(this_dir, params.get('cache_file')),
+					instrument_dirs = get_instrument_dirs(params),
+					in_progress_file = params.get('in_progress_file'))
+
+
+def discover_new_dirs(params, registry):
+	"""
+	Registers any new flowcell directories in the instrument directories.  
+	"""
+	for instrument in get_instrument_dirs(params):
+		registry.scan_instrument(instrument)
+
 
-	# iterate through the instruments, collecting the paths:
-	all_flowcell_dirs = []
-	for instrument in instrument_dirs:
-		all_flowcell_dirs += [os.path.join(instrument,d) for d in os.listdir(instrument)]
-	
-	# filter to retain only directories	
-	all_flowcell_dirs = set(filter(lambda x: os.path.isdir(x), all_flowcell_dirs))
+def claim_ready_dirs(params, registry, candidates = None):
+	"""
+	Checks the discovered (not yet started) directories and moves those that are ready into the queued state.
+	Returns the directories this call claimed- if another scanner got there first, the directory is not returned.
+	candidates optionally restricts the check to particular directories (e.g. those with a filesystem event), which 
+	are checked even if they are stale.  Otherwise, stale directories are only checked when they are due.
+	"""
+	if candidates is not None:
+		candidates = set(candidates)
+		discovered = [d for d in registry.in_state(run_registry.DISCOVERED) if d in candidates]
+	else:
+		discovered = registry.due_for_check()
+	claimed = []
+	for d in discovered:
+		if not is_ready(d, params):
+			registry.not_ready(d)
+		elif registry.transition(d, run_registry.DISCOVERED, run_registry.QUEUED):
+			claimed.append(d)
+	return claimed
 
-	# Load the pipeline_cache file, which tells us which directories have already been processed
-	CACHE = os.path.join(this_dir, params.get('cache_file'))
-	processed_flowcells = set([d.strip() for d in open(CACHE)])
 
-	# resolve symlinks, etc. by using realpath method:
-	all_flowcell_dirs = set(map(os.path.realpath, all_flowcell_dirs))
-	processed_flowcells = set(map(os.path.realpath, processed_flowcells))
+def registry_callbacks(registry):
+	"""
+	Returns the (on_start, on_success, on_failure) callbacks which record state changes in the registry
+	"""
+	on_start = lambda d: registry.transition(d, run_registry.QUEUED, run_registry.RUNNING)
+	on_success = lambda d: registry.transition(d, run_registry.RUNNING, run_registry.DONE, 0)
+	on_failure = lambda d, returncode: registry.transition(d, run_registry.RUNNING, run_registry.FAILED, returncode)
+	return on_start, on_success, on_failure
 
-	# Detect new/unprocessed directories by looking at the set difference:
-	unprocessed_dirs = all_flowcell_dirs.difference(processed_flowcells)
 
+def get_subscribers(params):
 	# have to handle whether the config file had a list of just a single item-- we ultimately need a list to pass to
 	# the notification/email methods, so have to convert strings to a single-item list.
 	converter = lambda x: [x] if isinstance(x, str) else x
-	subscribers = converter(params.get('subscribers'))
-	comp_subscribers = converter(params.get('comp_subscribers'))
-	for d in unprocessed_dirs:
-		progress_file = os.path.join(d, params.get('in_progress_file'))
-		if os.path.isfile(os.path.join(d, params.get('target_file'))) and not os.path.isfile(progress_file):
-			command = os.path.realpath(os.path.join(this_dir, os.pardir, params.get('demux_script'))) + ' '
-			args = ['-r', d, '-i', 'nextseq', '-e', ','.join(subscribers)]
-			command += ' '.join(args)
-			create_progress_file(progress_file, command)
-			os.chmod(progress_file, 0775)
-			process = subprocess.Popen(command, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-			stdout, stderr = process.communicate()
-			if process.returncode == 0:
-				processed_flowcells.add(d)
-			else:
-				send_error_email(comp_subscribers, d, params.get('smtp_server'), params.get('smtp_port'))
-			
-			
-	with open(CACHE, 'w') as cache_file:
-		cache_file.write('\n'.join(processed_flowcells))
+	return converter(params.get('subscribers')), converter(params.get('comp_subscribers'))
+
+
+def main(params):
+	# Get the absolute path to this directory
+	this_dir = os.path.dirname(os.path.abspath(__file__))
+
+	registry = open_registry(params, this_dir)
+	discover_new_dirs(params, registry)
+	ready_dirs = claim_ready_dirs(params, registry)
+
+	subscribers, comp_subscribers = get_subscribers(params)
+
+	# the registry is updated as each run completes, so a long-running (or failed) run does not hold up the record for the others
+	on_start, on_success, on_failure = registry_callbacks(registry)
+	schedule_runs(ready_dirs, params, this_dir, subscribers, comp_subscribers, on_success, on_start = on_start, on_failure = on_failure)
+
+
+class PollingWatcher(object):
+	"""
+	Fallback for when inotify is not available.  Simply waits, after which the daemon does a full listing
+	of the instrument directories.
+	"""
+	def __init__(self, params):
+		self.interval = float(params.get('watch_interval', 10))
+
+	def watch(self, flowcell_dirs):
+		pass
+
+	def wait(self):
+		"""
+		Returns None, which tells the caller that it has to check all the instrument directories
+		"""
+		time.sleep(self.interval)
+		return None
+
+
+class InotifyWatcher(object):
+	"""
+	Watches the instrument directories for new flowcell directories, and the (incomplete) flowcell 
+	directories for the appearance of the target file.  Only the flowcell directories themselves are watched
+	(not recursively), so the number of watches stays small regardless of the size of the run folders.
+	"""
+	def __init__(self, params):
+		self.interval = float(params.get('watch_interval', 10))
+		self.target_file = params.get('target_file')
+		self.candidates = set()
+		self.instrument_dirs = set(map(os.path.realpath, get_instrument_dirs(params)))
+		self.watch_manager = pyinotify.WatchManager()
+		self.mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE
+		self.notifier = pyinotify.Notifier(self.watch_manager, self.handle_event, timeout = int(self.interval * 1000))
+		for instrument in self.instrument_dirs:
+			self.watch_manager.add_watch(instrument, self.mask)
+
+	def watch(self, flowcell_dirs):
+		watched = set(w.path for w in self.watch_manager.watches.values())
+		for d in flowcell_dirs:
+			if d not in watched:
+				self.watch_manager.add_watch(d, self.mask)
+
+	def handle_event(self, event):
+		path = os.path.realpath(event.path)
+		if path in self.instrument_dirs and event.dir:
+			# a new flowcell directory-- watch it for the target file
+			new_dir = os.path.realpath(event.pathname)
+			logging.info('New flowcell directory detected: %s' % new_dir)
+			self.watch([new_dir,])
+			# the target file could have been written before the watch was in place
+			self.candidates.add(new_dir)
+		elif event.name == self.target_file:
+			logging.info('Found %s in %s' % (self.target_file, path))
+			self.candidates.add(path)
+
+	def wait(self):
+		"""
+		Blocks until events arrive (or the watch interval passes) and returns the set of flowcell directories
+		which might have become ready
+		"""
+		if self.notifier.check_events():
+			self.notifier.read_events()
+			self.notifier.process_events()
+		candidates = self.candidates
+		self.candidates = set()
+		return candidates
+
+
+def load_demux_module(params, this_dir):
+	"""
+	Imports the demux script (and with it, the pipeline and its dependencies) once, so that each 
+	forked run starts with everything already loaded.
+	"""
+	sys.path.insert(0, os.path.realpath(os.path.join(this_dir, os.pardir)))
+	module_name = os.path.splitext(params.get('demux_script'))[0]
+	return __import__(module_name)
+
+
+def run_daemon(params):
+	"""
+	Long-running alternative to the cron-driven main().  Starts processing of a flowcell directory within
+	seconds of the target file appearing, and keeps the processing code loaded in memory between runs.
+	"""
+	this_dir = os.path.dirname(os.path.abspath(__file__))
+	logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(asctime)s:%(levelname)s:%(message)s")
+
+	registry = open_registry(params, this_dir)
+	subscribers, comp_subscribers = get_subscribers(params)
+	rescan_interval = float(params.get('rescan_interval', 3600))
+
+	demux_module = load_demux_module(params, this_dir)
+	def launcher(d, params, this_dir, subscribers):
+		args = create_run_args(d, params, subscribers)
+		# the child must not inherit an open sqlite connection.  The registry reconnects on its next use.
+		registry.close()
+		return ForkedRun(demux_module, args)
+
+	on_start, on_success, on_failure = registry_callbacks(registry)
+	scheduler = RunScheduler(params, this_dir, subscribers, comp_subscribers, on_success, launcher, on_start, on_failure)
+
+	if pyinotify is not None:
+		watcher = InotifyWatcher(params)
+	else:
+		logging.info('pyinotify is not available.  Falling back to polling the instrument directories.')
+		watcher = PollingWatcher(params)
+
+	candidates = None
+	last_rescan = 0
+	while True:
+		if candidates is None or time.time() - last_rescan > rescan_interval:
+			# full check: at startup, when polling, and periodically as a safety net for missed events
+			discover_new_dirs(params, registry)
+			watcher.watch(registry.in_state(run_registry.DISCOVERED))
+			candidates = None
+			last_rescan = time.time()
+		else:
+			# directories reported by the watcher may not have been registered yet
+			for d in candidates:
+				if not registry.is_known(d):
+					try:
+						registry.add(d, os.path.dirname(d), os.stat(d).st_mtime)
+					except OSError as ex:
+						# e.g. removed again between the event and now
+						logging.warning('Could not register %s: %s' % (d, ex))
+
+		for d in claim_ready_dirs(params, registry, candidates):
+			scheduler.submit(d)
+		scheduler.step()
+		candidates = watcher.wait()
 
 		
 if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-d',
+				'--daemon',
+				action = 'store_true',
+				help = 'Run continuously, watching the instrument directories instead of doing a single scan (as called from cron)',
+				dest = 'daemon')
+	args = parser.parse_args()
+
 	config_params = parse_config()
-	main(config_params)
+	if args.daemon:
+		run_daemon(config_params)
+	else:
+		main(config_params)
@@ -0,0 +1,461 @@
+"""
+The demultiplexing backends which can sit behind Pipeline.run_demux.
+
+Each backend leaves its output in the demux output directory in the layout bcl2fastq produces:
+	<demux_output_dir>/<project>/<Sample_ID>/<sample>_S<n>_L00<lane>_R<read>_001.fastq.gz
+so that the remainder of the pipeline (concatenate_sample_fastq_files, etc.) does not depend on which backend ran.
+
+The backend is chosen with the demux_backend parameter in the [DEMUX] section of the config file.
+"""
+
+import os
+import sys
+import re
+import glob
+import json
+import gzip
+import shutil
+import logging
+import itertools
+import subprocess
+import multiprocessing
+import numpy as np
+
+import barcodes
+import run_info
+
+
+class DemuxBackend(object):
+	"""
+	Base class.  pipeline is the Pipeline instance, which gives the run directory, configuration parameters, etc.
+	"""
+	def __init__(self, pipeline):
+		self.pipeline = pipeline
+		self.params = pipeline.config_params_dict
+
+	def run(self):
+		raise NotImplementedError
+
+
+class Bcl2FastqBackend(DemuxBackend):
+	"""
+	Runs Illumina's bcl2fastq (demux_path) over the run folder, optionally split into concurrent shards
+	"""
+	def run(self):
+		num_shards = int(self.params.get('demux_shards', 1))
+		if num_shards > 1:
+			self.run_sharded(num_shards)
+		else:
+			call_command = self.params['demux_path'] + ' --output-dir ' + self.params['demux_output_dir'] + ' --runfolder-dir ' + self.pipeline.run_directory_path
+			self.pipeline.execute_call(call_command)
+
+	def run_sharded(self, num_shards):
+		"""
+		Splits the demux by lane (or, if more shards are requested than there are lanes, by lane and surface) using the
+		--tiles option of bcl2fastq.  The shards run concurrently, each into its own output directory, with the machine's
+		threads divided between them.  Once all have finished, the fastq files are merged into the usual layout
+		of the demux output directory, along with a combined Stats/Stats.json.
+		"""
+		run_directory_path = self.pipeline.run_directory_path
+		info = run_info.parse_run_info(run_directory_path)
+		tile_selections = plan_demux_shards(info, num_shards)
+
+		total_threads = int(self.params.get('demux_threads', 0)) or multiprocessing.cpu_count()
+		loading_threads, processing_threads, writing_threads = demux_thread_counts(len(tile_selections), total_threads)
+		logging.info('Splitting demux into %d shards (tiles: %s), each with %d loading, %d processing, and %d writing threads' % (len(tile_selections), tile_selections, loading_threads, processing_threads, writing_threads))
+
+		shard_root = os.path.join(self.params['demux_output_dir'], self.params.get('demux_shard_dir'))
+		if os.path.isdir(shard_root):
+			remove_previous_shards(shard_root, self.params['demux_output_dir'])
+		shards = []
+		for i, tiles in enumerate(tile_selections):
+			shard_dir = os.path.join(shard_root, 'shard_%d' % (i + 1))
+			os.makedirs(shard_dir)
+			call_command = self.params['demux_path'] + ' --output-dir ' + shard_dir + ' --runfolder-dir ' + run_directory_path
+			# each shard writes its own InterOp files, otherwise the concurrent processes would write to the same files in the run directory
+			call_command += ' --interop-dir ' + os.path.join(shard_dir, 'InterOp')
+			call_command += " --tiles '%s' -r %d -p %d -w %d" % (tiles, loading_threads, processing_threads, writing_threads)
+			logging.info('Starting demux shard with the following call to the shell:\n %s ' % call_command)
+			# the child has its own copy of the log's descriptor, so ours is closed straight away
+			with open(os.path.join(shard_dir, 'bcl2fastq.log'), 'w') as shard_log:
+				process = subprocess.Popen(call_command, shell = True, stdout = shard_log, stderr = subprocess.STDOUT)
+			shards.append((shard_dir, process))
+
+		failed_shards = []
+		for shard_dir, process in shards:
+			process.wait()
+			logging.info('Demux shard at %s finished with return code %s' % (shard_dir, process.returncode))
+			if process.returncode != 0:
+				failed_shards.append(shard_dir)
+		if len(failed_shards) > 0:
+			logging.error('The demux shard(s) at %s had non-zero exit status.  Check the bcl2fastq.log file in those directories.' % failed_shards)
+			sys.exit(1)
+
+		shard_dirs = [shard_dir for shard_dir, process in shards]
+		merge_demux_shards(shard_dirs, self.params['demux_output_dir'])
+		merge_demux_stats(shard_dirs, self.params['demux_output_dir'])
+
+
+class BclConvertBackend(DemuxBackend):
+	"""
+	Runs Illumina's bcl-convert (bcl_convert_path).  bcl-convert writes the fastq files for a project directly into
+	the project directory, so they are then moved into per-sample directories to match the bcl2fastq layout.
+	"""
+	def run(self):
+		call_command = self.params['bcl_convert_path'] + ' --bcl-input-directory ' + self.pipeline.run_directory_path
+		# the output directory was already created by the pipeline, so bcl-convert needs --force to write into it
+		call_command += ' --output-directory ' + self.params['demux_output_dir'] + ' --force'
+		self.pipeline.execute_call(call_command)
+		normalize_bcl_convert_output(self.params['demux_output_dir'])
+
+
+class UndeterminedRedemuxBackend(DemuxBackend):
+	"""
+	An in-process backend for fixing barcode errors in the SampleSheet.csv without going back to the BCL files.
+
+	Takes the output of a previous demux (redemux_source_dir, relative to the run directory), moves it into the
+	demux output directory, and re-assigns the reads in the Undetermined_*.fastq.gz files to the samples in the
+	(corrected) SampleSheet.csv.  Reads are matched on the index sequence(s) in their fastq header, allowing up to
+	redemux_max_mismatches mismatches, against the samples in the same lane.  Re-assigned reads are appended (as
+	additional gzip members) to the sample's lane-specific fastq files, and the reads which still do not match any
+	sample are left as undetermined.  Each lane is written to temporary files which replace the originals only once
+	the lane is complete, so running it again after an interruption does not duplicate any reads.
+	"""
+	def run(self):
+		source_dir = os.path.join(self.pipeline.run_directory_path, self.params['redemux_source_dir'])
+		output_dir = self.params['demux_output_dir']
+		if not os.path.isdir(source_dir):
+			logging.error('The directory with the previous demux output (%s) did not exist.' % source_dir)
+			sys.exit(1)
+		logging.info('Moving the previous demux output from %s to %s' % (source_dir, output_dir))
+		for entry in os.listdir(source_dir):
+			os.rename(os.path.join(source_dir, entry), os.path.join(output_dir, entry))
+
+		samples = self.get_samples()
+		max_mismatches = int(self.params.get('redemux_max_mismatches', 1))
+		batch_size = int(self.params.get('redemux_batch_size', 500000))
+		for r1 in sorted(glob.glob(os.path.join(output_dir, 'Undetermined_S0_L*_R1_001.fastq.gz'))):
+			lane = int(re.search(r'_L(\d{3})_', os.path.basename(r1)).group(1))
+			lane_samples = [s for s in samples if s['lane'] is None or s['lane'] == lane]
+			redemux_undetermined(r1, lane_samples, output_dir, max_mismatches, batch_size)
+
+	def get_samples(self):
+		"""
+		Returns a list of dictionaries, one per row of the samplesheet, with the project, sample ID/name, the
+		bcl2fastq sample number (S<n>), the lane (None if the row has no Lane, i.e. the sample is in every lane) and the
+		barcode (index + index2).  As with bcl2fastq, each Sample_ID is numbered once, in the order it first appears.
+		"""
+		samples = []
+		numbers = {}
+		for row in self.pipeline.samplesheet_rows:
+			number = numbers.setdefault(row['Sample_ID'], len(numbers) + 1)
+			samples.append({'project': row['Sample_Project'],
+					'sample_id': row['Sample_ID'],
+					'sample_name': row.get('Sample_Name') or row['Sample_ID'],
+					'number': number,
+					'lane': int(row['Lane']) if row.get('Lane') else None,
+					'barcode': row.get('index', '') + row.get('index2', '')})
+		return samples
+
+
+BACKENDS = {'bcl2fastq': Bcl2FastqBackend,
+		'bcl-convert': BclConvertBackend,
+		'undetermined': UndeterminedRedemuxBackend}
+
+
+def get_backend(name):
+	try:
+		return BACKENDS[name]
+	except KeyError:
+		logging.error('Unknown demux backend "%s".  Choose from: %s' % (name, ', '.join(sorted(BACKENDS.keys()))))
+		sys.exit(1)
+
+
+def plan_demux_shards(info, num_shards):
+	"""
+	Returns a list of bcl2fastq --tiles selections, one per shard.
+	If there are at least as many lanes as shards, lanes are dealt out to the shards (e.g. s_[13] selects lanes 1 and 3).
+	Otherwise the lanes are split by surface (e.g. s_1_1 selects the top surface of lane 1), and the lane surfaces are
+	dealt out to the shards (e.g. s_1_1,s_3_2).  There cannot be more shards than lane surfaces.
+	"""
+	lanes = range(1, info['lane_count'] + 1)
+	if num_shards <= len(lanes):
+		lane_groups = [lanes[i::num_shards] for i in range(num_shards)]
+		return ['s_[%s]' % ''.join(map(str, group)) for group in lane_groups]
+	units = ['s_%d_%d' % (lane, surface) for lane in lanes for surface in range(1, info['surface_count'] + 1)]
+	if num_shards > len(units):
+		logging.warning('%d demux shards were requested, but there are only %d lane surfaces, so %d shards are used' % (num_shards, len(units), len(units)))
+		num_shards = len(units)
+	return [','.join(units[i::num_shards]) for i in range(num_shards)]
+
+
+def demux_thread_counts(num_shards, total_threads):
+	"""
+	Divides the available threads among the concurrent bcl2fastq processes.  Returns a tuple of
+	(loading, processing, writing) threads for each shard, which together do not exceed the shard's share of the threads
+	(except that each shard needs at least one of each).  Loading and writing are I/O bound, so they get a smaller share
+	(bcl2fastq defaults to 4 of each for a single process)
+	"""
+	share = total_threads // num_shards
+	io_threads = max(1, min(4, share // 8))
+	processing_threads = max(1, share - 2 * io_threads)
+	return (io_threads, processing_threads, io_threads)
+
+
+def append_or_move(source, destination):
+	"""
+	Moves source to destination.  If destination already exists, source is appended to it instead (gzip files can be concatenated)
+	"""
+	destination_dir = os.path.dirname(destination)
+	if not os.path.isdir(destination_dir):
+		os.makedirs(destination_dir)
+	if os.path.isfile(destination):
+		logging.info('Appending %s to %s' % (source, destination))
+		with open(destination, 'ab') as fout:
+			with open(source, 'rb') as fin:
+				shutil.copyfileobj(fin, fout, 8*1024*1024)
+		os.remove(source)
+	else:
+		os.rename(source, destination)
+
+
+def merge_demux_shards(shard_dirs, output_dir):
+	"""
+	Moves the fastq files from each shard output directory into output_dir, keeping the relative layout (<project>/<sample>/<fastq>)
+	that bcl2fastq would have produced for an unsharded run.  When shards split a lane by surface, they produce files
+	with the same name, in which case the later shard's file is appended to the earlier one.
+	"""
+	for shard_dir in sorted(shard_dirs):
+		logging.info('Merging fastq files from demux shard %s into %s' % (shard_dir, output_dir))
+		for root, dirs, files in os.walk(shard_dir):
+			for f in files:
+				if f.endswith('.fastq.gz'):
+					source = os.path.join(root, f)
+					append_or_move(source, os.path.join(output_dir, os.path.relpath(source, shard_dir)))
+
+
+def remove_previous_shards(shard_root, output_dir):
+	"""
+	Removes the output of an earlier (failed or interrupted) sharded demux: the shard directories, and whatever had
+	already been merged into output_dir, so the fastq files are not appended to twice
+	"""
+	logging.info('Removing the output of a previous sharded demux in %s' % output_dir)
+	shutil.rmtree(shard_root)
+	for d in ['Stats', 'Reports']:
+		if os.path.isdir(os.path.join(output_dir, d)):
+			shutil.rmtree(os.path.join(output_dir, d))
+	for root, dirs, files in os.walk(output_dir):
+		for f in files:
+			if f.endswith('.fastq.gz'):
+				os.remove(os.path.join(root, f))
+
+
+# the fields which identify an entry in the lists of Stats.json (rather than being counts to add up)
+STATS_KEYS = ['LaneNumber', 'Lane', 'SampleId', 'ReadNumber', 'IndexSequence']
+
+
+def stats_key(item):
+	if isinstance(item, dict):
+		return tuple([(k, item[k]) for k in STATS_KEYS if k in item]) or None
+	return None
+
+
+def merge_stats_values(a, b):
+	"""
+	Adds up the counts in two parts of Stats.json from different shards.  Dictionaries are merged key by key, and
+	lists by their identifying fields (see STATS_KEYS).  Other values (names, etc.) are taken from a.
+	"""
+	if isinstance(a, dict) and isinstance(b, dict):
+		merged = dict(a)
+		for k, v in b.items():
+			if k not in merged:
+				merged[k] = v
+			elif k not in STATS_KEYS:
+				merged[k] = merge_stats_values(merged[k], v)
+		return merged
+	if isinstance(a, list) and isinstance(b, list):
+		return merge_stats_lists(a, b)
+	if isinstance(a, (int, long, float)) and isinstance(b, (int, long, float)) and not isinstance(a, bool):
+		return a + b
+	return a
+
+
+def merge_stats_lists(a, b):
+	merged = list(a)
+	for item in b:
+		key = stats_key(item)
+		matches = [i for i, x in enumerate(merged) if key is not None and stats_key(x) == key]
+		if matches:
+			merged[matches[0]] = merge_stats_values(merged[matches[0]], item)
+		else:
+			merged.append(item)
+	return merged
+
+
+def merge_demux_stats(shard_dirs, output_dir):
+	"""
+	Writes a Stats/Stats.json into output_dir which combines those of the shards, as bcl2fastq would have written it
+	for an unsharded run.  The rest of each shard's Stats and Reports directories are kept under
+	output_dir/Stats/<shard> and output_dir/Reports/<shard>.
+	"""
+	combined = None
+	for shard_dir in sorted(shard_dirs):
+		stats_path = os.path.join(shard_dir, 'Stats', 'Stats.json')
+		if not os.path.isfile(stats_path):
+			logging.warning('No demux statistics found at %s' % stats_path)
+			continue
+		stats = json.load(open(stats_path))
+		if combined is None:
+			combined = stats
+			continue
+		# the read structure of a lane is the same in every shard which has (a part of) it
+		lanes = set([r['LaneNumber'] for r in combined.get('ReadInfosForLanes', [])])
+		combined['ReadInfosForLanes'] = combined.get('ReadInfosForLanes', []) + [r for r in stats.get('ReadInfosForLanes', []) if r['LaneNumber'] not in lanes]
+		for k in ['ConversionResults', 'UnknownBarcodes']:
+			combined[k] = merge_stats_lists(combined.get(k, []), stats.get(k, []))
+
+	for shard_dir in sorted(shard_dirs):
+		for d in ['Stats', 'Reports']:
+			if os.path.isdir(os.path.join(shard_dir, d)):
+				destination = os.path.join(output_dir, d, os.path.basename(shard_dir))
+				if not os.path.isdir(os.path.dirname(destination)):
+					os.makedirs(os.path.dirname(destination))
+				os.rename(os.path.join(shard_dir, d), destination)
+	if combined is not None:
+		combined['ConversionResults'] = sorted(combined.get('ConversionResults', []), key = lambda r: r['LaneNumber'])
+		with open(os.path.join(output_dir, 'Stats', 'Stats.json'), 'w') as fout:
+			json.dump(combined, fout, indent = 2)
+
+
+def normalize_bcl_convert_output(output_dir):
+	"""
+	bcl-convert writes <project>/<Sample_ID>_S<n>_L00<lane>_R<read>_001.fastq.gz.  Move each of those files into a
+	<project>/<Sample_ID>/ directory, as bcl2fastq does.
+	"""
+	pattern = re.compile(r'(.*)_S\d+_L\d{3}_[RI]\d_001\.fastq\.gz$')
+	for project in os.listdir(output_dir):
+		project_dir = os.path.join(output_dir, project)
+		if not os.path.isdir(project_dir):
+			continue
+		for f in os.listdir(project_dir):
+			m = pattern.match(f)
+			if m:
+				append_or_move(os.path.join(project_dir, f), os.path.join(project_dir, m.group(1), f))
+
+
+def read_records(handle, n):
+	"""
+	Reads up to n fastq records from an open file handle.  Returns the list of lines (4 per record)
+	"""
+	return list(itertools.islice(handle, 4*n))
+
+
+def join_records(lines):
+	"""
+	Joins the lines (4 per record) into a numpy object array of full records
+	"""
+	records = np.empty(len(lines) // 4, dtype=object)
+	records[:] = map(''.join, zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4]))
+	return records
+
+
+def finish_redemux_commit(commit_file):
+	"""
+	Moves the temporary files listed in a lane's commit file over the originals, and removes the commit file.
+	Files which were already moved (before an interruption) are skipped.
+	"""
+	for tmp, final in json.load(open(commit_file)):
+		if os.path.isfile(tmp):
+			os.rename(tmp, final)
+	os.remove(commit_file)
+
+
+def redemux_undetermined(r1_path, samples, output_dir, max_mismatches, batch_size):
+	"""
+	Re-assigns the reads in one lane's Undetermined fastq files (R1 and, if present, R2) to the samples.
+
+	The new version of each file (the sample's existing reads followed by the re-assigned ones, and the reads which
+	remain undetermined) is written to a temporary file.  Once the lane is done, a commit file listing them is written
+	and they are moved over the originals.  If a commit file is found, the earlier run was interrupted while moving
+	the files, so that is finished instead.  Otherwise the originals are untouched, and any temporary files are
+	written again from the start.
+	"""
+	lane = re.search(r'_L(\d{3})_', os.path.basename(r1_path)).group(1)
+	commit_file = r1_path + '.redemux.commit'
+	if os.path.isfile(commit_file):
+		logging.info('Finishing the interrupted re-assignment of the undetermined reads in lane %s' % lane)
+		finish_redemux_commit(commit_file)
+		return np.zeros(len(samples) + 1, dtype=np.int64)
+
+	read_paths = [r1_path]
+	r2_path = r1_path.replace('_R1_001.fastq.gz', '_R2_001.fastq.gz')
+	if os.path.isfile(r2_path):
+		read_paths.append(r2_path)
+	logging.info('Re-assigning undetermined reads in %s' % read_paths)
+	for root, dirs, files in os.walk(output_dir):
+		for f in files:
+			if f.endswith('.redemux.tmp') and '_L%s_' % lane in f:
+				os.remove(os.path.join(root, f))
+
+	sample_codes = barcodes.encode([s['barcode'] for s in samples])
+	barcode_length = sample_codes.shape[1]
+	readers = [gzip.open(p, 'rb') for p in read_paths]
+	leftover_paths = [p + '.redemux.tmp' for p in read_paths]
+	leftover_writers = [gzip.GzipFile(p, 'wb', compresslevel=4) for p in leftover_paths]
+	sample_writers = {}
+	sample_files = {}
+	counts = np.zeros(len(samples) + 1, dtype=np.int64)
+
+	def get_writer(sample_index, read_index):
+		key = (sample_index, read_index)
+		if not key in sample_writers:
+			s = samples[sample_index]
+			sample_dir = os.path.join(output_dir, s['project'], s['sample_id'])
+			if not os.path.isdir(sample_dir):
+				os.makedirs(sample_dir)
+			fq = os.path.join(sample_dir, '%s_S%d_L%s_R%d_001.fastq.gz' % (s['sample_name'], s['number'], lane, read_index + 1))
+			# the re-assigned reads are added (as a new gzip member) after a copy of any reads the sample already had
+			raw = open(fq + '.redemux.tmp', 'wb')
+			if os.path.isfile(fq):
+				with open(fq, 'rb') as fin:
+					shutil.copyfileobj(fin, raw, 8*1024*1024)
+			sample_files[key] = (raw, fq)
+			sample_writers[key] = gzip.GzipFile(fq, 'wb', 4, raw)
+		return sample_writers[key]
+
+	while True:
+		batches = [read_records(r, batch_size) for r in readers]
+		if len(batches[0]) == 0:
+			break
+		headers = batches[0][0::4]
+		codes = barcodes.encode([barcodes.header_barcode(h) for h in headers], barcode_length)
+		assignment = barcodes.assign(codes, sample_codes, max_mismatches)
+		counts += np.bincount(assignment + 1, minlength=len(samples) + 1)
+
+		# group the reads by their assigned sample, so each sample's reads are written with a single call
+		order = np.argsort(assignment, kind='mergesort')
+		sorted_assignment = assignment[order]
+		group_values, group_starts = np.unique(sorted_assignment, return_index=True)
+		group_ends = np.append(group_starts[1:], len(order))
+		for read_index, lines in enumerate(batches):
+			records = join_records(lines)[order]
+			for value, start, end in zip(group_values, group_starts, group_ends):
+				if value < 0:
+					writer = leftover_writers[read_index]
+				else:
+					writer = get_writer(value, read_index)
+				writer.write(''.join(records[start:end]))
+
+	for handle in readers + leftover_writers + sample_writers.values() + [raw for raw, fq in sample_files.values()]:
+		handle.close()
+	moves = [(fq + '.redemux.tmp', fq) for raw, fq in sample_files.values()] + zip(leftover_paths, read_paths)
+	with open(commit_file + '.tmp', 'w') as fout:
+		json.dump(moves, fout)
+	os.rename(commit_file + '.tmp', commit_file)
+	finish_redemux_commit(commit_file)
+
+	logging.info('Lane %s: %d reads remained undetermined' % (lane, counts[0]))
+	for s, c in zip(samples, counts[1:]):
+		if c > 0:
+			logging.info('Lane %s: re-assigned %d reads to sample %s (%s)' % (lane, c, s['sample_id'], s['barcode']))
+	return counts
@@ -4,7 +4,6 @@ import os
 import json
 import libcloud
 from libcloud.storage.types import Provider, ContainerDoesNotExistError
-from libcloud.storage.drivers.google_storage import ObjectPermissions
 from libcloud.utils.py3 import urlquote
 import re
 import glob
@@ -15,11 +14,18 @@ import urllib
 import base64
 from Crypto.Cipher import DES
 import utils
+import checksums
+import cloud_uploader
+import bucket_access
 
 class InvalidBucketName(Exception):
 	pass
 
 
+class UploadVerificationException(Exception):
+	pass
+
+
 class MockObject(object):
 	"""
 	When I initially wrote this module, I had Apache libcloud doing the uploads.  The uploads kept failing, so we decided to 
@@ -29,9 +35,12 @@ class MockObject(object):
 
 	To avoid rewriting those working functions, simply make a wrapper object which has the 'name' attribute
 	For each file uploaded via gsutil, create an instance of this class, giving it the proper name.
+	md5 is the (hex) MD5 of the file, and size its size in bytes, if known
 	"""
-	def __init__(self, name):
+	def __init__(self, name, md5 = None, size = None):
 		self.name = name
+		self.md5 = md5
+		self.size = size
 
 
 def read_credentials(credential_file):
@@ -89,30 +98,24 @@ def prep_fastqc_files(fqd, destination_bucket, params):
 
 def get_or_create_bucket(ilab_id, driver, users, params):
 	"""
-	Grabs or creates bucket for this project.
-	Adds READ permissions for the emails passed in users list.
+	Grabs or creates bucket for this project.  Returns the container, and whether it was just created.
+	Access for the emails passed in users list is granted once the files are uploaded (see give_permissions)
 	"""
 	destination_bucket_name = '%s-%s' % (params['master_bucket'], ilab_id)
 	logging.info('upload to bucket: %s' % destination_bucket_name)
 	if is_valid_bucket_name(destination_bucket_name):
 		# check for existing bucket:
+		created = False
 		try:
 			c = driver.get_container(destination_bucket_name)
 		except ContainerDoesNotExistError:
 			# container did not exist.  Make it.
 			c = driver.create_container(destination_bucket_name)
+			created = True
 
-		# add or update permissions
-		for user in users:
-			if user in params['cccb_emails']:
-				gsutil_chmod(user, c.name)
-			else:
-				driver.ex_set_permissions(c.name, 
-					entity="user-%s" % user, 
-					role=ObjectPermissions.READER)
 		# TODO: unless something strange happened, we have a container now.  Maybe double-check?
 		logging.info('final container: %s' % c.name)
-		return c 		
+		return c, created
 	else:
 		raise InvalidBucketName('Bucket name (%s) did not pass all requirements' % destination_bucket_name)
 
@@ -147,10 +150,10 @@ def collect_files(project_dir, filetype, params):
 	return glob.glob(os.path.join(project_dir, '%s*' % params['sample_dir_prefix'],'*%s' % filetype)) # project_dir is the path on OUR local filesystem
 	
 
-def upload_fastq_dir(upload_items, project_dir, container, root_location, params):
+def upload_fastq_dir(upload_items, project_dir, container, root_location, params, upload_manifest = None):
 	"""
-	Since the fastq files are large, we required another way to upload them reliably.  The quick solution was to
-	symlink the 'final' fastq files from a single location and use gsutil's rsync functionality to send them up
+	Since the fastq files are large, we required another way to upload them reliably.  The 'final' fastq files are 
+	symlinked from a single location (with the md5sum file), and sent up with gsutil
 
 	upload_items is a list of filepaths to the fastq files.
 	container is a Apache libcloud Container instance
@@ -161,6 +164,9 @@ def upload_fastq_dir(upload_items, project_dir, container, root_location, params
 
 	Note that we change the name of the fastq in the symlink directory- this way the file names that users
 	will download are a little more "standard", rather than having <sample>_R1_.final.fastq.gz
+
+	Each file is sent with its own gsutil cp (with the metadata of fastq_metadata), so that if upload_manifest (a 
+	cloud_uploader.UploadManifest) is given, only the files which changed since they were last uploaded are sent.
 	"""
 	original_suffix = '_.final.fastq.gz'
 	new_suffix = '.fastq.gz'
@@ -177,6 +183,16 @@ def upload_fastq_dir(upload_items, project_dir, container, root_location, params
 			logging.error('Exception thrown when making symlinked fastq directory: %s' % ex.message)
 			raise ex
 
+	# the checksums computed during concatenation (if any).  These are written to an md5sum file which is uploaded
+	# with the fastq files, and used to verify the upload, so gsutil does not need to re-read the files to hash them
+	manifest = None
+	if int(params.get('compute_checksums', 0)):
+		manifest = checksums.ChecksumManifest(project_dir, params['checksum_manifest'])
+		name_map = dict([(item, os.path.basename(item)[:-len(original_suffix)] + new_suffix) for item in upload_items])
+		missing = manifest.write_md5sum_file(name_map, os.path.join(final_symlinked_directory, params['md5sum_file']))
+		if len(missing) > 0:
+			logging.warning('No checksums were found for %s, so the upload of those will not be verified against them' % missing)
+
 	for item in upload_items:
 		try:
 			basename = os.path.basename(item) # e.g. <sample>_R?_.final.fastq.gz
@@ -190,39 +206,315 @@ def upload_fastq_dir(upload_items, project_dir, container, root_location, params
 				logging.error('Exception thrown when linking fastq file: %s' % ex.message)
 				raise ex
 		
-	# now upload using gsutil rsync
-	rsync_cmd = 'gsutil rsync -r %s gs://%s/%s' % (final_symlinked_directory, container.name, root_location)
-	logging.info('Issue system command for uploading fastq files: %s' % rsync_cmd)
-	process = subprocess.Popen(rsync_cmd, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+	object_names = dict([(item, os.path.join(root_location, os.path.basename(item)[:-len(original_suffix)] + new_suffix)) for item in upload_items])
+	md5s = fastq_md5s(upload_items, manifest)
+	changed = upload_items
+	if upload_manifest is not None:
+		changed = [item for item in upload_items if not upload_manifest.unchanged(item, object_names[item], md5s.get(item))]
+
+	remote = {}
+	if len(changed) == 0:
+		logging.info('None of the fastq files has changed since the last upload to gs://%s, so they are not sent again' % container.name)
+	else:
+		# now upload each changed file with gsutil cp, which sets its metadata (see fastq_metadata) with the upload, so 
+		# no second request per object is needed
+		options = ''
+		if manifest and len(missing) == 0:
+			# we verify against our own checksums below, so gsutil does not need to read each file again to hash it
+			options = '-o GSUtil:check_hashes=never '
+		if manifest:
+			md5sum_path = os.path.join(final_symlinked_directory, params['md5sum_file'])
+			run_gsutil('gsutil %scp %s gs://%s/%s' % (options, md5sum_path, container.name, os.path.join(root_location, params['md5sum_file'])), 'uploading the md5sum file')
+		for item in changed:
+			metadata = fastq_metadata(item, manifest.get(item) if manifest else None, params)
+			link = os.path.join(final_symlinked_directory, os.path.basename(object_names[item]))
+			cp_cmd = 'gsutil %s%s cp %s gs://%s/%s' % (options, gsutil_headers(metadata), link, container.name, object_names[item])
+			run_gsutil(cp_cmd, 'uploading fastq files')
+		if manifest:
+			remote = verify_upload(upload_items, manifest, container, root_location, original_suffix, new_suffix)
+
+	# now put the attributes of the files into a mock object which keeps me from having to refactor code elsewhere.  Previously we had 
+	# objects created by libcloud or other libraries which had various useful attributes.  We mock that functionality here with a dummy class	
+	uploaded_objects = []
+	if manifest:
+		md5sum_path = os.path.join(final_symlinked_directory, params['md5sum_file'])
+		uploaded_objects.append(MockObject(os.path.join(root_location, params['md5sum_file']), size = os.path.getsize(md5sum_path)))
+	for item in upload_items:
+		object_name = object_names[item]
+		entry = manifest.get(item) if manifest else None
+		uploaded_objects.append(MockObject(object_name, entry['md5'] if entry else None, os.path.getsize(item)))
+		if item in changed:
+			if upload_manifest is not None:
+				info = dict(remote.get('gs://%s/%s' % (container.name, object_name), {}))
+				info.update({'name': object_name, 'size': os.path.getsize(item)})
+				upload_manifest.record(item, info, md5s.get(item))
+	return uploaded_objects
+
+
+def run_gsutil(cmd, description):
+	"""
+	Runs a gsutil command, logging its output.  Raises an exception if it fails.
+	"""
+	logging.info('Issue system command for %s: %s' % (description, cmd))
+	process = subprocess.Popen(cmd, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
 	stdout, stderr = process.communicate()
-	logging.info('STDOUT from gsutil fastq upload: ')
+	logging.info('STDOUT from gsutil (%s): ' % description)
 	logging.info(stdout)
-	logging.info('STDERR from gsutil fastq upload: ')
-	logging.info(stderr)
 	if process.returncode != 0:
-		logging.error('There was an error while uploading with gsutil.  Check the logs.')
+		logging.error('There was an error while %s with gsutil.  Check the logs.' % description)
 		raise Exception('Error during gsutil upload module.')
-	else:
-		# now put the attributes of the files into a mock object which keeps me from having to refactor code elsewhere.  Previously we had 
-		# objects created by libcloud or other libraries which had various useful attributes.  We mock that functionality here with a dummy class	
-		uploaded_objects = []
+	return stdout
+
+
+def gsutil_headers(metadata):
+	"""
+	Returns the gsutil -h options which set the metadata (as given by fastq_metadata) of an object as it is uploaded
+	"""
+	headers = ['-h "Content-Disposition:%s"' % metadata['contentDisposition']]
+	for key, value in sorted(metadata.get('metadata', {}).items()):
+		headers.append('-h "x-goog-meta-%s:%s"' % (key, value))
+	return ' '.join(headers)
+
+
+def fastq_md5s(upload_items, manifest):
+	"""
+	Returns a dict of each fastq file to its (base64) md5, from the checksum manifest (if there is one)
+	"""
+	md5s = {}
+	if manifest:
 		for item in upload_items:
-			basename = os.path.basename(item)
-			edited_name = basename[:-len(original_suffix)] + new_suffix
-			object_name = os.path.join(root_location, edited_name)
-			uploaded_objects.append(MockObject(object_name))
-
-			# set some metadata so the download does NOT prepend junk onto the file name
-			set_meta_cmd = 'gsutil setmeta -h "Content-Disposition: attachment; filename=%s" gs://%s/%s' % (basename, container.name, object_name)
-			logging.info('Issue system command for setting metadata on fastq file: %s' % set_meta_cmd)
-			process = subprocess.Popen(set_meta_cmd, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-			stdout, stderr = process.communicate()
-			if process.returncode != 0:
-				logging.error('There was an error while setting the metadata on the fastq with gsutil.  Check the logs.  STDERR was:%s' % stderr)
-				raise Exception('Error during gsutil upload module.')
-	return uploaded_objects
+			entry = manifest.get(item)
+			if entry:
+				md5s[item] = checksums.md5_hex_to_base64(entry['md5'])
+	return md5s
+
+
+def local_md5(path):
+	"""
+	Returns the (base64) md5 of a (small) file
+	"""
+	return checksums.md5_hex_to_base64(checksums.file_checksums(path)['md5'])
+
+
+def get_upload_manifest(project_dir, container, new_bucket, params):
+	"""
+	Returns the record of the files uploaded from the project directory to the bucket (see cloud_uploader.UploadManifest).
+	The records are checked against one listing of the bucket, so objects which were removed or changed since (or all of
+	them, if the bucket was just created, e.g. after it was removed by the retention scanner) are sent again.
+	"""
+	path = os.path.join(project_dir, params.get('upload_manifest', 'upload_manifest.json'))
+	manifest = cloud_uploader.UploadManifest(path, container.name)
+	if new_bucket:
+		manifest.forget()
+	elif params.get('upload_engine', 'gsutil') == 'native':
+		manifest.check_remote([cloud_uploader.object_info(r) for r in get_uploader(container, project_dir, params).list_objects()])
+	else:
+		manifest.check_remote(gsutil_list_objects(container.name))
+	return manifest
+
+
+def gsutil_list_objects(bucket_name):
+	"""
+	Returns the objects in the bucket (in the form given by cloud_uploader.object_info), from one 'gsutil ls -L'
+	"""
+	ls_cmd = 'gsutil ls -L gs://%s/**' % bucket_name
+	logging.info('Issue system command for listing the bucket: %s' % ls_cmd)
+	process = subprocess.Popen(ls_cmd, shell = True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+	stdout, stderr = process.communicate()
+	if process.returncode != 0:
+		if 'matched no objects' in stderr:
+			return []
+		logging.error('Could not list gs://%s: %s' % (bucket_name, stderr))
+		raise Exception('Could not list gs://%s' % bucket_name)
+	prefix = 'gs://%s/' % bucket_name
+	objects = []
+	for url, info in parse_object_listing(stdout).items():
+		info = dict(info)
+		info['name'] = url[len(prefix):]
+		objects.append(info)
+	return objects
+
+
+def fastq_metadata(item, entry, params):
+	"""
+	Returns the metadata for the object of a final fastq file: the Content-Disposition (so the download does NOT 
+	prepend junk onto the file name), and custom metadata giving the sample, the number of flowcells merged into the 
+	file, and its checksums (entry is the file's entry in the checksum manifest, or None)
+	"""
+	sample_dir = os.path.basename(os.path.dirname(item))
+	prefix = params.get('sample_dir_prefix', '')
+	sample_name = sample_dir[len(prefix):] if sample_dir.startswith(prefix) else sample_dir
+	flowcell_base = item[:-len(params['final_fastq_tag'] + '.fastq.gz')] + params.get('flowcell_prefix', 'fc')
+	flowcells = len([f for f in glob.glob(flowcell_base + '[0-9]*.fastq.gz') if f[len(flowcell_base):-len('.fastq.gz')].isdigit()])
+	custom = {'sample': sample_name, 'flowcells': str(max(flowcells, 1))}
+	if entry:
+		custom['md5'] = entry['md5']
+		if 'crc32c' in entry:
+			custom['crc32c'] = entry['crc32c']
+	return {'contentDisposition': 'attachment; filename=%s' % os.path.basename(item), 'metadata': custom}
 	
 
+def upload_fastq_native(upload_items, project_dir, container, root_location, uploader, params, upload_manifest = None):
+	"""
+	Uploads the fastq files with the in-process uploader (see cloud_uploader.py), which reads them straight from their
+	paths, so no symlink directory is needed.  The object names are the same as with upload_fastq_dir, and the hashes
+	returned by the uploads are checked against the local checksums (no listing of the bucket is needed).  The metadata
+	(see fastq_metadata) is set by the request which creates each object.  Files which are unchanged since their last
+	upload (according to upload_manifest, if given) are not sent again.
+	"""
+	original_suffix = '_.final.fastq.gz'
+	new_suffix = '.fastq.gz'
+	name_map = dict([(item, os.path.basename(item)[:-len(original_suffix)] + new_suffix) for item in upload_items])
+
+	manifest = None
+	if int(params.get('compute_checksums', 0)):
+		manifest = checksums.ChecksumManifest(project_dir, params['checksum_manifest'])
+	jobs = [(item, os.path.join(root_location, name_map[item]), fastq_metadata(item, manifest.get(item) if manifest else None, params)) 
+			for item in upload_items]
+	if manifest:
+		md5sum_path = os.path.join(project_dir, params['md5sum_file'])
+		missing = manifest.write_md5sum_file(name_map, md5sum_path)
+		if len(missing) > 0:
+			logging.warning('No checksums were found for %s, so the upload of those will not be verified against them' % missing)
+		jobs.append((md5sum_path, os.path.join(root_location, params['md5sum_file'])))
+	md5s = fastq_md5s(upload_items, manifest)
+	if manifest:
+		md5s[md5sum_path] = local_md5(md5sum_path)
+
+	results = uploader.upload_all(jobs, upload_manifest, md5s)
+	sizes = dict([(r['name'], r['size']) for r in results])
+	if manifest:
+		remote = dict([('gs://%s/%s' % (container.name, r['name']), r) for r in results])
+		compare_checksums(upload_items, manifest, remote, container, root_location, original_suffix, new_suffix)
+
+	uploaded_objects = []
+	if manifest:
+		object_name = os.path.join(root_location, params['md5sum_file'])
+		uploaded_objects.append(MockObject(object_name, size = sizes.get(object_name)))
+	for item in upload_items:
+		object_name = os.path.join(root_location, name_map[item])
+		entry = manifest.get(item) if manifest else None
+		uploaded_objects.append(MockObject(object_name, entry['md5'] if entry else None, sizes.get(object_name)))
+	return uploaded_objects
+
+
+def upload_files_native(upload_items, root_location, uploader, upload_manifest = None):
+	"""
+	Uploads (small) files, not directories, with the in-process uploader, skipping those which are unchanged since their
+	last upload (according to upload_manifest, if given).  Returns MockObjects for them, like upload()
+	"""
+	md5s = dict([(item, local_md5(item)) for item in upload_items])
+	results = uploader.upload_all([(item, os.path.join(root_location, os.path.basename(item))) for item in upload_items], upload_manifest, md5s)
+	return [MockObject(r['name'], size = r['size']) for r in results]
+
+
+def upload_changed_files(upload_items, container, root_location, params, upload_manifest):
+	"""
+	Uploads (small) files, not directories, with upload(), skipping those which are unchanged since their last upload
+	(according to upload_manifest)
+	"""
+	uploaded_objects = []
+	for item in upload_items:
+		object_name = os.path.join(root_location, os.path.basename(item))
+		md5 = local_md5(item)
+		if upload_manifest.unchanged(item, object_name, md5):
+			logging.info('%s is unchanged since its last upload to gs://%s' % (item, container.name))
+			uploaded_objects.append(MockObject(object_name, size = upload_manifest.entry(object_name)['size']))
+		else:
+			uploaded_objects.extend(upload([item,], container, root_location, params))
+			upload_manifest.record(item, {'name': object_name, 'size': os.path.getsize(item)}, md5)
+	return uploaded_objects
+
+
+def get_uploader(container, project_dir, params):
+	"""
+	Returns an uploader (see cloud_uploader.py) for the bucket, configured by the upload_* parameters.  The progress of
+	the large uploads is kept in upload_state_dir (in the project directory, if given), so a later attempt can continue them.
+	"""
+	token = cloud_uploader.AccessToken(params.get('access_token_command', 'gcloud auth print-access-token'))
+	composite_threshold = int(params.get('upload_composite_threshold_mb', 2048)) * cloud_uploader.MEGABYTE
+	if int(params.get('compute_checksums', 0)) and not checksums.HAVE_CRC32C:
+		# a composed object has no md5, so without a local crc32c (which needs crcmod) it could not be verified
+		logging.info('crcmod is not installed, so large files are not uploaded as composite objects')
+		composite_threshold = sys.maxint
+	return cloud_uploader.Uploader(container.name, token, 
+					workers = int(params.get('upload_workers', 8)), 
+					chunk_size = int(params.get('upload_chunk_mb', 64)) * cloud_uploader.MEGABYTE,
+					composite_threshold = composite_threshold,
+					state_dir = os.path.join(project_dir, params.get('upload_state_dir', '.upload_state')) if project_dir else None)
+
+
+def parse_object_listing(listing):
+	"""
+	Parses the output of 'gsutil ls -L'.  Returns a dict mapping each object URL to a dict of its size, generation and
+	hashes (md5 and crc32c, both base64-encoded, as shown by gsutil).  Composite objects have no md5.
+	"""
+	objects = {}
+	current = None
+	for line in listing.splitlines():
+		if line.startswith('gs://') and line.rstrip().endswith(':'):
+			current = {}
+			objects[line.rstrip()[:-1]] = current
+		elif current is not None and ':' in line:
+			key, value = [x.strip() for x in line.split(':', 1)]
+			if key == 'Hash (md5)':
+				current['md5'] = value
+			elif key == 'Hash (crc32c)':
+				current['crc32c'] = value
+			elif key == 'Content-Length':
+				current['size'] = int(value)
+			elif key == 'Generation':
+				current['generation'] = value
+	return objects
+
+
+def verify_upload(upload_items, manifest, container, root_location, original_suffix, new_suffix):
+	"""
+	Compares the hashes google storage reports for the uploaded fastq files with the checksums computed locally.
+	Raises an UploadVerificationException if any do not match.  Returns the listing (see parse_object_listing)
+	"""
+	ls_cmd = 'gsutil ls -L gs://%s/%s/' % (container.name, root_location)
+	logging.info('Issue system command for listing the uploaded fastq files: %s' % ls_cmd)
+	process = subprocess.Popen(ls_cmd, shell = True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+	stdout, stderr = process.communicate()
+	if process.returncode != 0:
+		logging.error('Could not list the uploaded files: %s' % stderr)
+		raise UploadVerificationException('Could not list gs://%s/%s' % (container.name, root_location))
+	remote = parse_object_listing(stdout)
+	compare_checksums(upload_items, manifest, remote, container, root_location, original_suffix, new_suffix)
+	return remote
+
+
+def compare_checksums(upload_items, manifest, remote, container, root_location, original_suffix, new_suffix):
+	"""
+	remote maps each object URL to a dict of its size and (base64) hashes, as given by parse_object_listing.
+	Raises an UploadVerificationException if any do not match the local checksums.
+	"""
+	mismatches = []
+	for item in upload_items:
+		local = manifest.get(item)
+		if local is None:
+			continue
+		object_url = 'gs://%s/%s' % (container.name, os.path.join(root_location, os.path.basename(item)[:-len(original_suffix)] + new_suffix))
+		r = remote.get(object_url)
+		if r is None:
+			mismatches.append('%s was not found' % object_url)
+		elif 'crc32c' in local and 'crc32c' in r:
+			if local['crc32c'] != r['crc32c']:
+				mismatches.append('%s has crc32c %s, expected %s' % (object_url, r['crc32c'], local['crc32c']))
+		elif 'md5' in r:
+			if checksums.md5_hex_to_base64(local['md5']) != r['md5']:
+				mismatches.append('%s has md5 %s, expected %s' % (object_url, r['md5'], checksums.md5_hex_to_base64(local['md5'])))
+		else:
+			logging.warning('No comparable hash for %s (a composite object, and crcmod is not installed).  Checking the size only.' % object_url)
+			if r.get('size') != local['size']:
+				mismatches.append('%s has size %s, expected %s' % (object_url, r.get('size'), local['size']))
+	if len(mismatches) > 0:
+		logging.error('Upload verification failed:\n%s' % '\n'.join(mismatches))
+		raise UploadVerificationException('The uploaded fastq files did not match their local checksums')
+	logging.info('Verified the checksums of %d uploaded fastq files' % len(upload_items))
+
+
 def upload(upload_items, container, root_location, params):
 	"""
 	files is a list of paths on our local filesystem.  Can be actual files OR directories
@@ -291,41 +583,26 @@ def get_client_emails(project_dir, params):
 	logging.info('Will give permissions to the following emails: %s' % client_email_addresses)
 	return client_email_addresses
 
-def gsutil_chmod(user, container_name, object_name = ''):
-	"""
-	For whatever reason, libcloud will not let me assign OWNER permissions to the CCCB users so we have to fall back to gsutil
-	"""
-	chmod_cmd = 'gsutil acl ch -u %s:O gs://%s/%s' % (user, container_name, object_name)
-	logging.info('Issue system command for adding CCCB users as OWNERS: %s' % chmod_cmd)
-	process = subprocess.Popen(chmod_cmd, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-	stdout, stderr = process.communicate()
-	logging.info('STDOUT from gsutil chmod: ')
-	logging.info(stdout)
-	logging.info('STDERR from gsutil chmod: ')
-	logging.info(stderr)
-	if process.returncode != 0:
-	       	logging.error('There was an error while changing the ACL with gsutil.  Check the logs.')
-	    	raise Exception('Error during gsutil acl/chmod module.')
-
-
 def give_permissions(driver, container, object_list, users, params):
 	"""
-	Give reader permissions to the users.
+	Give reader permissions to the users (and OWNER-like permissions to the CCCB staff).
+	The access is granted on the bucket (see bucket_access.py), so it covers all of its objects, and the number of 
+	requests does not depend on object_list.  The policy is only written if some of the users do not have access yet.
+	With the gsutil engine, the bindings are added with gsutil, so no access token is needed.
 	driver is an instance of the storage driver
 	container is a container object instance
 	object_list is a list of Object instances
 	users is a list of strings (email addresses)
 	"""
-	for o in object_list:
-		logging.info('adjusting privileges for %s' % o.name)
-		for user in users:
-			if user in params['cccb_emails']:
-				logging.info('%s was a cccb user, so set with gsutil' % user)
-				gsutil_chmod(user, container.name, o.name)
-			else:
-				logging.info('%s was not a CCCB user so we will set privileges with libcloud' % user)
-				driver.ex_set_permissions(container.name, object_name = o.name, entity="user-%s" % user, role=ObjectPermissions.READER)
-				
+	if params.get('upload_engine', 'gsutil') == 'native':
+		access = bucket_access.BucketAccess(get_uploader(container, None, params))
+		access.grant(container.name, users, params['cccb_emails'])
+	else:
+		# 'gsutil iam ch' only adds the bindings which are missing, in a single read and write of the policy
+		grants = bucket_access.desired_grants(users, params['cccb_emails'])
+		bindings = ['%s:%s' % (member, role) for role, members in sorted(grants.items()) for member in members]
+		run_gsutil('gsutil iam ch %s gs://%s' % (' '.join(bindings), container.name), 'granting access to the bucket')
+
 
 def update_webapp_database(container, object_list, client_email_addresses, params):
 	"""
@@ -334,8 +611,11 @@ def update_webapp_database(container, object_list, client_email_addresses, param
 	upload_targets = ['fastq.gz', 'html', 'zip']
 	upload_list = []
 	for o in object_list:
-		if any([o.name[-len(suffix):]==suffix for suffix in upload_targets]):
+		if any([o.name[-len(suffix):]==suffix for suffix in upload_targets]) or os.path.basename(o.name) == params.get('md5sum_file'):
 			upload_dict = {'basename': o.name, 'bucket_name':container.name, 'owners':client_email_addresses}
+			# so the delivery page can show the checksum next to the file
+			if getattr(o, 'md5', None):
+				upload_dict['md5'] = o.md5
 			upload_list.append(upload_dict)
 	d = {}
 	d2 = {}
@@ -414,6 +694,18 @@ def calculate_upload_size(uploaded_objects, scale=1e9):
 	return total_size_in_bytes/float(scale)		
 
 
+def newest_mtime(directories):
+	"""
+	Returns the latest modification time of the directories and everything in them
+	"""
+	mtimes = [0]
+	for d in directories:
+		for r, dirs, files in os.walk(os.path.realpath(d)):
+			mtimes.append(os.path.getmtime(r))
+			mtimes.extend([os.path.getmtime(os.path.join(r, f)) for f in files])
+	return max(mtimes)
+
+
 def zip_fastqc_reports(fastQC_dirs, project_dir, params):
 	logging.info('Will zip up the fastQC reports:\n%s' % '\n'.join(fastQC_dirs))
 	base_cmd = 'zip -r %s %s'
@@ -424,6 +716,11 @@ def zip_fastqc_reports(fastQC_dirs, project_dir, params):
 	initial_cwd = os.getcwd()
 	os.chdir(project_dir)
 	final_zip = ilab_id + params['fastqc_zip_suffix']
+	if os.path.isfile(final_zip) and os.path.getmtime(final_zip) >= newest_mtime(fastQC_dirs):
+		# e.g. a retried upload- the reports have not changed since they were zipped
+		logging.info('The fastQC reports have not changed since %s was made, so it is not made again' % final_zip)
+		os.chdir(initial_cwd)
+		return os.path.join(project_dir, final_zip)
 	relative_locations = [os.path.relpath(os.path.realpath(x)) for x in fastQC_dirs] # need to run realpath inside RELpath to resolve any funny behavior due to /cccbstore-rc symlink vs /ifs/labs/cccb
 	zip_cmd = base_cmd % (final_zip, ' '.join(relative_locations))
 
@@ -462,7 +759,7 @@ def entry_method(project_dir, params):
 	ilab_id = os.path.basename(project_dir).replace('_', '-').lower()
 
 	driver = get_connection_driver(params)
-	bucket_obj = get_or_create_bucket(ilab_id, driver, client_email_addresses, params)
+	bucket_obj, new_bucket = get_or_create_bucket(ilab_id, driver, client_email_addresses, params)
 
 	#TODO: collect lane-specific fastq
 
@@ -478,11 +775,21 @@ def entry_method(project_dir, params):
 	#zip-up fastQC directories
 	zipfile = zip_fastqc_reports(fastQC_dirs, project_dir, params)
 
-	# do uploads
+	# do uploads.  With upload_engine = native, the files are uploaded in-process by a pool of threads (see cloud_uploader.py)
+	# Files which are unchanged since their last upload to the bucket (e.g. in a previous attempt, or for an earlier 
+	# flowcell of the project) and still in the bucket as they were uploaded are not sent again- see the upload manifest
+	upload_manifest = get_upload_manifest(project_dir, bucket_obj, new_bucket, params)
+	uploader = None
+	if params.get('upload_engine', 'gsutil') == 'native':
+		uploader = get_uploader(bucket_obj, project_dir, params)
 	uploaded_objects = []
-	uploaded_objects.extend(upload_fastq_dir(fastq_files, project_dir, bucket_obj, params['cloud_fastq_root'], params))
-	#uploaded_objects.extend(upload(fastq_files, bucket_obj, params['cloud_fastq_root'], params))
-	uploaded_objects.extend(upload([zipfile,], bucket_obj, params['cloud_fastqc_root'], params))
+	if uploader:
+		uploaded_objects.extend(upload_fastq_native(fastq_files, project_dir, bucket_obj, params['cloud_fastq_root'], uploader, params, upload_manifest))
+		uploaded_objects.extend(upload_files_native([zipfile,], params['cloud_fastqc_root'], uploader, upload_manifest))
+	else:
+		uploaded_objects.extend(upload_fastq_dir(fastq_files, project_dir, bucket_obj, params['cloud_fastq_root'], params, upload_manifest))
+		#uploaded_objects.extend(upload(fastq_files, bucket_obj, params['cloud_fastq_root'], params))
+		uploaded_objects.extend(upload_changed_files([zipfile,], bucket_obj, params['cloud_fastqc_root'], params, upload_manifest))
 
 	# give permissions:
 	give_permissions(driver, bucket_obj, uploaded_objects, client_email_addresses, params)
@@ -490,13 +797,19 @@ def entry_method(project_dir, params):
 	# let the webapp know about the uploads:
 	update_webapp_database(bucket_obj, uploaded_objects, client_email_addresses, params)
 
-	# get the total upload size
-	# commented out since using rsync
-	#upload_size = calculate_upload_size(uploaded_objects)
-	#logging.info('upload size in GB: %s' % upload_size)
+	# get the total upload size.  The sizes not given by the uploads come from the upload manifest
+	for o in uploaded_objects:
+		if getattr(o, 'size', None) is None:
+			entry = upload_manifest.entry(o.name)
+			o.size = entry['size'] if entry else 0
+	upload_size = calculate_upload_size(uploaded_objects)
+	logging.info('upload size in GB: %s' % upload_size)
 
 	# upload the metadata file:
-	upload([os.path.join(project_dir, params['project_descriptor']),], bucket_obj, '', params)	
+	if uploader:
+		upload_files_native([os.path.join(project_dir, params['project_descriptor']),], '', uploader, upload_manifest)
+	else:
+		upload_changed_files([os.path.join(project_dir, params['project_descriptor']),], bucket_obj, '', params, upload_manifest)
 
 	# handle master metadata file
 	update_project_mappings(driver, bucket_obj, client_email_addresses, params)
@@ -0,0 +1,307 @@
+"""
+Concatenation of (gzipped) fastq files without going through the shell.
+
+The data is copied in the kernel where possible (copy_file_range, then sendfile), so it never passes through
+Python.  Those are reached through os if the interpreter has them, or through libc with ctypes otherwise.  If neither
+is available (or the filesystem does not support them), the files are copied with large buffered reads and writes.
+Source files are opened with a sequential-read hint, so the kernel reads ahead aggressively.
+
+If observers are given (objects with an update(data) method, e.g. checksums.Checksummer or read_stats.ReadStatsObserver,
+which are on in the default configuration), the data is still copied by the kernel, and each chunk is read back through
+a second descriptor of the source right after it is copied, for the observers.  So the reads pass through Python (once,
+while the pages are still cached where the kernel copy went through the page cache), but the writes do not, and no
+separate read pass over the file is needed afterwards.  With the buffered fallback, the observers see the data as it is
+copied.
+
+Appends to an existing file can be made crash-safe with append_with_journal: the original length of the file is
+recorded in a journal file first, so an interrupted append can be rolled back (see rollback_append).  A merge of a new
+file into an existing one is recorded as pending (see start_merge) until it is done, so an attempt which was interrupted
+at any point of it can be resumed without renaming or appending the new file twice.
+"""
+
+import os
+import json
+import time
+import errno
+import ctypes
+import ctypes.util
+import logging
+from multiprocessing.pool import ThreadPool
+
+import permissions
+
+# the size of each copy request (and the buffer size for the fallback copy)
+CHUNK_SIZE = 16*1024*1024
+
+POSIX_FADV_SEQUENTIAL = 2
+
+# errors which mean the kernel copy is not supported for these files, rather than a real I/O problem
+UNSUPPORTED_ERRORS = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF])
+
+try:
+	libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+except OSError:
+	libc = None
+
+
+def _libc_function(name, restype, argtypes):
+	f = getattr(libc, name, None) if libc is not None else None
+	if f is not None:
+		f.restype = restype
+		f.argtypes = argtypes
+	return f
+
+_libc_copy_file_range = _libc_function('copy_file_range', ctypes.c_ssize_t, [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+_libc_sendfile = _libc_function('sendfile', ctypes.c_ssize_t, [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+_libc_posix_fadvise = _libc_function('posix_fadvise', ctypes.c_int, [ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int])
+
+
+def _check(result):
+	if result < 0:
+		e = ctypes.get_errno()
+		raise OSError(e, os.strerror(e))
+	return result
+
+
+def copy_file_range(fd_in, fd_out, count):
+	if hasattr(os, 'copy_file_range'):
+		return os.copy_file_range(fd_in, fd_out, count)
+	if _libc_copy_file_range is None:
+		raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+	# NULL offsets: use (and advance) the file offsets of both descriptors
+	return _check(_libc_copy_file_range(fd_in, None, fd_out, None, count, 0))
+
+
+def sendfile(fd_in, fd_out, count):
+	if hasattr(os, 'sendfile'):
+		return os.sendfile(fd_out, fd_in, None, count)
+	if _libc_sendfile is None:
+		raise OSError(errno.ENOSYS, 'sendfile is not available')
+	return _check(_libc_sendfile(fd_out, fd_in, None, count))
+
+
+def buffered_copy(fd_in, fd_out, count):
+	data = os.read(fd_in, min(count, CHUNK_SIZE))
+	written = 0
+	while written < len(data):
+		written += os.write(fd_out, data[written:])
+	return len(data)
+
+
+def advise_sequential(fd):
+	try:
+		if hasattr(os, 'posix_fadvise'):
+			os.posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+		elif _libc_posix_fadvise is not None:
+			_libc_posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+	except OSError:
+		# only a hint
+		pass
+
+
+# the copy methods, in order of preference
+COPY_METHODS = [copy_file_range, sendfile, buffered_copy]
+
+
+def observed_copy_methods(observers, fd_observe):
+	"""
+	Returns the copy methods (see COPY_METHODS), which also pass the data they copy to the observers.  The kernel copies
+	are followed by a read of the same bytes through fd_observe (another descriptor of the source, at the same offset);
+	the buffered copy passes on the data it reads.
+	"""
+	def observed(method):
+		def copy(fd_in, fd_out, count):
+			n = method(fd_in, fd_out, count)
+			remaining = n
+			while remaining > 0:
+				data = os.read(fd_observe, remaining)
+				if not data:
+					raise IOError('Unexpected end of file (%d copied bytes could not be read back)' % remaining)
+				for o in observers:
+					o.update(data)
+				remaining -= len(data)
+			return n
+		copy.__name__ = method.__name__
+		return copy
+
+	def buffered_copy_with_observers(fd_in, fd_out, count):
+		data = os.read(fd_in, min(count, CHUNK_SIZE))
+		for o in observers:
+			o.update(data)
+		written = 0
+		while written < len(data):
+			written += os.write(fd_out, data[written:])
+		return len(data)
+	return [observed(copy_file_range), observed(sendfile), buffered_copy_with_observers]
+
+
+def copy_fd(fd_in, fd_out, size, methods = None):
+	"""
+	Copies size bytes from the current offset of fd_in to the current offset of fd_out.  Each method is tried in
+	turn; if one is not supported, the next one carries on from where it stopped.  Returns the name of the last method used.
+	"""
+	methods = methods or COPY_METHODS
+	remaining = size
+	for method in methods:
+		try:
+			while remaining > 0:
+				n = method(fd_in, fd_out, min(remaining, CHUNK_SIZE))
+				if n == 0:
+					raise IOError('Unexpected end of file (%d bytes were not copied)' % remaining)
+				remaining -= n
+			return method.__name__
+		except OSError as ex:
+			if ex.errno in UNSUPPORTED_ERRORS and method is not methods[-1]:
+				logging.debug('%s not supported (%s), falling back' % (method.__name__, ex))
+				continue
+			raise
+	return None
+
+
+def concatenate(sources, destination, append = False, sync = False, observers = None, mode = None):
+	"""
+	Concatenates the source files into destination (or appends them, if append is True).
+	If sync is True, the destination is flushed to disk before returning.
+	observers is an optional list of objects whose update(data) method is called with the data as it is written (the
+	kernel copy is still used, and the data is read back for them- see the module docstring).
+	If mode is given, the destination is given that mode when it is opened (so no chmod is needed afterwards).
+	Returns the number of bytes written.
+	"""
+	flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append else os.O_TRUNC)
+	if mode is None:
+		fd_out = os.open(destination, flags, 0666)
+	else:
+		fd_out = permissions.open_with_mode(destination, flags, mode)
+	total = 0
+	try:
+		for source in sources:
+			fd_in = os.open(source, os.O_RDONLY)
+			fd_observe = None
+			try:
+				advise_sequential(fd_in)
+				methods = None
+				if observers:
+					fd_observe = os.open(source, os.O_RDONLY)
+					advise_sequential(fd_observe)
+					methods = observed_copy_methods(observers, fd_observe)
+				size = os.fstat(fd_in).st_size
+				start = time.time()
+				method = copy_fd(fd_in, fd_out, size, methods)
+				elapsed = max(time.time() - start, 1e-6)
+				logging.info('Copied %s to %s: %d bytes in %.2fs (%.1f MB/s, %s)' % (source, destination, size, elapsed, size/elapsed/1e6, method))
+				total += size
+			finally:
+				os.close(fd_in)
+				if fd_observe is not None:
+					os.close(fd_observe)
+		if sync:
+			os.fsync(fd_out)
+	finally:
+		os.close(fd_out)
+	return total
+
+
+def journal_path(destination):
+	return destination + '.merge_journal'
+
+
+def pending_merge_path(destination):
+	return destination + '.pending_merge'
+
+
+def write_record(path, record):
+	"""
+	Writes the record (as JSON) to path, so that it is either complete or absent, even if the process dies
+	"""
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as fout:
+		json.dump(record, fout)
+		fout.flush()
+		os.fsync(fout.fileno())
+	os.rename(tmp, path)
+
+
+def start_merge(source, destination):
+	"""
+	Records that source (a new file, about to be renamed to this name) is being merged into destination, before anything
+	is renamed or written.  The record keeps the length of destination (None if it is a link, which the merge replaces
+	with a real file), so an attempt which resumes the merge can tell whether it had finished.  Returns the record.
+	"""
+	record = {'source': source, 'length': None if os.path.islink(destination) else os.path.getsize(destination)}
+	write_record(pending_merge_path(destination), record)
+	return record
+
+
+def pending_merge(destination):
+	"""
+	Returns the record of an unfinished merge into destination (see start_merge), or None
+	"""
+	path = pending_merge_path(destination)
+	if os.path.isfile(path):
+		return json.load(open(path))
+	return None
+
+
+def merge_complete(destination, record):
+	"""
+	Returns True if the merge of the record (see start_merge) was complete.  A partial append must be rolled back first.
+	"""
+	if record['length'] is None:
+		return not os.path.islink(destination)
+	return os.path.getsize(destination) == record['length'] + os.path.getsize(record['source'])
+
+
+def finish_merge(destination):
+	os.remove(pending_merge_path(destination))
+
+
+def append_with_journal(sources, destination):
+	"""
+	Appends the source files to destination, writing only the new bytes.  Before anything is appended, the current length
+	of destination (and the sources) are recorded in a journal file.  If the append fails, destination is truncated back
+	to that length.  If the process dies part-way, the journal is left behind and rollback_append undoes the partial append.
+	"""
+	journal = journal_path(destination)
+	write_record(journal, {'length': os.path.getsize(destination), 'sources': sources})
+	try:
+		concatenate(sources, destination, append = True, sync = True)
+	except:
+		rollback_append(destination)
+		raise
+	os.remove(journal)
+
+
+def rollback_append(destination):
+	"""
+	If there is a journal from an interrupted append to destination, truncates destination to its length before the
+	append and removes the journal.  Returns the list of source files which were being appended, or None if there was
+	nothing to roll back.
+	"""
+	journal = journal_path(destination)
+	if not os.path.isfile(journal):
+		return None
+	record = json.load(open(journal))
+	logging.warning('Rolling back an interrupted append of %s to %s (truncating to %d bytes)' % (record['sources'], destination, record['length']))
+	with open(destination, 'r+b') as f:
+		f.truncate(record['length'])
+		f.flush()
+		os.fsync(f.fileno())
+	os.remove(journal)
+	return record['sources']
+
+
+def concatenate_all(jobs, workers, mode = None):
+	"""
+	Runs several concatenations in parallel.  jobs is a list of (sources, destination) or (sources, destination, observers) tuples.
+	mode is the (optional) mode of the destination files.  Returns the list of the bytes written by each job.
+	"""
+	jobs = [(job[0], job[1], job[2] if len(job) > 2 else None) for job in jobs]
+	if len(jobs) <= 1 or workers <= 1:
+		return [concatenate(sources, destination, observers = observers, mode = mode) for sources, destination, observers in jobs]
+	pool = ThreadPool(min(workers, len(jobs)))
+	try:
+		results = [pool.apply_async(concatenate, (sources, destination), {'observers': observers, 'mode': mode}) for sources, destination, observers in jobs]
+		return [r.get() for r in results]
+	finally:
+		pool.close()
+		pool.join()
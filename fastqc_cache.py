@@ -0,0 +1,145 @@
+"""
+A cache of fastQC reports, so unchanged fastq files (e.g. when a flowcell is rerun through the pipeline, or a project
+is delivered again) are not run through fastQC a second time.
+
+Entries are keyed on the identity of the fastq file (its name plus its MD5 and size from the checksum manifest when
+those are known, or its device, inode, size and modification time otherwise) and of the QC engine which made the
+report (e.g. the fastQC version, or the native qc_engine), so a report is never served for another engine.  Each entry
+is a directory in the cache directory holding copies of the fastQC outputs (the _fastqc directory and/or the
+_fastqc.zip).  On a hit the outputs are copied next to the fastq file, so the delivered reports never depend on an
+entry which may be evicted.
+
+The cache is bounded in size: after each store, the least recently used entries are removed until the total is under
+the limit.  The modification time of an entry's directory is its last use.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+
+# holds the total size of the entry, so the eviction does not need to walk every entry
+SIZE_FILE = '.size'
+
+_eviction_lock = threading.Lock()
+
+
+def directory_size(path):
+	if os.path.isfile(path):
+		return os.path.getsize(path)
+	total = 0
+	for root, dirs, files in os.walk(path):
+		for f in files:
+			total += os.path.getsize(os.path.join(root, f))
+	return total
+
+
+class FastQCCache(object):
+
+	def __init__(self, cache_dir, max_bytes, engine = ''):
+		"""
+		engine identifies the QC engine (and its version) which makes the reports
+		"""
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.engine = engine
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+	def key(self, fastq_file, checksums = None):
+		"""
+		checksums is the entry from the checksum manifest for the file (or None if it is not known)
+		"""
+		if checksums:
+			identity = 'md5:%s:%d' % (checksums['md5'], checksums['size'])
+		else:
+			st = os.stat(fastq_file)
+			identity = 'stat:%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime))
+		return hashlib.sha1(self.engine + '|' + os.path.basename(fastq_file) + '|' + identity).hexdigest()
+
+	def entry_path(self, key):
+		return os.path.join(self.cache_dir, key)
+
+	def restore(self, key, outputs):
+		"""
+		outputs are the paths fastQC would have created.  If the cache has them, they are copied into place and True is returned.
+		"""
+		entry = self.entry_path(key)
+		if not os.path.isdir(entry):
+			return False
+		cached = [(os.path.join(entry, os.path.basename(p)), p) for p in outputs]
+		cached = [(c, p) for c, p in cached if os.path.exists(c)]
+		if len(cached) == 0:
+			return False
+		for c, p in cached:
+			if os.path.islink(p):
+				os.remove(p)
+			elif os.path.isdir(p):
+				shutil.rmtree(p)
+			elif os.path.exists(p):
+				os.remove(p)
+			if os.path.isdir(c):
+				shutil.copytree(c, p)
+			else:
+				shutil.copy2(c, p)
+		# mark the entry as recently used
+		os.utime(entry, None)
+		return True
+
+	def store(self, key, outputs):
+		"""
+		Copies the fastQC outputs (those which exist) into the cache, then evicts entries if the cache is over its size limit
+		"""
+		entry = self.entry_path(key)
+		if os.path.isdir(entry):
+			os.utime(entry, None)
+			return
+		outputs = [p for p in outputs if os.path.exists(p)]
+		if len(outputs) == 0:
+			return
+		# copy into a temporary directory first so a partial entry is never seen
+		tmp_entry = '%s.tmp.%d.%d' % (entry, os.getpid(), threading.current_thread().ident)
+		os.mkdir(tmp_entry)
+		try:
+			for p in outputs:
+				if os.path.isdir(p):
+					shutil.copytree(p, os.path.join(tmp_entry, os.path.basename(p)))
+				else:
+					shutil.copy2(p, tmp_entry)
+			with open(os.path.join(tmp_entry, SIZE_FILE), 'w') as fout:
+				fout.write(str(directory_size(tmp_entry)))
+			os.rename(tmp_entry, entry)
+		except OSError:
+			# another process stored the same entry first
+			shutil.rmtree(tmp_entry, ignore_errors = True)
+			if not os.path.isdir(entry):
+				raise
+		self.evict()
+
+	def entries(self):
+		"""
+		Returns a list of (last use, size, path) for the entries in the cache
+		"""
+		entries = []
+		for name in os.listdir(self.cache_dir):
+			path = os.path.join(self.cache_dir, name)
+			if '.tmp.' in name or not os.path.isdir(path):
+				continue
+			try:
+				size = int(open(os.path.join(path, SIZE_FILE)).read())
+			except (IOError, ValueError):
+				size = directory_size(path)
+			entries.append((os.path.getmtime(path), size, path))
+		return entries
+
+	def evict(self):
+		with _eviction_lock:
+			entries = sorted(self.entries())
+			total = sum([size for last_use, size, path in entries])
+			while total > self.max_bytes and entries:
+				last_use, size, path = entries.pop(0)
+				logging.info('Evicting %s from the fastQC cache (last used %s)' % (path, time.ctime(last_use)))
+				shutil.rmtree(path, ignore_errors = True)
+				total -= size
@@ -0,0 +1,87 @@
+"""
+Runs fastQC over a bounded pool of worker threads.
+
+Each fastQC invocation starts a JVM, which is slow, and fastQC only uses one thread per file.  So the fastq files are
+grouped into batches, and each batch is handled by a single invocation with one thread per file ('-t N').  Up to
+'workers' invocations run at once.  If a semaphore is given, it is shared with other callers (e.g. the per-sample
+tasks of the pipeline, which run concurrently) so the total number of fastQC processes stays bounded.
+"""
+
+import os
+import logging
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+
+def make_batches(fastq_files, batch_size):
+	batch_size = max(1, batch_size)
+	return [fastq_files[i:i + batch_size] for i in range(0, len(fastq_files), batch_size)]
+
+
+def output_dir(fastq_file):
+	"""
+	Returns the path of the directory fastQC creates for the fastq file
+	"""
+	name = os.path.basename(fastq_file)
+	for ext in ['.fastq.gz', '.fq.gz', '.fastq', '.fq']:
+		if name.endswith(ext):
+			name = name[:-len(ext)]
+			break
+	return os.path.join(os.path.dirname(fastq_file), name + '_fastqc')
+
+
+def outputs(fastq_file):
+	"""
+	Returns the paths fastQC may create for the fastq file (depending on its version and options, some will not exist)
+	"""
+	d = output_dir(fastq_file)
+	return [d, d + '.zip', d + '.html']
+
+
+def fastqc_command(fastqc_path, fastq_files):
+	return '%s -t %d %s' % (fastqc_path.strip(), len(fastq_files), ' '.join(fastq_files))
+
+
+def version(fastqc_path):
+	"""
+	Returns the version fastQC reports (e.g. 'FastQC v0.11.5'), or None if it cannot be run
+	"""
+	try:
+		return subprocess.check_output('%s --version' % fastqc_path.strip(), shell = True, stderr = subprocess.STDOUT).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def run_batch(fastqc_path, fastq_files, slots = None):
+	"""
+	Runs a single fastQC invocation on the fastq files.  Returns the list of files.
+	"""
+	if slots:
+		slots.acquire()
+	try:
+		call_command = fastqc_command(fastqc_path, fastq_files)
+		logging.info('Running fastQC: %s' % call_command)
+		subprocess.check_call(call_command, shell = True)
+	finally:
+		if slots:
+			slots.release()
+	return fastq_files
+
+
+def run_all(fastqc_path, fastq_files, workers, batch_size, on_complete = None, slots = None):
+	"""
+	Runs fastQC on all the fastq files.  on_complete(fastq_file) is called (in this thread) for each file as soon as its
+	batch finishes.  Raises subprocess.CalledProcessError if any invocation fails.
+	"""
+	batches = make_batches(fastq_files, batch_size)
+	if len(batches) == 0:
+		return
+	pool = ThreadPool(max(1, min(workers, len(batches))))
+	try:
+		for finished in pool.imap_unordered(lambda batch: run_batch(fastqc_path, batch, slots), batches):
+			for fq in finished:
+				if on_complete:
+					on_complete(fq)
+	finally:
+		pool.close()
+		pool.join()
@@ -15,8 +15,8 @@ sections = ['Per base sequence quality',
 'Overrepresented sequences']
 
 basic_stats_section = 'Basic Statistics'
-def parse(project_dir):
-	all_files = glob.glob('%s/*/*/fastqc_data.txt' % project_dir)
+def parse(project_dir, report_pattern = '*/*/fastqc_data.txt', output_name = 'fastqc_output.tsv'):
+	all_files = glob.glob(os.path.join(project_dir, report_pattern))
 	df = pd.DataFrame()
 
 	for f in all_files:
@@ -46,5 +46,5 @@ def parse(project_dir):
 		pds = pd.Series(d, name=sample)
 		df = pd.concat([df,pds], axis=1)
 
-	df.T.to_csv(os.path.join(project_dir, 'fastqc_output.tsv'), sep='\t', index_label='File')
+	df.T.to_csv(os.path.join(project_dir, output_name), sep='\t', index_label='File')
 
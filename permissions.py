@@ -0,0 +1,183 @@
+"""
+Setting the group-writable permissions (0775 for directories, 0664 for files) on the pipeline's outputs.
+
+On network filesystems every metadata operation is a round trip, and the same trees are fixed repeatedly (the year
+and month directories, each sample directory, each fastQC directory), so:
+	- the mode of each entry is checked first, and chmod is only called on entries which are not already correct.
+	  With scandir, the directory listing gives the entry types, so each entry needs a single lstat.
+	- the subdirectories at the top of a tree are handled in parallel.
+	- new files and directories are created with the right modes (with the umask of set_creation_umask, or with
+	  open_with_mode), so they do not need fixing afterwards.
+Symlinks are not descended into, but their targets are given the mode, as a chmod through the link would (e.g. the
+links to the final fastq files, whose targets may be outside the tree being fixed).
+
+The counts of the entries checked and changed are kept, and summary() reports how many chmod calls were saved.
+"""
+
+import os
+import stat
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+DIRECTORY_MODE = 0775
+FILE_MODE = 0664
+
+# the default number of threads used for fixing the subtrees of a directory
+DEFAULT_WORKERS = 8
+
+# with this umask, new directories are created with DIRECTORY_MODE and new files with FILE_MODE
+CREATION_UMASK = 0002
+
+_counts = {'checked': 0, 'changed': 0}
+_counts_lock = threading.Lock()
+
+
+def _count(checked, changed):
+	with _counts_lock:
+		_counts['checked'] += checked
+		_counts['changed'] += changed
+
+
+def set_creation_umask(mask = CREATION_UMASK):
+	"""
+	Sets the process umask.  Since the umask is shared by all threads, this should be called once at startup.
+	"""
+	previous = os.umask(mask)
+	logging.info('Set the umask to %04o (was %04o)' % (mask, previous))
+	return previous
+
+
+def _fix_entry(path, st_mode, directory_mode, file_mode):
+	"""
+	Returns True if the entry needed a chmod
+	"""
+	mode = directory_mode if stat.S_ISDIR(st_mode) else file_mode
+	if stat.S_IMODE(st_mode) != mode:
+		os.chmod(path, mode)
+		return True
+	return False
+
+
+def _list_directory(directory):
+	"""
+	Returns a list of (path, mode, is directory) for the entries of the directory.  The mode of a symlink is that of its
+	target (so the target is fixed through the link), and it is never a directory to descend into.  Dangling links are skipped.
+	"""
+	entries = []
+	if scandir is not None:
+		for entry in scandir(directory):
+			if entry.is_symlink():
+				try:
+					entries.append((entry.path, entry.stat(follow_symlinks = True).st_mode, False))
+				except OSError:
+					pass
+				continue
+			entries.append((entry.path, entry.stat(follow_symlinks = False).st_mode, entry.is_dir(follow_symlinks = False)))
+	else:
+		for name in os.listdir(directory):
+			path = os.path.join(directory, name)
+			st = os.lstat(path)
+			if stat.S_ISLNK(st.st_mode):
+				try:
+					entries.append((path, os.stat(path).st_mode, False))
+				except OSError:
+					pass
+				continue
+			entries.append((path, st.st_mode, stat.S_ISDIR(st.st_mode)))
+	return entries
+
+
+def _fix_tree(directory, directory_mode, file_mode):
+	"""
+	Fixes everything underneath directory (not the directory itself).  Returns (checked, changed)
+	"""
+	checked = 0
+	changed = 0
+	pending = [directory]
+	while pending:
+		for path, st_mode, is_dir in _list_directory(pending.pop()):
+			checked += 1
+			if _fix_entry(path, st_mode, directory_mode, file_mode):
+				changed += 1
+			if is_dir:
+				pending.append(path)
+	return checked, changed
+
+
+def fix(path, directory_mode = DIRECTORY_MODE, file_mode = FILE_MODE, workers = DEFAULT_WORKERS):
+	"""
+	Sets the modes on path and everything underneath it, skipping entries which already have them.
+	Returns (entries checked, entries changed).
+	"""
+	st = os.stat(path)
+	checked = 1
+	changed = 1 if _fix_entry(path, st.st_mode, directory_mode, file_mode) else 0
+	if stat.S_ISDIR(st.st_mode) and not os.path.islink(path):
+		top = _list_directory(path)
+		subdirs = []
+		for entry_path, st_mode, is_dir in top:
+			checked += 1
+			if _fix_entry(entry_path, st_mode, directory_mode, file_mode):
+				changed += 1
+			if is_dir:
+				subdirs.append(entry_path)
+		if len(subdirs) > 1 and workers > 1:
+			pool = ThreadPool(min(workers, len(subdirs)))
+			try:
+				results = pool.map(lambda d: _fix_tree(d, directory_mode, file_mode), subdirs)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			results = [_fix_tree(d, directory_mode, file_mode) for d in subdirs]
+		for c, ch in results:
+			checked += c
+			changed += ch
+	_count(checked, changed)
+	return checked, changed
+
+
+def correct_permissions(directory, workers = DEFAULT_WORKERS):
+	"""
+	Gives write privileges to the biocomp group (if not already there)
+	Recurses through all directories and files underneath the path passed as the argument, with the given number of threads
+	"""
+	checked, changed = fix(directory, workers = workers)
+	logging.info('Corrected permissions underneath %s: %d entries checked, %d changed' % (directory, checked, changed))
+
+
+def open_with_mode(path, flags, mode = FILE_MODE):
+	"""
+	Opens (creating, if flags include O_CREAT) a file and gives it the mode through the open descriptor (fchmod),
+	which avoids another lookup of the path.  Returns the file descriptor.
+	"""
+	fd = os.open(path, flags, mode)
+	try:
+		if stat.S_IMODE(os.fstat(fd).st_mode) != mode:
+			os.fchmod(fd, mode)
+			_count(1, 1)
+		else:
+			_count(1, 0)
+	except:
+		os.close(fd)
+		raise
+	return fd
+
+
+def counts():
+	with _counts_lock:
+		return dict(_counts)
+
+
+def summary():
+	c = counts()
+	return 'Permissions: %d entries checked, %d changed, %d chmod calls saved' % (c['checked'], c['changed'], c['checked'] - c['changed'])
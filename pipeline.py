@@ -5,35 +5,57 @@ import glob
 import shutil
 import json
 import logging
+import threading
+import zlib
 from datetime import datetime as date
 import subprocess
 import demux_cloud_upload
+import checksums
+import demux_backends
+import fastq_concat
+import fastqc_cache
+import fastqc_runner
+import parse_fastqc_data
+import permissions
+import preflight
+import qc_engine
+import qc_preview
+import read_stats
+import samplesheet
+import stage_executor
+import undetermined_analysis
 import utils
 
-class SampleSheetException(Exception):
-	pass
+# defined with the sample sheet parser, but still raised (and caught) as pipeline.SampleSheetException
+SampleSheetException = samplesheet.SampleSheetException
 
 
 class MissingContactException(Exception):
 	pass
 
 
-def correct_permissions(directory):
-	"""
-	Gives write privileges to the biocomp group (if not already there)
-	Recurses through all directories and files underneath the path passed as the argument
-	"""
-	logging.info('Changing permissions on all directories underneath %s' % directory)
-	os.chmod(directory, 0775)
-	for root, dirs, files in os.walk(directory):
-		for d in dirs:
-			os.chmod(os.path.join(root, d), 0775)
-		for f in files:
-			os.chmod(os.path.join(root, f), 0775)
+# the shared permission fixer (see permissions.py)
+correct_permissions = permissions.correct_permissions
+
+
+# the attributes which are saved in the checkpoint file after each stage, so an interrupted run can be resumed
+CHECKPOINT_ATTRIBUTES = ['project_id_list', 
+			'project_to_email_mapping', 
+			'project_to_sample_map', 
+			'target_dir', 
+			'fc_index_map', 
+			'lane_specific_fastq_mapping', 
+			'project_to_bucket_mapping']
 
 
 class Pipeline(object):
 
+	# guards the creation of the semaphore which bounds the number of concurrent fastQC processes
+	fastqc_slots_guard = threading.Lock()
+
+	# guards the writing of the preview summary tables, which several samples' tasks update
+	preview_lock = threading.Lock()
+
 	def __init__(self):
 		pass
 
@@ -49,6 +71,29 @@ class Pipeline(object):
 		logging.info(self.config_params_dict)
 
 
+	def correct_permissions(self, path):
+		"""
+		Fixes the permissions underneath path, with the number of threads given in the config
+		"""
+		correct_permissions(path, int(self.config_params_dict.get('permission_workers', permissions.DEFAULT_WORKERS)))
+
+
+	def run_preflight_checks(self):
+		"""
+		Checks the free space, write permissions, tools and cloud credentials needed by the rest of the run (see preflight.py),
+		so those problems stop the run before the demux starts rather than hours into it
+		"""
+		logging.info('Running the pre-flight checks')
+		cloud_params = utils.parse_config_file('CLOUD')
+		problems = preflight.run_checks(self.run_directory_path, self.config_params_dict, cloud_params, 
+						self.completed_stages, getattr(self, 'demux_backend', None))
+		if problems:
+			for problem in problems:
+				logging.error('Pre-flight check failed: %s' % problem)
+			sys.exit(1)
+		logging.info('Pre-flight checks passed')
+
+
 	def create_output_directory(self):
 		"""
 		This method takes a path to the sequencing run directory and attempts to create an output
@@ -59,9 +104,12 @@ class Pipeline(object):
 		if os.path.isdir(self.run_directory_path):
 			try:
 				output_directory_path = os.path.join(self.run_directory_path, self.config_params_dict.get('demux_output_dir'))
+				if getattr(self, 'resume', False) and os.path.isdir(output_directory_path):
+					logging.info('Resuming, so re-using the existing output directory at %s' % output_directory_path)
+					self.config_params_dict['demux_output_dir'] = output_directory_path
+					return
 				logging.info('Creating output directory for demux process at %s' % output_directory_path)			
 				os.mkdir(output_directory_path)
-				correct_permissions(output_directory_path)
 				self.config_params_dict['demux_output_dir'] = output_directory_path
 			except:
 				logging.error('An exception occurred when attempting to create the output directory at: %s' % output_directory_path)
@@ -91,6 +139,59 @@ class Pipeline(object):
 			sys.exit(1)
 
 
+	def checkpoint_path(self):
+		return os.path.join(self.run_directory_path, self.config_params_dict.get('checkpoint_file'))
+
+
+	def write_checkpoint(self, stage):
+		"""
+		Records that 'stage' has completed, along with the state (attributes) that later stages depend on.
+		The file is written to a temporary location, flushed to disk, and then renamed over the old checkpoint
+		so that a crash cannot leave a partially-written checkpoint.
+		"""
+		self.completed_stages.append(stage)
+		checkpoint = {'completed_stages': self.completed_stages, 
+				'demux_output_dir': self.config_params_dict.get('demux_output_dir'),
+				'state': {}}
+		for attr in CHECKPOINT_ATTRIBUTES:
+			if hasattr(self, attr):
+				checkpoint['state'][attr] = getattr(self, attr)
+		checkpoint_file = self.checkpoint_path()
+		tmp_file = checkpoint_file + '.tmp'
+		with open(tmp_file, 'w') as fout:
+			json.dump(checkpoint, fout)
+			fout.flush()
+			os.fsync(fout.fileno())
+		os.rename(tmp_file, checkpoint_file)
+		logging.info('Wrote checkpoint after stage "%s" to %s' % (stage, checkpoint_file))
+
+
+	def load_checkpoint(self):
+		"""
+		Restores the completed stages and their outputs from a previous (interrupted) run, if a checkpoint exists
+		"""
+		self.completed_stages = []
+		checkpoint_file = self.checkpoint_path()
+		if os.path.isfile(checkpoint_file):
+			logging.info('Loading checkpoint from %s' % checkpoint_file)
+			checkpoint = json.load(open(checkpoint_file))
+			self.completed_stages = checkpoint['completed_stages']
+			for attr, value in checkpoint['state'].items():
+				setattr(self, attr, value)
+			logging.info('Previously completed stages: %s' % self.completed_stages)
+		else:
+			logging.info('No checkpoint found at %s.  Starting from the beginning.' % checkpoint_file)
+
+
+	def checksum_manifest(self, project_dir):
+		"""
+		Returns the checksum manifest for the project directory, or None if checksums are turned off in the config
+		"""
+		if int(self.config_params_dict.get('compute_checksums', 0)):
+			return checksums.ChecksumManifest(project_dir, self.config_params_dict.get('checksum_manifest'))
+		return None
+
+
 	def create_project_structure(self, project_id):
 		"""
 		This creates the project and sample subdirectories within the time-stamped destination directory.
@@ -101,7 +202,6 @@ class Pipeline(object):
 		new_project_dir = os.path.join(self.target_dir, project_id)
 		try:
 			os.mkdir(new_project_dir)
-			os.chmod(new_project_dir, 0775)
 			logging.info('Created directory for project %s at %s' % (project_id, new_project_dir))
 		except OSError as ex:
 			if ex.errno == 17: # directory was already there
@@ -114,7 +214,6 @@ class Pipeline(object):
 				sample_dir = os.path.join(new_project_dir, sample_dir)
 				os.mkdir(sample_dir)
 				logging.info('Created sample directory at %s' % sample_dir)
-				correct_permissions(sample_dir)
 		except OSError as ex:
 			if ex.errno == 17: # directory was already there
 				logging.warning('Sample directory at %s was already present.  Generally this should not occur, so something could be wrong.  However, if the same sample we sequenced in two or more different runs, then this is expected.  Not exiting, but check this over.' % sample_dir)
@@ -168,12 +267,10 @@ class Pipeline(object):
 				year_dir = os.path.join(self.config_params_dict.get('destination_path'), str(year))
 				if not os.path.isdir(year_dir):
 					os.mkdir(year_dir)
-					correct_permissions(year_dir)
 					logging.info('Creating new year-level directory at %s' % year_dir)
 				month_dir = os.path.join(year_dir, str(month))
 				if not os.path.isdir(month_dir):
 					os.mkdir(month_dir)
-					correct_permissions(month_dir)
 					logging.info('Creating new month-level directory at %s' % month_dir)					
 
 			except OSError as ex:
@@ -196,149 +293,273 @@ class Pipeline(object):
 
 
 
-	def run_fastqc(self):
+	def run_fastqc_for_sample(self, project_id, sample_name):
 		"""
-		Finds all the fastq files in 'target_directory' and runs them through fastQC with a system call
+		Runs fastQC on the final fastq files of a single sample
 		"""
-		logging.info('About to run fastQC...')
-		for project_id in self.project_id_list:
-			logging.info('FastQC for project ID: %s' % project_id)
-			project_dir = os.path.join(self.target_dir, project_id)
+		fastq_files = self.final_fastq_files(project_id, sample_name)
+		logging.info('Found these fastq files for sample %s: %s' % (sample_name, fastq_files))
+		self.run_fastqc_on_files(fastq_files)
+		self.replace_previews(fastq_files)
+
+
+	def preview_sample(self, project_id, sample_name):
+		"""
+		Writes provisional QC reports for a sample from a random subsample of preview_reads reads of each of its fastq files, 
+		and updates the project's preview summary table.  The full QC replaces these (see replace_previews).
+		"""
+		project_dir = os.path.join(self.target_dir, project_id)
+		preview_dir = os.path.join(project_dir, self.config_params_dict.get('preview_qc_dir'))
+		for fq in self.final_fastq_files(project_id, sample_name):
+			full_report = os.path.join(fastqc_runner.output_dir(fq), self.config_params_dict.get('fastqc_data', 'fastqc_data.txt'))
+			if os.path.isfile(full_report) and os.path.getmtime(full_report) >= os.path.getmtime(fq):
+				logging.info('The full QC report for %s is already done, so not making a preview' % fq)
+				continue
+			logging.info('Making a preview QC report for %s' % fq)
+			try:
+				qc_preview.preview(fq, int(self.config_params_dict.get('preview_reads')), preview_dir)
+			except (IOError, OSError, zlib.error) as ex:
+				# the preview is only a convenience, so a failure is not fatal
+				logging.warning('Could not make a preview QC report for %s: %s' % (fq, ex))
+		self.write_preview_summary(project_id)
+
+
+	def replace_previews(self, fastq_files):
+		"""
+		Removes the provisional reports of fastq files whose full QC is done
+		"""
+		projects = set()
+		for fq in fastq_files:
+			project_dir = os.path.dirname(os.path.dirname(fq))
+			if qc_preview.remove_preview(fq, os.path.join(project_dir, self.config_params_dict.get('preview_qc_dir'))):
+				projects.add(os.path.basename(project_dir))
+		for project_id in projects:
+			self.write_preview_summary(project_id)
 
-			samples = self.project_to_sample_map[project_id]
-			fastq_files = []
-			for s in samples:
-				sample_dir = os.path.join(project_dir, self.config_params_dict.get('sample_dir_prefix') + s)
-				fastq_files.extend( [os.path.join(sample_dir, f) for f in os.listdir(sample_dir) if f.lower().endswith(self.config_params_dict['final_fastq_tag'] + '.fastq.gz')])
 
-			logging.info('Found these fastq files for this project: %s' % fastq_files)
+	def write_preview_summary(self, project_id):
+		"""
+		Writes the summary table of the project's provisional reports (or removes it, once all of them have been replaced)
+		"""
+		project_dir = os.path.join(self.target_dir, project_id)
+		preview_dir = self.config_params_dict.get('preview_qc_dir')
+		summary_path = os.path.join(project_dir, self.config_params_dict.get('preview_summary_file'))
+		with Pipeline.preview_lock:
+			if len(glob.glob(os.path.join(project_dir, preview_dir, '*', 'fastqc_data.txt'))) > 0:
+				parse_fastqc_data.parse(project_dir, os.path.join(preview_dir, '*', 'fastqc_data.txt'), self.config_params_dict.get('preview_summary_file'))
+			elif os.path.isfile(summary_path):
+				os.remove(summary_path)
+
+
+	def final_fastq_files(self, project_id, sample_name):
+		sample_dir = os.path.join(self.target_dir, project_id, self.config_params_dict.get('sample_dir_prefix') + sample_name)
+		return sorted([os.path.join(sample_dir, f) for f in os.listdir(sample_dir) if f.lower().endswith(self.config_params_dict['final_fastq_tag'] + '.fastq.gz')])
+
+
+	def flowcell_fastq_files(self, final_fastq):
+		"""
+		Returns the flowcell-specific fastq files (fc1, fc2, ...) whose concatenation is the final fastq file, in order
+		"""
+		suffix = self.config_params_dict['final_fastq_tag'] + '.fastq.gz'
+		if not final_fastq.endswith(suffix):
+			return []
+		base = final_fastq[:-len(suffix)] + self.config_params_dict.get('flowcell_prefix', '')
+		files = [f for f in glob.glob(base + '[0-9]*.fastq.gz') if f[len(base):-len('.fastq.gz')].isdigit()]
+		return sorted(files, key = lambda f: int(f[len(base):-len('.fastq.gz')]))
+
+
+	def fastqc_cache(self):
+		"""
+		Returns the fastQC report cache, or None if there is no fastqc_cache_dir in the config
+		"""
+		cache_dir = self.config_params_dict.get('fastqc_cache_dir', '').strip()
+		if cache_dir:
+			return fastqc_cache.FastQCCache(cache_dir, int(float(self.config_params_dict.get('fastqc_cache_max_gb', 50)) * 1e9), self.qc_engine_identity())
+		return None
+
+
+	def qc_engine_identity(self):
+		"""
+		Returns a string identifying the engine (and its version) which makes the QC reports, as given by qc_backend
+		"""
+		if self.config_params_dict.get('qc_backend', 'fastqc') == 'native':
+			return 'native:%s' % qc_engine.VERSION
+		if getattr(self, 'fastqc_version', None) is None:
+			fastqc_path = self.config_params_dict['fastqc_path']
+			self.fastqc_version = 'fastqc:%s' % (fastqc_runner.version(fastqc_path) or fastqc_path)
+		return self.fastqc_version
+
+
+	def run_fastqc_on_files(self, fastq_files):
+		"""
+		Runs fastQC on the fastq files in batches (one JVM with a thread per file for each batch), with at most fastqc_workers
+		invocations running at once across the whole pipeline.  Permissions are corrected on each report as soon as its batch is done.
+		Files whose reports are in the fastQC cache are not run again- the cached reports are restored instead.
+		With qc_backend = native in the config, the reports are made by qc_engine (in fastqc_workers processes) instead of fastQC.
+		The native reports for samples merged across flowcells are made from stored per-flowcell summaries, so only new data is read.
+		"""
+		cache = self.fastqc_cache()
+		keys = {}
+		if cache:
 			for fq in fastq_files:
-				try:
-					call_command = self.config_params_dict['fastqc_path'] + ' ' + fq
-					subprocess.check_call(call_command, shell = True)
+				manifest = self.checksum_manifest(os.path.dirname(os.path.dirname(fq)))
+				keys[fq] = cache.key(fq, manifest.get(fq) if manifest else None)
+			hits = [fq for fq in fastq_files if cache.restore(keys[fq], fastqc_runner.outputs(fq))]
+			for fq in hits:
+				logging.info('Restored the fastQC report for %s from the cache' % fq)
+				self.correct_permissions(fastqc_runner.output_dir(fq))
+			fastq_files = [fq for fq in fastq_files if fq not in hits]
+
+		def on_complete(fq):
+			self.correct_permissions(fastqc_runner.output_dir(fq))
+			if cache:
+				cache.store(keys[fq], fastqc_runner.outputs(fq))
+
+		workers = int(self.config_params_dict.get('fastqc_workers', 1))
+		if self.config_params_dict.get('qc_backend', 'fastqc') == 'native':
+			try:
+				parts = dict([(fq, self.flowcell_fastq_files(fq)) for fq in fastq_files])
+				qc_engine.run_all(fastq_files, workers, on_complete = on_complete, parts = parts)
+			except (IOError, OSError, ValueError, zlib.error) as ex:
+				logging.error('The QC of fastq files (%s) failed: %s' % (fastq_files, ex))
+				sys.exit(1)
+			return
 
-					# get the name of the output directory from the fastQC process:
-					fastqc_dir_name = os.path.basename(fq)[:-len('.fastq.gz')] + '_fastqc'
-					fastqc_dir = os.path.join(os.path.dirname(fq), fastqc_dir_name)
-					correct_permissions(fastqc_dir)
-				except subprocess.CalledProcessError:
-					logging.error('The fastqc process on fastq file (%s) had non-zero exit status.  Check the log.' % fq)
-					sys.exit(1)
+		with Pipeline.fastqc_slots_guard:
+			if getattr(self, 'fastqc_slots', None) is None:
+				self.fastqc_slots = threading.BoundedSemaphore(workers)
+		try:
+			fastqc_runner.run_all(self.config_params_dict['fastqc_path'], 
+						fastq_files, 
+						workers, 
+						int(self.config_params_dict.get('fastqc_batch_size', 1)), 
+						on_complete = on_complete,
+						slots = self.fastqc_slots)
+		except subprocess.CalledProcessError as ex:
+			logging.error('The fastqc process on fastq files (%s) had non-zero exit status.  Check the log.' % ex.cmd)
+			sys.exit(1)
 
 
 
 	def run_demux(self):
 		"""
-		This writes the call for the demux process.  Uses the parent to execute the actual process.
+		Runs the demux process with the backend given by demux_backend in the config (bcl2fastq by default).
+		See demux_backends.py for the available backends.
 		"""
-		call_command = self.config_params_dict['demux_path'] + ' --output-dir ' + self.config_params_dict['demux_output_dir'] + ' --runfolder-dir ' + self.run_directory_path
-		self.execute_call(call_command)
+		backend_name = getattr(self, 'demux_backend', None) or self.config_params_dict.get('demux_backend', 'bcl2fastq')
+		logging.info('Demultiplexing with the %s backend' % backend_name)
+		backend = demux_backends.get_backend(backend_name)(self)
+		backend.run()
+		self.correct_permissions(self.config_params_dict['demux_output_dir'])
 
 
-	def concatenate_and_move_fastq_files(self):
+	def analyze_undetermined(self):
+		"""
+		Counts the index sequences of the undetermined reads and writes reports of the likely mis-entered barcodes
+		and the index-hopping rate for each lane.  This is informational, so a failure here does not stop the pipeline.
 		"""
-		This method scans the output and concatenates the fastq files for each sample and read number.
-		That is, the NextSeq output (in general) has a fastq file for each lane and sample and we need to 
-		concatenate the lane files into a single fastq file for that sample.  For paired-end protocol, need
-		to do this for both the R1 and R2 reads.
+		demux_output_dir = self.config_params_dict['demux_output_dir']
+		try:
+			undetermined_analysis.analyze(demux_output_dir, 
+							self.samplesheet_rows, 
+							os.path.join(demux_output_dir, self.config_params_dict.get('undetermined_barcode_report')), 
+							os.path.join(demux_output_dir, self.config_params_dict.get('index_hopping_report')), 
+							int(self.config_params_dict.get('undetermined_top_n', 50)), 
+							int(self.config_params_dict.get('undetermined_max_mismatches', 2)))
+		except Exception as ex:
+			logging.warning('The analysis of the undetermined reads failed: %s' % ex)
+
 
-		Also moves the lane-specific fastq files into the project directories, so the demux dirs can eventually be deleted
+	def concatenate_sample_fastq_files(self, project_id, sample_dir):
 		"""
+		Concatenates the lane-specific fastq files for a single sample (sample_dir is the sample's directory in the demux output)
+		and moves the lane-specific files into the project directory.  Returns the sample name and the final locations of 
+		the lane-specific files.
+		"""
+		# since bcl2fastq2 renames the fastq files with a different scheme, extract the sample name we want via parsing the directory name
+		sample_name_with_prefix = os.path.basename(sample_dir)
+		sample_name = sample_name_with_prefix[len(self.config_params_dict.get('sample_dir_prefix')):]
 
-		# we want to keep track of where the original (lane-specific fastq files were kept), via a hierarchical dictionary:
-		self.lane_specific_fastq_mapping = {}
+		# get all the fastq files as lists.  Note the sort so they are concatenated in the same order for paired-end protocol
+		read_1_fastq_files = sorted(glob.glob(os.path.join(sample_dir, '*R1_001.fastq.gz')))			
+		read_2_fastq_files = sorted(glob.glob(os.path.join(sample_dir, '*R2_001.fastq.gz'))) # will be empty list [] if single-end protocol
 
-		for project_id in self.project_id_list:
+		paired = False
+		if len(read_2_fastq_files) > 0:
+			paired = True
 
-			project_dir = os.path.join(self.config_params_dict.get('demux_output_dir'), project_id)
+		# need at least the read 1 files to continue
+		if len(read_1_fastq_files) == 0:
+			logging.error('Did not find any fastq files in %s directory.' % sample_dir)
+			sys.exit(1)			
 
-			# get the sample-specific subdirectories and append the path to the project directory in front (for full path name):
-			# this gives the fully qualified location of the original fastq files (which are given by lane)
-			sample_dirs = [os.path.join(project_dir, d) for d in os.listdir(project_dir) if d.startswith(self.config_params_dict.get('sample_dir_prefix'))] 
+		# make file names for the merged files:
+		merged_read_1_fastq = sample_name + '_R1_.' + self.config_params_dict.get('tmp_fastq_tag') + '.fastq.gz'
+		merged_read_2_fastq = sample_name + '_R2_.' + self.config_params_dict.get('tmp_fastq_tag') + '.fastq.gz'
 
-			# double check that they are actually directories:
-			sample_dirs = filter( lambda x: os.path.isdir(x), sample_dirs)
+		# construct full paths to the final files:
+		merged_read_1_fastq = os.path.join(self.target_dir, project_id, sample_name_with_prefix, merged_read_1_fastq)
+		merged_read_2_fastq = os.path.join(self.target_dir, project_id, sample_name_with_prefix, merged_read_2_fastq)
 
-			# declare a lower-level dict to map the sample names (For a single project) to a list of filepaths
-			sample_to_lane_specific_fastq_map = {}
+		jobs = [(read_1_fastq_files, merged_read_1_fastq)]
+		if len(read_2_fastq_files) > 0:
+			if len(read_2_fastq_files) == len(read_1_fastq_files):
+				jobs.append((read_2_fastq_files, merged_read_2_fastq))
+			else:
+				logging.error('Differing number of FASTQ files between R1 and R2')
+				logging.info('R1 files: %s' % read_1_fastq_files)
+				logging.info('R2 files: %s' % read_2_fastq_files)
+				sys.exit(1)
 
-			for sample_dir in sample_dirs:
-				# since bcl2fastq2 renames the fastq files with a different scheme, extract the sample name we want via parsing the directory name
-				sample_name_with_prefix = os.path.basename(sample_dir)
-				sample_name = sample_name_with_prefix[len(self.config_params_dict.get('sample_dir_prefix')):]
-
-				# get all the fastq files as lists.  Note the sort so they are concatenated in the same order for paired-end protocol
-				read_1_fastq_files = sorted(glob.glob(os.path.join(sample_dir, '*R1_001.fastq.gz')))			
-				read_2_fastq_files = sorted(glob.glob(os.path.join(sample_dir, '*R2_001.fastq.gz'))) # will be empty list [] if single-end protocol
-
-				paired = False
-				if len(read_2_fastq_files) > 0:
-					paired = True
-
-				# need at least the read 1 files to continue
-				if len(read_1_fastq_files) == 0:
-					logging.error('Did not find any fastq files in %s directory.' % sample_dir)
-					sys.exit(1)			
-
-				# make file names for the merged files:
-				merged_read_1_fastq = sample_name + '_R1_.' + self.config_params_dict.get('tmp_fastq_tag') + '.fastq.gz'
-				merged_read_2_fastq = sample_name + '_R2_.' + self.config_params_dict.get('tmp_fastq_tag') + '.fastq.gz'
-
-				# construct full paths to the final files:
-				merged_read_1_fastq = os.path.join(self.target_dir, project_id, sample_name_with_prefix, merged_read_1_fastq)
-				merged_read_2_fastq = os.path.join(self.target_dir, project_id, sample_name_with_prefix, merged_read_2_fastq)
-
-				# an inline method to compose the concatenation command:
-				write_call = lambda infiles,outfile: 'cat '+ ' '.join(infiles) + ' >' + outfile
-
-				call_list = []
-				call_list.append(write_call(read_1_fastq_files, merged_read_1_fastq))
-				if len(read_2_fastq_files) > 0:
-					if len(read_2_fastq_files) == len(read_1_fastq_files):
-						call_list.append(write_call(read_2_fastq_files, merged_read_2_fastq))
-					else:
-						logging.error('Differing number of FASTQ files between R1 and R2')
-						logging.info('R1 files: %s' % read_1_fastq_files)
-						logging.info('R2 files: %s' % read_2_fastq_files)
-						sys.exit(1)
-
-				for call in call_list:
-					try:
-						logging.info('Issuing system command: %s ' % call)
-						subprocess.check_call( call, shell = True )
-						logging.info('Completed concatenation for %s' % sample_name)
-					except subprocess.CalledProcessError:
-						logging.error('The concatentation of the lane-specific fastq files failed somehow')
-						sys.exit(1)
-					except Exception as ex:
-						logging.error(ex.message)
-						sys.exit(1)
-
-				# change permissions on the final concatenated fastq files
-				os.chmod(merged_read_1_fastq, 0775)	
-				if paired:
-					os.chmod(merged_read_2_fastq, 0775)	
-
-				# finally, relocate the lane-specific fastq files to the project directory so we don't risk losing that level of data when
-				# we delete the flowcell/demux folders
-				dest_dir = os.path.join(self.target_dir, project_id, self.config_params_dict.get('lane_specific_fastq_directory'), self.config_params_dict.get('flowcell_prefix') + str(self.fc_index_map[project_id]))
-				for fq in read_1_fastq_files + read_2_fastq_files:
-					# since bcl2fastq will change underscores to dashes (and potentially other side-effects), we will rename the
-					# lane-specific files as we move them.
-
-					suffix = re.findall(r'_L00\d_R\d_001.fastq.gz', os.path.basename(fq))[0]
-					new_name = sample_name + suffix
-					destination_path = os.path.join(dest_dir, new_name)
-					logging.info('Moving %s to %s' % (fq, destination_path))
-					shutil.move(fq, destination_path)
-					logging.info('Done moving')
-
-				# keep track of the file mapping
-				sample_to_lane_specific_fastq_map[sample_name] = [os.path.realpath(x) for x in glob.glob(os.path.join(dest_dir, sample_name + '*.fastq.gz'))]
-
-			# add the file mapping to the highest-level dict
-			self.lane_specific_fastq_mapping[project_id] = sample_to_lane_specific_fastq_map
-			logging.info(self.lane_specific_fastq_mapping[project_id])
+		# compute the checksums and read statistics of the concatenated files as the data streams through
+		manifest = self.checksum_manifest(os.path.join(self.target_dir, project_id))
+		checksummers = {}
+		stats_observers = {}
+		observers = dict([(destination, []) for sources, destination in jobs])
+		if manifest:
+			for destination in observers.keys():
+				observers[destination].append(checksummers.setdefault(destination, checksums.Checksummer()))
+		if int(self.config_params_dict.get('collect_read_stats', 0)):
+			for read_num, (sources, destination) in enumerate(jobs, 1):
+				observers[destination].append(stats_observers.setdefault(read_num, read_stats.ReadStatsObserver()))
+		jobs = [(sources, destination, observers[destination]) for sources, destination in jobs]
+
+		try:
+			logging.info('Concatenating: %s' % jobs)
+			# the concatenated files are given their final permissions as they are created
+			fastq_concat.concatenate_all(jobs, int(self.config_params_dict.get('concatenation_workers', 2)), mode = permissions.FILE_MODE)
+			logging.info('Completed concatenation for %s' % sample_name)
+		except (IOError, OSError) as ex:
+			logging.error('The concatentation of the lane-specific fastq files failed: %s' % ex)
+			for observer in stats_observers.values():
+				observer.cancel()
+			sys.exit(1)
+
+		for destination, checksummer in checksummers.items():
+			manifest.set(destination, checksummer.result())
+
+		if stats_observers:
+			stats = dict([(read_num, observer.result()) for read_num, observer in stats_observers.items()])
+			logging.info('Read statistics for %s: %s' % (sample_name, stats))
+			stats_table = read_stats.ReadStatsTable(os.path.join(self.target_dir, project_id), self.config_params_dict.get('read_stats_file'))
+			stats_table.add_sample(sample_name, self.config_params_dict.get('flowcell_prefix') + str(self.fc_index_map[project_id]), stats)
+
+		# finally, relocate the lane-specific fastq files to the project directory so we don't risk losing that level of data when
+		# we delete the flowcell/demux folders
+		dest_dir = os.path.join(self.target_dir, project_id, self.config_params_dict.get('lane_specific_fastq_directory'), self.config_params_dict.get('flowcell_prefix') + str(self.fc_index_map[project_id]))
+		for fq in read_1_fastq_files + read_2_fastq_files:
+			# since bcl2fastq will change underscores to dashes (and potentially other side-effects), we will rename the
+			# lane-specific files as we move them.
+
+			suffix = re.findall(r'_L00\d_R\d_001.fastq.gz', os.path.basename(fq))[0]
+			new_name = sample_name + suffix
+			destination_path = os.path.join(dest_dir, new_name)
+			logging.info('Moving %s to %s' % (fq, destination_path))
+			shutil.move(fq, destination_path)
+			logging.info('Done moving')
+
+		# return the file mapping, so the caller can keep track of it
+		return sample_name, [os.path.realpath(x) for x in glob.glob(os.path.join(dest_dir, sample_name + '*.fastq.gz'))]
 
 
 	def merge_and_rename_fastq(self, sample_dir, read_num):
@@ -352,111 +573,216 @@ class Pipeline(object):
 		# the expected names of the final fastq files
 		existing_read_k_fastq = os.path.join(sample_dir, sample_name + '_R'+ k + '_.' + self.config_params_dict.get('final_fastq_tag') +'.fastq.gz')
 		logging.info('Looking for an existing fastq file at %s ' % existing_read_k_fastq)
+		manifest = self.checksum_manifest(os.path.dirname(sample_dir))
 		if os.path.isfile(existing_read_k_fastq):
-			logging.info('There was already a fastq file for this sample.  Merge the new fastq from this demux process with the old one.')
-			# concatenate the existing final fastq with the new one.  Dump the result into a temp file and then rename the tempfile
-
-			# first, rename the fastq file from this demux process to indicate which 'run' it came from
-			j = len(glob.glob(os.path.join(sample_dir, sample_name + '_R' + k +"_." + self.config_params_dict.get('flowcell_prefix') + "[0-9]*.fastq.gz")))
-			run_specific_fq = os.path.join(sample_dir, sample_name + '_R'+ k +'_.' + self.config_params_dict.get('flowcell_prefix') + str(j+1) + '.fastq.gz')
-			logging.info('Renaming: %s ---> %s' % (new_read_fastq, run_specific_fq))
-			os.rename(new_read_fastq, run_specific_fq)  
-
-			# a placeholder file to concatenate into (cannot concatenate into *final.fastq.gz since that is one of the files 'providing' data to the stream
-			tmpfile = os.path.join(sample_dir, sample_name + '_R'+ k + '_.tmp')
-			cat_cmd = 'cat ' + existing_read_k_fastq + ' ' + run_specific_fq + '> ' + tmpfile
-			self.execute_call(cat_cmd)
-
-			# rename this 'final' fastq
-			logging.info('Renaming: %s ---> %s' % (tmpfile, existing_read_k_fastq))
-			os.rename(tmpfile, existing_read_k_fastq) 
+			# an earlier attempt may have been interrupted part-way through the merge (see fastq_concat.start_merge)
+			pending = fastq_concat.pending_merge(existing_read_k_fastq)
+			if not os.path.islink(existing_read_k_fastq):
+				# if a previous merge into the final fastq was interrupted, undo the partial append.  It is redone below.
+				interrupted_sources = fastq_concat.rollback_append(existing_read_k_fastq)
+				if interrupted_sources and pending is None and not os.path.isfile(new_read_fastq):
+					logging.info('Redoing the interrupted merge of %s into %s' % (interrupted_sources, existing_read_k_fastq))
+					fastq_concat.append_with_journal(interrupted_sources, existing_read_k_fastq)
+					if manifest:
+						manifest.set(existing_read_k_fastq, checksums.file_checksums(existing_read_k_fastq))
+					return
+
+			if os.path.isfile(new_read_fastq):
+				logging.info('There was already a fastq file for this sample.  Merge the new fastq from this demux process with the old one.')
+				if pending:
+					# the interrupted attempt had not renamed the new fastq yet; keep the name it chose
+					run_specific_fq = pending['source']
+				else:
+					# first, rename the fastq file from this demux process to indicate which 'run' it came from
+					j = len(glob.glob(os.path.join(sample_dir, sample_name + '_R' + k +"_." + self.config_params_dict.get('flowcell_prefix') + "[0-9]*.fastq.gz")))
+					run_specific_fq = os.path.join(sample_dir, sample_name + '_R'+ k +'_.' + self.config_params_dict.get('flowcell_prefix') + str(j+1) + '.fastq.gz')
+					fastq_concat.start_merge(run_specific_fq, existing_read_k_fastq)
+				logging.info('Renaming: %s ---> %s' % (new_read_fastq, run_specific_fq))
+				os.rename(new_read_fastq, run_specific_fq)  
+			elif pending:
+				run_specific_fq = pending['source']
+				logging.info('Resuming the interrupted merge of %s into %s' % (run_specific_fq, existing_read_k_fastq))
+				if fastq_concat.merge_complete(existing_read_k_fastq, pending):
+					logging.info('The merge of %s into %s had finished' % (run_specific_fq, existing_read_k_fastq))
+					if manifest:
+						manifest.rename(new_read_fastq, run_specific_fq)
+						manifest.set(existing_read_k_fastq, checksums.file_checksums(existing_read_k_fastq))
+					fastq_concat.finish_merge(existing_read_k_fastq)
+					return
+			else:
+				logging.info('There is no new fastq file at %s, and no unfinished merge, so %s is complete' % (new_read_fastq, existing_read_k_fastq))
+				return
+			if manifest:
+				manifest.rename(new_read_fastq, run_specific_fq)
+
+			try:
+				if os.path.islink(existing_read_k_fastq):
+					# the final fastq is still a link to the first flowcell's fastq.  Copy that (once) into a real file and append the new one.
+					# This goes into a placeholder file first, so an interrupted copy never leaves a partial final fastq.
+					tmpfile = os.path.join(sample_dir, sample_name + '_R'+ k + '_.tmp')
+					checksummer = checksums.Checksummer()
+					fastq_concat.concatenate([os.path.realpath(existing_read_k_fastq), run_specific_fq], tmpfile, sync = True, observers = [checksummer] if manifest else None)
+					logging.info('Renaming: %s ---> %s' % (tmpfile, existing_read_k_fastq))
+					os.rename(tmpfile, existing_read_k_fastq) 
+					if manifest:
+						manifest.set(existing_read_k_fastq, checksummer.result())
+				else:
+					# gzip files can be concatenated, so only the new data needs to be written.  
+					logging.info('Appending %s to %s' % (run_specific_fq, existing_read_k_fastq))
+					fastq_concat.append_with_journal([run_specific_fq], existing_read_k_fastq)
+					if manifest:
+						# MD5 cannot be extended from a stored digest, so the merged file has to be read once here
+						manifest.set(existing_read_k_fastq, checksums.file_checksums(existing_read_k_fastq))
+				fastq_concat.finish_merge(existing_read_k_fastq)
+			except (IOError, OSError) as ex:
+				logging.error('Could not merge %s into %s: %s' % (run_specific_fq, existing_read_k_fastq, ex))
+				sys.exit(1)
 		else:
 			logging.info('No previous fastq files for this sample were found.  Renaming to reflect which run it came from, and symlinking the final fastq')
 			# an existing 'final' fastq file does not exist- simply create a symlink.  This way we retain the original fastq file from each run for the sample.  Renaming
 			# would cause us to lose track of which fastq file corresponds to which run
 			run_specific_fq = os.path.join(sample_dir, sample_name + '_R'+ k +'_.'+ self.config_params_dict.get('flowcell_prefix') + '1.fastq.gz')
-			logging.info('Renaming: %s ---> %s' % (new_read_fastq, run_specific_fq))
-			os.rename(new_read_fastq, run_specific_fq)  
+			if os.path.isfile(new_read_fastq):
+				logging.info('Renaming: %s ---> %s' % (new_read_fastq, run_specific_fq))
+				os.rename(new_read_fastq, run_specific_fq)  
+			elif os.path.isfile(run_specific_fq):
+				# an earlier attempt was interrupted after the rename
+				logging.info('%s was already renamed to %s' % (new_read_fastq, run_specific_fq))
+			else:
+				logging.info('There is no new fastq file at %s' % new_read_fastq)
+				return
 			logging.info('Linking: %s will point at ---> %s' % (existing_read_k_fastq, run_specific_fq))
 			os.symlink(run_specific_fq, existing_read_k_fastq)
+			if manifest:
+				manifest.rename(new_read_fastq, run_specific_fq)
+				manifest.copy(run_specific_fq, existing_read_k_fastq)
 
 
 
-	def merge_with_existing_fastq_files(self):
+	def merge_sample_fastq_files(self, sample_dir):
 		"""
-		This method handles the case where the same sample has been sequenced on multiple flowcells (e.g. for extra-deep sequencing)
-		It looks for existing fastq files in the final directory and concatentates this new fastq file with those, if applicable.  
+		Merges the new fastq files of a single sample (in its final directory) with any from previous flowcells
 		"""
-		logging.info('in merge method')
-		for project_id in self.project_id_list:
-			sample_dirs = [os.path.join(self.target_dir, project_id, d) for d in os.listdir(os.path.join(self.target_dir, project_id)) if d.startswith(self.config_params_dict.get('sample_dir_prefix'))] 
-			logging.info('Sample directories for project %s: %s' % (project_id, sample_dirs))
-			# double check that they are actually directories:
-			sample_dirs = filter( lambda x: os.path.isdir(x), sample_dirs)
+		logging.info('Looking for previous fastq files to merge with in directory: %s' % sample_dir)
+		self.merge_and_rename_fastq(sample_dir, 1)
+		# any R2 file (not only a new one), since an interrupted attempt may have renamed the new R2 fastq already
+		if len(glob.glob(os.path.join(sample_dir, '*_R2_.*fastq.gz'))) > 0:
+			logging.info('Found paired fastq files to merge with as well in dir: %s' % sample_dir)
+			self.merge_and_rename_fastq(sample_dir, 2)
 
-			# the directories above are ALL the sample directories for this project.  
-			# We only have to worry about merging with older fastq files for the samples sequenced in the current run
-			samples_from_current_run = self.project_to_sample_map.get(project_id)
 
-			for sample_dir in sample_dirs:
-				sample_name = os.path.basename(sample_dir)[len(self.config_params_dict.get('sample_dir_prefix')):]
-				if sample_name in samples_from_current_run:
-					logging.info('Looking for previous fastq files to merge with in directory: %s' % sample_dir)
-					self.merge_and_rename_fastq(sample_dir, 1)
-					if len(glob.glob(os.path.join(sample_dir, '*_R2_.' + self.config_params_dict.get('tmp_fastq_tag') + '.fastq.gz'))) > 0:
-						logging.info('Found paired fastq files to merge with as well in dir: %s' % sample_dir)
-						self.merge_and_rename_fastq(sample_dir, 2)
-
-
-
-	def write_project_descriptor(self):
-		logging.info('Starting writing of project descriptor file(s)')
-		for project_id in self.project_to_email_mapping.keys():
-			project_dir = os.path.join(self.target_dir, project_id)
-			descriptor_filepath = os.path.join(project_dir, self.config_params_dict['project_descriptor'])
-			with open(descriptor_filepath, 'w') as fout:
-				logging.info('Writing project descriptor to %s' % descriptor_filepath)
-				d = {}
-				d['project_id'] = project_id
-				d['client_emails'] = self.project_to_email_mapping[project_id]
-				logging.info('Descriptor contents: %s' % d)
-				json.dump(d, fout)
-				logging.info('Done writing to json file')
-			logging.info('file closed, moving onto next project')
-		logging.info('completed projects')
-
-
-	def upload_to_remote(self):
-		logging.info('About to upload to cloud storage')
-		project_to_bucket_mapping = {}
-		for project_id in self.project_to_email_mapping.keys():
-			project_dir = os.path.join(self.target_dir, project_id)
-			logging.info('Uploading project directory at: %s' % project_dir)
-			attempt = 0
-			logging.info('Max attempts: %s' % int(self.config_params_dict['max_cloud_upload_attempts']))
-			while attempt < int(self.config_params_dict['max_cloud_upload_attempts']):
-				logging.info('Upload attempt %s' % (attempt + 1))
-				try:
-					bucket_name, client_emails = demux_cloud_upload.entry_method(project_dir, self.config_params_dict)
-					project_to_bucket_mapping.update({project_id: {'bucket': bucket_name, 'client_emails': client_emails}}) 
-
-					break
-				except Exception as ex:
-					logging.error('Cloud upload attempt %s failed.' % (attempt + 1))
-					logging.error('Exception message: %s' % ex.message)
-					attempt += 1
-		self.project_to_bucket_mapping = project_to_bucket_mapping
-		
+
+	def write_project_descriptor_file(self, project_id):
+		project_dir = os.path.join(self.target_dir, project_id)
+		descriptor_filepath = os.path.join(project_dir, self.config_params_dict['project_descriptor'])
+		with open(descriptor_filepath, 'w') as fout:
+			logging.info('Writing project descriptor to %s' % descriptor_filepath)
+			d = {}
+			d['project_id'] = project_id
+			d['client_emails'] = self.project_to_email_mapping[project_id]
+			logging.info('Descriptor contents: %s' % d)
+			json.dump(d, fout)
+			logging.info('Done writing to json file')
+
+
+	def upload_project(self, project_id):
+		"""
+		Uploads a single project directory, retrying up to max_cloud_upload_attempts times.  
+		Returns a dict with the bucket name and client emails, or None if all attempts failed
+		"""
+		project_dir = os.path.join(self.target_dir, project_id)
+		logging.info('Uploading project directory at: %s' % project_dir)
+		attempt = 0
+		logging.info('Max attempts: %s' % int(self.config_params_dict['max_cloud_upload_attempts']))
+		while attempt < int(self.config_params_dict['max_cloud_upload_attempts']):
+			logging.info('Upload attempt %s' % (attempt + 1))
+			try:
+				bucket_name, client_emails = demux_cloud_upload.entry_method(project_dir, self.config_params_dict)
+				return {'bucket': bucket_name, 'client_emails': client_emails}
+			except Exception as ex:
+				logging.error('Cloud upload attempt %s failed.' % (attempt + 1))
+				logging.error('Exception message: %s' % ex.message)
+				attempt += 1
+		return None
+
+
+	def process_samples(self):
+		"""
+		Runs the per-sample steps (concatenate -> merge -> fastQC, and a preview QC) and the per-project steps (project descriptor -> upload)
+		as a dependency graph, so each sample moves through its steps independently of the others, and each project is 
+		uploaded as soon as its own samples are done.  Each task is checkpointed as it completes.
+		"""
+		prefix = self.config_params_dict.get('sample_dir_prefix')
+		if not hasattr(self, 'lane_specific_fastq_mapping'):
+			self.lane_specific_fastq_mapping = {}
+		if not hasattr(self, 'project_to_bucket_mapping'):
+			self.project_to_bucket_mapping = {}
+
+		def is_complete(task_name):
+			# a checkpoint from a run which completed the whole stage (e.g. 'fastqc') covers all of that stage's tasks
+			return task_name in self.completed_stages or task_name.split(':')[0] in self.completed_stages
+
+		preview = int(self.config_params_dict.get('preview_reads', 0)) > 0
+		if self.config_params_dict.get('qc_backend', 'fastqc') == 'native':
+			# the QC processes are forked now, before the executor's threads start (see qc_engine.process_pool)
+			qc_engine.process_pool(int(self.config_params_dict.get('fastqc_workers', 1)))
+		executor = stage_executor.StageExecutor(int(self.config_params_dict.get('pipeline_workers', 1)))
+		for project_id in self.project_id_list:
+			fastqc_tasks = []
+			for sample_name in self.project_to_sample_map[project_id]:
+				demux_sample_dir = os.path.join(self.config_params_dict.get('demux_output_dir'), project_id, prefix + sample_name)
+				final_sample_dir = os.path.join(self.target_dir, project_id, prefix + sample_name)
+				concatenate_task = 'concatenate:%s:%s' % (project_id, sample_name)
+				merge_task = 'merge:%s:%s' % (project_id, sample_name)
+				fastqc_task = 'fastqc:%s:%s' % (project_id, sample_name)
+				executor.add(concatenate_task, self.concatenate_sample_fastq_files, (project_id, demux_sample_dir), completed = is_complete(concatenate_task))
+				executor.add(merge_task, self.merge_sample_fastq_files, (final_sample_dir,), [concatenate_task], completed = is_complete(merge_task))
+				executor.add(fastqc_task, self.run_fastqc_for_sample, (project_id, sample_name), [merge_task], completed = is_complete(fastqc_task))
+				if preview:
+					# a quick QC of a subsample, which runs alongside the full QC and is replaced by it
+					preview_task = 'preview:%s:%s' % (project_id, sample_name)
+					executor.add(preview_task, self.preview_sample, (project_id, sample_name), [merge_task], completed = is_complete(preview_task) or is_complete(fastqc_task))
+				fastqc_tasks.append(fastqc_task)
+			descriptor_task = 'project_descriptor:%s' % project_id
+			upload_task = 'upload:%s' % project_id
+			executor.add(descriptor_task, self.write_project_descriptor_file, (project_id,), fastqc_tasks, completed = is_complete(descriptor_task))
+			executor.add(upload_task, self.upload_project, (project_id,), [descriptor_task], completed = is_complete(upload_task) or project_id in self.project_to_bucket_mapping)
+
+		def on_complete(task_name, result):
+			fields = task_name.split(':')
+			if fields[0] == 'concatenate':
+				sample_name, lane_specific_fastq_files = result
+				self.lane_specific_fastq_mapping.setdefault(fields[1], {})[sample_name] = lane_specific_fastq_files
+			elif fields[0] == 'upload':
+				if result is None:
+					# do not checkpoint, so a resume will retry the project
+					logging.error('Upload of project %s failed' % fields[1])
+					return
+				self.project_to_bucket_mapping[fields[1]] = result
+			Pipeline.write_checkpoint(self, task_name)
+
+		failed_tasks = executor.run(on_complete)
+		if len(failed_tasks) > 0:
+			logging.error('The following tasks failed or could not run: %s' % failed_tasks)
+			sys.exit(1)
+
 
 
 class NextSeqPipeline(Pipeline):
 	
-	def __init__(self, run_directory_path):
+	def __init__(self, run_directory_path, resume = False, demux_backend = None):
 		self.run_directory_path = run_directory_path
 		self.instrument = 'nextseq'
+		self.resume = resume
+		self.demux_backend = demux_backend
+		self.completed_stages = []
 
 	def run(self):
 		Pipeline.parse_config_file(self)
+		if self.resume:
+			Pipeline.load_checkpoint(self)
+		if int(self.config_params_dict.get('preflight_checks', 0)):
+			Pipeline.run_preflight_checks(self)
 		Pipeline.create_output_directory(self)
 
 		try:
@@ -468,26 +794,33 @@ class NextSeqPipeline(Pipeline):
 			logging.error('Message: ' % ex.message)
 			raise ex
 
-		# actually start the demux process:
-		Pipeline.run_demux(self)
-	
-		# sets up the directory structure for the final, merged fastq files.
-		Pipeline.create_final_locations(self)
+		# the stages, in order.  Each writes a checkpoint when it completes, so a resumed run starts at the first incomplete stage
+		stages = [
+			# actually start the demux process:
+			('demux', Pipeline.run_demux),
 
-		# the NextSeq has each sample in multiple lanes- concat those
-		Pipeline.concatenate_and_move_fastq_files(self)
+			# report on the reads which could not be assigned to a sample (e.g. barcode typos, index hopping)
+			('undetermined_analysis', Pipeline.analyze_undetermined),
 
-		# handle concatenation of these new fastq files with those that may already exist (in the case of same sample on multiple flowcells)
-		logging.info('try merge')
-		Pipeline.merge_with_existing_fastq_files(self)
-	
-		# run the fastQC process:
-		Pipeline.run_fastqc(self)
+			# sets up the directory structure for the final, merged fastq files.
+			('create_final_locations', Pipeline.create_final_locations),
 
-		# write a project descriptor file, which can be used by other processes
-		Pipeline.write_project_descriptor(self)
-		
-		Pipeline.upload_to_remote(self)
+			# concatenate the lanes, merge with previous flowcells, run fastQC, write the project descriptors, and upload.
+			# These run per-sample/per-project as a dependency graph (and checkpoint themselves per task)
+			('process_samples', Pipeline.process_samples)
+		]
+
+		for stage, method in stages:
+			if stage in self.completed_stages:
+				logging.info('Skipping stage "%s", which completed previously' % stage)
+				continue
+			logging.info('Starting stage "%s"' % stage)
+			method(self)
+			if stage == 'process_samples' and set(self.project_to_bucket_mapping.keys()) != set(self.project_to_email_mapping.keys()):
+				# do not mark the upload as complete, so a resume will retry the projects that failed
+				logging.error('Not all projects were uploaded.  Uploaded: %s' % self.project_to_bucket_mapping.keys())
+				continue
+			Pipeline.write_checkpoint(self, stage)
 
 
 	def line_is_valid(self, line, header_dict):
@@ -496,94 +829,48 @@ class NextSeqPipeline(Pipeline):
 		that the Samplesheet.csv has the correct formatting for our pipelines.
 		Returns a boolean: True is all the fields are within guidelines, otherwise False
 		"""
-		elements = line.split(',')
-
-		# establish a greedy regex for only letters, numbers, and underscores.  No other characters allowed.
-		pattern = re.compile('[a-z0-9_]+', re.IGNORECASE)
-
-		try:
-			tests = []
-			tests.append(pattern.match(elements[header_dict['Sample_Name']]).group() == elements[header_dict['Sample_Name']]) # if the greedy regex did not match the sample name, then there is some character exception
-			tests.append(elements[header_dict['Sample_ID']].startswith(self.config_params_dict.get('sample_dir_prefix'))) # check that the Sample_ID field has the proper prefix
-			tests.append(elements[header_dict['Sample_ID']][len(self.config_params_dict.get('sample_dir_prefix')):] == elements[header_dict['Sample_Name']]) # check that the sample names match between the first and second fields
-			#tests.append(len(elements[5]) == 7) # check that 7bp index was provided
-			tests.append(pattern.match(elements[header_dict['Sample_Project']]).group() == elements[header_dict['Sample_Project']]) # if the greedy regex did not match the full project designation then something is wrong.
-			if all(tests):
-				return True
-			else:
-				logging.error('Line was not valid.  Boolean tests are as follows: %s' % tests)
-				return False
-		except Exception:
+		row = dict([(k, v) for k, v in zip(sorted(header_dict, key = header_dict.get), line.split(','))])
+		problems = samplesheet.row_is_valid(row, self.config_params_dict.get('sample_dir_prefix'))
+		if problems:
+			logging.error('Line was not valid: %s' % problems)
 			return False
+		return True
 
 
 
 	def check_samplesheet(self):
 		"""
-		This method checks for a samplesheet and does a quick check that it is formatted within guidelines (described elsewhere)
+		This method checks for a samplesheet and does a quick check that it is formatted within guidelines (described elsewhere).
+		The index sequences are also checked for collisions, since those would only show up after the demux otherwise.
 		"""
 		samplesheet_path = os.path.join(self.run_directory_path, 'SampleSheet.csv')
 		logging.info('Examining samplesheet at: %s' % samplesheet_path)
 
 		if os.path.isfile(samplesheet_path):
 
-			# the following regex extracts the Header section, which is started by '[Header]'
-			# and continues until it reaches another section (or the end of the file)
-			# re.findall() returns a list-- get the first element
 			try:
-				header_section = re.findall(r'\[Header\][^\[]*', open(samplesheet_path).read())[0]
-				logging.info('header: %s' % header_section)
-			except IndexError:
-				logging.error('Could not find the [Header] section in the file: %s' % samplesheet_path)
+				sheet = samplesheet.SampleSheet(samplesheet_path)
+			except samplesheet.SampleSheetFormatError as ex:
+				logging.error('%s in the file: %s' % (ex, samplesheet_path))
 				sys.exit(1)
+			logging.info('header: %s' % sheet.header)
 
-			line_list = [line.rstrip('\r') for line in header_section.split('\n') if len(line)>0]
-			project_to_email_mapping = {}
-			for line in line_list:
-				if line.startswith('Email'):
-					contents = line.split(',')
-					project_id = contents[1].strip()
-					emails = [x.strip() for x in contents[2:] if len(x) > 0]
-					if project_id in project_to_email_mapping:
-						project_to_email_mapping[project_id].extend(emails)
-					else:
-						project_to_email_mapping[project_id] = emails
+			project_to_email_mapping = sheet.emails
 			logging.info('Contacts from sampleSheet: %s' % project_to_email_mapping)
 			self.project_to_email_mapping = project_to_email_mapping
 			if len(project_to_email_mapping.keys()) == 0:
 				raise MissingContactException('No contacts parsed for samplesheet: %s' % samplesheet_path)
 
-			# the following regex extracts the sample annotation section, which is started by '[Data]'
-			# and continues until it reaches another section (or the end of the file)
-			# re.findall() returns a list-- get the first element
-			try:
-				sample_annotation_section = re.findall(r'\[Data\][^\[]*', open(samplesheet_path).read())[0]
-			except IndexError:
-				logging.error('Could not find the [Data] section in the SampleSheet.csv file')
-				sys.exit(1)
-	 
-			line_list = [line.rstrip('\r') for line in sample_annotation_section.split('\n') if len(line)>0]
-
-			# in the case of dual-indexed SampleSheet.csv, should use the headers to locate the necessary fields to check (instead of using expected positioning on the line)
-			header_line = line_list[1]
-			header_dict = {s:p for p,s in enumerate(header_line.split(','))}
-
-
-			# this statement gets us a list, where each item in the list is the annotation line in the sample sheet.  
-			# The [2:] index removes the '[Data]' and the line with the field headers 
-			# Also strips off any Windows/Mac endline characters ('\r') if present
-			annotation_lines = line_list[2:]
-
-			# a list of True/False on whether the sample annotation line is valid
-			lines_valid = [self.line_is_valid(line, header_dict) for line in annotation_lines]
-			if not all(lines_valid):
-				problem_lines = [i+1 for i,k in enumerate(lines_valid) if k == False]
+			invalid_rows = sheet.invalid_rows(self.config_params_dict.get('sample_dir_prefix'))
+			if len(invalid_rows) > 0:
+				problem_lines = [i for i, problems in invalid_rows]
 				logging.error('There was some problem with the SampleSheet.csv')
-				logging.error('Problem lines: %s' % problem_lines)
+				for i, problems in invalid_rows:
+					logging.error('Problem line %d: %s' % (i, '; '.join(problems)))
 				raise SampleSheetException('Check lines (%s) for errors. ' % problem_lines)
 
 			# now get a list of all the projects that we are processing in this sampling run:
-			project_id_list = list(set([line.split(',')[header_dict['Sample_Project']] for line in annotation_lines]))
+			project_id_list = list(sheet.project_ids())
 
 			logging.info('The following projects were identified from the SampleSheet.csv: %s' % project_id_list)
 			self.project_id_list = project_id_list
@@ -595,17 +882,19 @@ class NextSeqPipeline(Pipeline):
 				logging.error('There was a likely error in parsing the email contacts for each project.')
 				logging.error('Namely, the set of project IDs from the Email fields (%s) did not match those from the sample annotation section (%s).' % (self.project_to_email_mapping.keys(), self.project_id_list))
 				sys.exit(1)
-	
-			# get the sample names for later use.  Put them into a map, keyed by the project id
-			sample_id_map = { p:[] for p in project_id_list }
-			for l in annotation_lines:
-				contents = l.split(',')
-				sample_id_map[contents[header_dict['Sample_Project']]].append(contents[header_dict['Sample_Name']])
 
-			# ensure that we have a unique set of samples for each project id:
-			for k, vals in sample_id_map.iteritems():
-				sample_id_map[k] = list(set(vals))
+			# samples whose indexes are too close together cannot be told apart by the demux
+			collisions = sheet.index_collisions(int(self.config_params_dict.get('min_index_distance', 3)))
+			if len(collisions) > 0:
+				descriptions = ['%s and %s%s (%d mismatches)' % (a, b, ' in lane %s' % lane if lane else '', d) for lane, a, b, d in collisions]
+				logging.error('Index collisions in the SampleSheet.csv: %s' % descriptions)
+				raise SampleSheetException('The index sequences of these samples are too similar to demultiplex: %s' % ', '.join(descriptions))
+
+			# keep the full sample annotation (as dicts keyed by the field headers), e.g. for the index sequences
+			self.samplesheet_rows = sheet.rows
 
+			# get the sample names for later use, keyed by the project id
+			sample_id_map = sheet.project_samples(self.config_params_dict.get('sample_dir_prefix'))
 			logging.info('The following projects and associated samples are:')
 			logging.info(sample_id_map)
 
@@ -0,0 +1,195 @@
+"""
+Quick checks, made before the demux starts, for the problems which would otherwise only show up hours into a run:
+	- not enough free space for the demux output (in the run directory) and the final fastq files (destination_path).
+	  The size of the output is estimated from RunInfo.xml: the cycles of all the reads, times the number of clusters
+	  (estimated per tile), times the number of tiles in all the lanes, times the (compressed) bytes per base.
+	- output locations which cannot be written to
+	- missing tools (the demultiplexer, fastQC, and gsutil if it is the upload engine)
+	- a missing or unreadable credential file for the cloud storage, or (with the native upload engine, which uses the
+	  storage API directly) no way to get an access token
+Nothing here reads the sequencing data, so the checks take seconds.
+"""
+
+import os
+import json
+import logging
+import tempfile
+from distutils.spawn import find_executable
+
+import run_info
+import cloud_uploader
+
+GIGABYTE = 1024 ** 3
+
+
+def estimate_output_bytes(info, clusters_per_tile, bytes_per_base):
+	"""
+	Estimates the size of the (gzipped) fastq files from the run, given the parsed RunInfo.xml
+	"""
+	tiles = info['lane_count'] * info['surface_count'] * info['swath_count'] * info['tile_count']
+	cycles = sum([r['cycles'] for r in info['reads']])
+	return int(tiles * clusters_per_tile * cycles * bytes_per_base)
+
+
+def existing_ancestor(path):
+	"""
+	Returns the path, or its nearest parent which exists (for paths which are yet to be created)
+	"""
+	path = os.path.abspath(path)
+	while not os.path.exists(path) and os.path.dirname(path) != path:
+		path = os.path.dirname(path)
+	return path
+
+
+def free_bytes(path):
+	st = os.statvfs(existing_ancestor(path))
+	return st.f_bavail * st.f_frsize
+
+
+def device(path):
+	return os.stat(existing_ancestor(path)).st_dev
+
+
+def check_space(requirements, min_free_bytes = 0):
+	"""
+	requirements is a list of (path, bytes needed).  The requirements of paths on the same filesystem are added up,
+	and each filesystem must also keep min_free_bytes free.  Returns a list of problems.
+	"""
+	needed = {}
+	paths = {}
+	for path, size in requirements:
+		d = device(path)
+		needed[d] = needed.get(d, 0) + size
+		paths.setdefault(d, []).append(path)
+	problems = []
+	for d, size in needed.items():
+		available = free_bytes(paths[d][0])
+		if available < size + min_free_bytes:
+			problems.append('Not enough space for %s: %.1f GB needed (plus %.1f GB to keep free), %.1f GB available'
+					% (', '.join(paths[d]), float(size) / GIGABYTE, float(min_free_bytes) / GIGABYTE, float(available) / GIGABYTE))
+	return problems
+
+
+def check_writable(path):
+	"""
+	Tries to create (and remove) a file in the path, or in its nearest existing parent if it is yet to be created.
+	This is more reliable than os.access on network filesystems.  Returns a list of problems.
+	"""
+	directory = existing_ancestor(path)
+	try:
+		fd, tmp = tempfile.mkstemp(prefix = '.preflight', dir = directory)
+		os.close(fd)
+		os.remove(tmp)
+	except (IOError, OSError) as ex:
+		return ['Cannot write to %s (for %s): %s' % (directory, path, ex)]
+	return []
+
+
+def check_executable(name, path):
+	"""
+	Checks that the tool given by a path in the config exists and can be run.  Returns a list of problems.
+	"""
+	path = (path or '').strip()
+	if not path:
+		return ['No path is given for %s in the configuration' % name]
+	if not os.path.isfile(path) or not os.access(path, os.X_OK):
+		return ['%s was not found (or is not executable) at %s' % (name, path)]
+	return []
+
+
+def check_on_path(command):
+	if find_executable(command) is None:
+		return ['%s was not found on the PATH' % command]
+	return []
+
+
+def check_credentials(credential_file):
+	"""
+	Checks that the credential file for the cloud storage can be read, and has the fields used by the upload
+	(see demux_cloud_upload.read_credentials).  Returns a list of problems.
+	"""
+	if not credential_file:
+		return ['No credential file is given in the configuration']
+	try:
+		j = json.load(open(credential_file))
+	except (IOError, ValueError) as ex:
+		return ['Could not read the credential file at %s: %s' % (credential_file, ex)]
+	missing = [k for k in ['client_id', 'secret'] if k not in j]
+	if missing:
+		return ['The credential file at %s is missing %s' % (credential_file, ', '.join(missing))]
+	return []
+
+
+def check_access_token(token_command):
+	"""
+	Checks that an access token for the storage API can be had (see cloud_uploader.AccessToken).  Returns a list of problems.
+	"""
+	try:
+		cloud_uploader.AccessToken(token_command).fetch()
+	except Exception as ex:
+		return ['Could not get an access token for the cloud storage: %s' % ex]
+	return []
+
+
+def run_checks(run_directory_path, params, cloud_params, completed_stages = (), demux_backend = None):
+	"""
+	Makes all the checks for the stages of the run which have not yet completed.  params are the [DEMUX] parameters and
+	cloud_params the [CLOUD] parameters from the configuration.  demux_backend overrides the one in params.
+	Returns a list of problems (empty if there are none).
+	"""
+	problems = []
+	demux_pending = 'demux' not in completed_stages
+	process_pending = 'process_samples' not in completed_stages
+	demux_output_dir = os.path.join(run_directory_path, params.get('demux_output_dir'))
+	destination_path = params.get('destination_path')
+	delivery_home = params.get('delivery_home')
+
+	# space
+	try:
+		info = run_info.parse_run_info(run_directory_path)
+		estimate = estimate_output_bytes(info,
+						float(params.get('preflight_clusters_per_tile', 1500000)),
+						float(params.get('preflight_bytes_per_base', 0.6)))
+		logging.info('Estimated size of the fastq files from the run: %.1f GB' % (float(estimate) / GIGABYTE))
+	except run_info.RunInfoException as ex:
+		logging.warning('Could not estimate the size of the output, so the free space is not checked: %s' % ex)
+		estimate = None
+	if estimate is not None:
+		requirements = []
+		if demux_pending:
+			requirements.append((demux_output_dir, estimate))
+		if process_pending:
+			# the concatenated fastq files, and the lane-specific files, which are copied (rather than just renamed)
+			# if the destination is on a different filesystem than the demux output
+			requirements.append((destination_path, estimate))
+			if device(destination_path) != device(demux_output_dir):
+				requirements.append((destination_path, estimate))
+			# only symlinks go into the delivery directory
+			requirements.append((delivery_home, 0))
+		problems.extend(check_space(requirements, float(params.get('preflight_min_free_gb', 1)) * GIGABYTE))
+
+	# write permissions
+	locations = []
+	if demux_pending:
+		locations.append(demux_output_dir)
+	if process_pending:
+		locations.extend([destination_path, delivery_home])
+	for path in locations:
+		problems.extend(check_writable(path))
+
+	# tools
+	if demux_pending:
+		backend = demux_backend or params.get('demux_backend', 'bcl2fastq')
+		if backend == 'bcl2fastq':
+			problems.extend(check_executable('bcl2fastq', params.get('demux_path')))
+		elif backend == 'bcl-convert':
+			problems.extend(check_executable('bcl-convert', params.get('bcl_convert_path')))
+	if process_pending:
+		if params.get('qc_backend', 'fastqc') != 'native':
+			problems.extend(check_executable('fastQC', params.get('fastqc_path')))
+		problems.extend(check_credentials(cloud_params.get('credential_file')))
+		if cloud_params.get('upload_engine', 'gsutil') == 'native':
+			problems.extend(check_access_token(cloud_params.get('access_token_command', 'gcloud auth print-access-token')))
+		else:
+			problems.extend(check_on_path('gsutil'))
+	return problems
@@ -15,6 +15,7 @@ import subprocess
 import cloud_delivery_tracking
 import utils
 import parse_fastqc_data
+import permissions
 
 # names of the machines for global reference:
 AVAILABLE_INSTRUMENTS = ['nextseq',]
@@ -23,7 +24,7 @@ AVAILABLE_INSTRUMENTS = ['nextseq',]
 def process():
 
 	# kickoff the processing:
-	run_directory_path, recipients, instrument, log_dir = parse_commandline_args()
+	run_directory_path, recipients, instrument, log_dir, resume, demux_backend = parse_commandline_args()
 
 	timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
 	if log_dir:
@@ -38,8 +39,11 @@ def process():
 		logging.error('The path to the run directory (%s) was not valid.' % run_directory_path)
 		sys.exit(1)
 
+	# new files and directories are group-writable from the start, so fewer of them need fixing later
+	permissions.set_creation_umask()
+
 	if instrument == 'nextseq':
-		p = pipeline.NextSeqPipeline(run_directory_path)
+		p = pipeline.NextSeqPipeline(run_directory_path, resume, demux_backend)
 	else:
 		logging.error('Processing logic not implemented for this instrument.  Exiting')
 		sys.exit(1)
@@ -105,6 +109,8 @@ def process():
 	# track this data so we don't store it forever:
 	cloud_delivery_tracking.main(p.project_to_bucket_mapping)
 
+	logging.info(permissions.summary())
+
 
 def parse_commandline_args():
 	"""
@@ -136,8 +142,19 @@ def parse_commandline_args():
 				help = 'Directory in which to write the logfile.  Defaults to the run directory (-r) arg.',
 				dest = 'log_dir')
 
+	parser.add_argument('--resume',
+				action = 'store_true',
+				help = 'Restart a previously interrupted run at the first processing stage that did not complete (uses the checkpoint file in the run directory).',
+				dest = 'resume')
+
+	parser.add_argument('--demux-backend',
+				required = False,
+				choices = ['bcl2fastq', 'bcl-convert', 'undetermined'],
+				help = 'The demultiplexer to use.  Overrides demux_backend in the config file.',
+				dest = 'demux_backend')
+
 	args = parser.parse_args()
-	return (args.run_directory, args.recipients, args.instrument, args.log_dir)
+	return (args.run_directory, args.recipients, args.instrument, args.log_dir, args.resume, args.demux_backend)
 
 
 def write_html_links(delivery_links, external_url, internal_drop_location):
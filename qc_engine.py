@@ -0,0 +1,492 @@
+"""
+A native QC engine, as an alternative to fastQC.
+
+fastQC starts a JVM for each invocation and reads each file end to end in a single thread.  Here the fastq files are
+inflated in large blocks, and each block of records is turned into 2D numpy arrays (reads x positions) of base codes
+and quality scores, so all the statistics are accumulated with array operations instead of per-read code.
+
+The output is a directory next to the fastq file, named as fastQC would name it, with a fastqc_data.txt in fastQC's
+format (so parse_fastqc_data.parse reads it as it would a fastQC report), a summary.txt and a simple HTML report.
+The module statuses (pass/warn/fail) use fastQC's default thresholds.  Unlike fastQC, each base position is reported
+separately rather than in groups, and overrepresented sequences are counted over the first OVERREPRESENTED_SAMPLE reads.
+
+The statistics are all counts (histograms and count matrices), so those of several files can be added together.  The
+statistics of each flowcell-specific fastq file are stored next to it, and the report for a sample sequenced on several
+flowcells is made by merging those, so only the new flowcell's data has to be read (see run).
+"""
+
+import os
+import zlib
+import math
+import collections
+import multiprocessing
+import threading
+import numpy as np
+
+import fastqc_runner
+
+VERSION = '0.11.5'
+
+NEWLINE = ord('\n')
+PHRED_OFFSET = 33
+MAX_QUALITY = 93
+
+# the base codes.  INVALID marks the positions past the end of a read
+BASES = 'ACGTN'
+INVALID = len(BASES)
+BASE_CODES = np.zeros(256, dtype=np.uint8) + BASES.index('N')
+for i, b in enumerate(BASES):
+	BASE_CODES[ord(b)] = i
+	BASE_CODES[ord(b.lower())] = i
+A, C, G, T, N = range(len(BASES))
+
+# the amount of compressed data read at once, and the most decompressed data handled at once
+READ_SIZE = 4*1024*1024
+INFLATE_SIZE = 16*1024*1024
+
+OVERREPRESENTED_SAMPLE = 100000
+# as fastQC does, long reads are truncated to this length before counting duplicates
+OVERREPRESENTED_LENGTH = 50
+
+PASS, WARN, FAIL = 'pass', 'warn', 'fail'
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def split_records(text):
+	"""
+	Finds the complete fastq records in text.  Returns (the text as a numpy array, the line starts, the line ends, the
+	remaining text after the last complete record).  The line ends are the positions of the newlines.
+	"""
+	buf = np.frombuffer(text, dtype=np.uint8)
+	line_ends = np.flatnonzero(buf == NEWLINE)
+	complete_records = len(line_ends) // 4
+	if complete_records == 0:
+		return buf, line_ends[:0], line_ends[:0], text
+	end = line_ends[4*complete_records - 1] + 1
+	line_ends = line_ends[:4*complete_records]
+	line_starts = np.concatenate([[0], line_ends[:-1] + 1])
+	return buf, line_starts, line_ends, text[end:]
+
+
+class QCStats(object):
+	"""
+	Accumulates the statistics over (uncompressed) fastq text passed to update(), which need not be split on record boundaries
+	"""
+	def __init__(self):
+		self.carry = ''
+		self.reads = 0
+		self.position_quality = np.zeros((0, MAX_QUALITY + 1), dtype=np.int64)
+		self.position_bases = np.zeros((0, len(BASES)), dtype=np.int64)
+		self.sequence_quality = np.zeros(MAX_QUALITY + 1, dtype=np.int64)
+		self.sequence_gc = np.zeros(101, dtype=np.int64)
+		self.lengths = np.zeros(0, dtype=np.int64)
+		self.sequences = collections.Counter()
+		self.sampled = 0
+
+	def grow(self, length):
+		if length > len(self.position_quality):
+			extra = length - len(self.position_quality)
+			self.position_quality = np.vstack([self.position_quality, np.zeros((extra, MAX_QUALITY + 1), dtype=np.int64)])
+			self.position_bases = np.vstack([self.position_bases, np.zeros((extra, len(BASES)), dtype=np.int64)])
+
+	def merge(self, other):
+		"""
+		Adds the statistics of another file (e.g. another flowcell's data for the same sample)
+		"""
+		self.grow(len(other.position_quality))
+		self.position_quality[:len(other.position_quality)] += other.position_quality
+		self.position_bases[:len(other.position_bases)] += other.position_bases
+		self.sequence_quality += other.sequence_quality
+		self.sequence_gc += other.sequence_gc
+		if len(other.lengths) > len(self.lengths):
+			self.lengths = np.concatenate([self.lengths, np.zeros(len(other.lengths) - len(self.lengths), dtype=np.int64)])
+		self.lengths[:len(other.lengths)] += other.lengths
+		self.sequences.update(other.sequences)
+		self.sampled += other.sampled
+		self.reads += other.reads
+
+	def save(self, path, source_size, source_mtime):
+		"""
+		Saves the statistics, with the size and modification time of the file they came from (to detect a changed file)
+		"""
+		sequences = self.sequences.items()
+		tmp_path = path + '.tmp.npz'
+		np.savez(tmp_path,
+			position_quality = self.position_quality,
+			position_bases = self.position_bases,
+			sequence_quality = self.sequence_quality,
+			sequence_gc = self.sequence_gc,
+			lengths = self.lengths,
+			sequence_keys = np.array([k for k, c in sequences], dtype = 'S'),
+			sequence_counts = np.array([c for k, c in sequences], dtype = np.int64),
+			counts = np.array([self.reads, self.sampled, source_size], dtype = np.int64),
+			source_mtime = np.array([source_mtime]))
+		os.rename(tmp_path, path)
+
+	@staticmethod
+	def load(path):
+		"""
+		Returns (stats, source size, source modification time)
+		"""
+		data = np.load(path)
+		stats = QCStats()
+		stats.position_quality = data['position_quality']
+		stats.position_bases = data['position_bases']
+		stats.sequence_quality = data['sequence_quality']
+		stats.sequence_gc = data['sequence_gc']
+		stats.lengths = data['lengths']
+		stats.sequences = collections.Counter(dict(zip(data['sequence_keys'].tolist(), data['sequence_counts'].tolist())))
+		stats.reads, stats.sampled, source_size = [int(x) for x in data['counts']]
+		return stats, source_size, float(data['source_mtime'][0])
+
+	def update(self, text):
+		buf, line_starts, line_ends, self.carry = split_records(self.carry + text)
+		if len(line_starts) > 0:
+			self.add_records(buf, line_starts[1::4], line_ends[1::4] - line_starts[1::4], line_starts[3::4])
+
+	def add_records(self, buf, seq_starts, lengths, quality_starts):
+		n = len(lengths)
+		max_length = int(lengths.max())
+		self.grow(max_length)
+		positions = np.arange(max_length)
+		valid = positions[np.newaxis, :] < lengths[:, np.newaxis]
+		last = len(buf) - 1
+		seq = np.where(valid, BASE_CODES[buf[np.minimum(seq_starts[:, np.newaxis] + positions, last)]], INVALID)
+		quality = buf[np.minimum(quality_starts[:, np.newaxis] + positions, last)].astype(np.int64) - PHRED_OFFSET
+		quality = np.where(valid, np.clip(quality, 0, MAX_QUALITY), 0)
+
+		# per-position counts.  The invalid positions go into an extra column which is dropped
+		position_index = np.broadcast_to(positions, seq.shape)
+		bases = np.bincount((position_index * (len(BASES) + 1) + seq).ravel(), minlength = max_length * (len(BASES) + 1))
+		self.position_bases[:max_length] += bases.reshape(max_length, len(BASES) + 1)[:, :len(BASES)]
+		quality_index = np.where(valid, position_index * (MAX_QUALITY + 1) + quality, max_length * (MAX_QUALITY + 1))
+		qualities = np.bincount(quality_index.ravel(), minlength = max_length * (MAX_QUALITY + 1) + 1)[:-1]
+		self.position_quality[:max_length] += qualities.reshape(max_length, MAX_QUALITY + 1)
+
+		# per-read values
+		safe_lengths = np.maximum(lengths, 1)
+		mean_quality = quality.sum(axis = 1) // safe_lengths
+		self.sequence_quality += np.bincount(mean_quality, minlength = MAX_QUALITY + 1)[:MAX_QUALITY + 1]
+		gc = ((seq == G) | (seq == C)).sum(axis = 1)
+		called = ((seq != N) & (seq != INVALID)).sum(axis = 1)
+		gc_percent = np.round(100.0 * gc / np.maximum(called, 1)).astype(np.int64)
+		self.sequence_gc += np.bincount(gc_percent[called > 0], minlength = 101)
+		length_counts = np.bincount(lengths)
+		if len(length_counts) > len(self.lengths):
+			self.lengths = np.concatenate([self.lengths, np.zeros(len(length_counts) - len(self.lengths), dtype=np.int64)])
+		self.lengths[:len(length_counts)] += length_counts
+
+		# sequences for the overrepresented sequences module, from the start of the file only
+		if self.sampled < OVERREPRESENTED_SAMPLE:
+			take = min(n, OVERREPRESENTED_SAMPLE - self.sampled)
+			for start, length in zip(seq_starts[:take], lengths[:take]):
+				if length > 75:
+					length = OVERREPRESENTED_LENGTH
+				self.sequences[buf[start:start + length].tobytes()] += 1
+			self.sampled += take
+		self.reads += n
+
+
+def quantile(histogram, fraction):
+	"""
+	Returns the value at the given fraction of the way through a histogram (indexed by value)
+	"""
+	total = histogram.sum()
+	if total == 0:
+		return 0
+	return int(np.searchsorted(np.cumsum(histogram), fraction * total))
+
+
+def percent(a, b):
+	return 100.0 * a / b if b else 0.0
+
+
+def basic_statistics(stats, filename):
+	lengths = np.flatnonzero(stats.lengths)
+	if len(lengths) == 0:
+		length = '0'
+	elif lengths.min() == lengths.max():
+		length = str(lengths.min())
+	else:
+		length = '%d-%d' % (lengths.min(), lengths.max())
+	totals = stats.position_bases.sum(axis = 0)
+	gc = int(round(percent(totals[G] + totals[C], totals[A] + totals[C] + totals[G] + totals[T])))
+	rows = [('Filename', filename),
+		('File type', 'Conventional base calls'),
+		('Encoding', 'Sanger / Illumina 1.9'),
+		('Total Sequences', stats.reads),
+		('Sequences flagged as poor quality', 0),
+		('Sequence length', length),
+		('%GC', gc)]
+	return PASS, ['#Measure', 'Value'], rows
+
+
+def per_base_quality(stats):
+	rows = []
+	status = PASS
+	for i, h in enumerate(stats.position_quality):
+		total = h.sum()
+		mean = float((h * np.arange(len(h))).sum()) / total if total else 0.0
+		median = quantile(h, 0.5)
+		lower = quantile(h, 0.25)
+		rows.append((i + 1, mean, median, lower, quantile(h, 0.75), quantile(h, 0.1), quantile(h, 0.9)))
+		if lower < 5 or median < 20:
+			status = FAIL
+		elif status == PASS and (lower < 10 or median < 25):
+			status = WARN
+	return status, ['#Base', 'Mean', 'Median', 'Lower Quartile', 'Upper Quartile', '10th Percentile', '90th Percentile'], rows
+
+
+def per_sequence_quality(stats):
+	rows = [(q, c) for q, c in enumerate(stats.sequence_quality) if c > 0]
+	mode = int(stats.sequence_quality.argmax())
+	status = FAIL if mode < 20 else (WARN if mode < 27 else PASS)
+	return status, ['#Quality', 'Count'], rows
+
+
+def per_base_content(stats):
+	rows = []
+	worst = 0.0
+	for i, counts in enumerate(stats.position_bases):
+		total = counts[A] + counts[C] + counts[G] + counts[T]
+		g, a, t, c = [percent(counts[b], total) for b in (G, A, T, C)]
+		rows.append((i + 1, g, a, t, c))
+		worst = max(worst, abs(a - t), abs(g - c))
+	status = FAIL if worst > 20 else (WARN if worst > 10 else PASS)
+	return status, ['#Base', 'G', 'A', 'T', 'C'], rows
+
+
+def per_base_gc(stats):
+	counts = stats.position_bases
+	called = counts[:, A] + counts[:, C] + counts[:, G] + counts[:, T]
+	gc = 100.0 * (counts[:, G] + counts[:, C]) / np.maximum(called, 1)
+	rows = [(i + 1, v) for i, v in enumerate(gc)]
+	deviation = np.abs(gc - gc.mean()).max() if len(gc) else 0.0
+	status = FAIL if deviation > 10 else (WARN if deviation > 5 else PASS)
+	return status, ['#Base', '%GC'], rows
+
+
+def per_sequence_gc(stats):
+	"""
+	Compares the GC distribution to a normal distribution with the same mode and spread, as fastQC does
+	"""
+	h = stats.sequence_gc.astype(np.float64)
+	total = h.sum()
+	rows = [(i, v) for i, v in enumerate(h)]
+	if total == 0:
+		return PASS, ['#GC Content', 'Count'], rows
+	x = np.arange(len(h))
+	mode = h.argmax()
+	stdev = math.sqrt((h * (x - mode)**2).sum() / total) or 1.0
+	theoretical = np.exp(-(x - mode)**2 / (2 * stdev**2))
+	theoretical *= total / theoretical.sum()
+	deviation = percent(np.abs(theoretical - h).sum(), total)
+	status = FAIL if deviation > 30 else (WARN if deviation > 15 else PASS)
+	return status, ['#GC Content', 'Count'], rows
+
+
+def per_base_n_content(stats):
+	counts = stats.position_bases
+	n_percent = 100.0 * counts[:, N] / np.maximum(counts.sum(axis = 1), 1)
+	rows = [(i + 1, v) for i, v in enumerate(n_percent)]
+	worst = n_percent.max() if len(n_percent) else 0.0
+	status = FAIL if worst > 20 else (WARN if worst > 5 else PASS)
+	return status, ['#Base', 'N-Count'], rows
+
+
+def length_distribution(stats):
+	rows = [(length, c) for length, c in enumerate(stats.lengths) if c > 0]
+	if stats.lengths[:1].sum() > 0:
+		status = FAIL
+	elif len(rows) > 1:
+		status = WARN
+	else:
+		status = PASS
+	return status, ['#Length', 'Count'], rows
+
+
+def overrepresented_sequences(stats):
+	rows = []
+	status = PASS
+	for seq, count in stats.sequences.most_common():
+		fraction = percent(count, stats.sampled)
+		if fraction <= 0.1:
+			break
+		rows.append((seq, count, fraction, 'No Hit'))
+		status = FAIL if fraction > 1 else WARN if status == PASS else status
+	return status, ['#Sequence', 'Count', 'Percentage', 'Possible Source'], rows
+
+
+def modules(stats, filename):
+	"""
+	Returns a list of (module name, status, header, rows) in the order fastQC reports them
+	"""
+	return [('Basic Statistics',) + basic_statistics(stats, filename),
+		('Per base sequence quality',) + per_base_quality(stats),
+		('Per sequence quality scores',) + per_sequence_quality(stats),
+		('Per base sequence content',) + per_base_content(stats),
+		('Per base GC content',) + per_base_gc(stats),
+		('Per sequence GC content',) + per_sequence_gc(stats),
+		('Per base N content',) + per_base_n_content(stats),
+		('Sequence Length Distribution',) + length_distribution(stats),
+		('Overrepresented sequences',) + overrepresented_sequences(stats)]
+
+
+def format_value(v):
+	if isinstance(v, (float, np.floating)):
+		return '%s' % round(float(v), 6)
+	return str(v)
+
+
+def write_fastqc_data(results, path):
+	lines = ['##FastQC\t%s' % VERSION]
+	for name, status, header, rows in results:
+		lines.append('>>%s\t%s' % (name, status))
+		lines.append('\t'.join(header))
+		for row in rows:
+			lines.append('\t'.join([format_value(v) for v in row]))
+		lines.append('>>END_MODULE')
+	with open(path, 'w') as fout:
+		fout.write('\n'.join(lines) + '\n')
+
+
+def write_summary(results, filename, path):
+	with open(path, 'w') as fout:
+		for name, status, header, rows in results:
+			fout.write('%s\t%s\t%s\n' % (status.upper(), name, filename))
+
+
+def write_html_report(results, filename, path):
+	html = ['<html><head><title>%s QC report</title></head><body>' % filename, '<h1>%s</h1>' % filename]
+	html.append('<table border="1"><tr><th>Module</th><th>Status</th></tr>')
+	for k, (name, status, header, rows) in enumerate(results):
+		html.append('<tr><td><a href="#m%d">%s</a></td><td>%s</td></tr>' % (k, name, status.upper()))
+	html.append('</table>')
+	for k, (name, status, header, rows) in enumerate(results):
+		html.append('<h2 id="m%d">%s (%s)</h2><table border="1">' % (k, name, status.upper()))
+		html.append('<tr>%s</tr>' % ''.join(['<th>%s</th>' % h.lstrip('#') for h in header]))
+		for row in rows:
+			html.append('<tr>%s</tr>' % ''.join(['<td>%s</td>' % format_value(v) for v in row]))
+		html.append('</table>')
+	html.append('</body></html>')
+	with open(path, 'w') as fout:
+		fout.write('\n'.join(html) + '\n')
+
+
+def iterate_text(fastq_file):
+	"""
+	Yields the decompressed contents of the (gzipped) fastq file in blocks of at most INFLATE_SIZE
+	"""
+	decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	with open(fastq_file, 'rb') as fin:
+		while True:
+			data = fin.read(READ_SIZE)
+			if not data:
+				break
+			while data:
+				yield decompressor.decompress(data, INFLATE_SIZE)
+				data = decompressor.unconsumed_tail
+				# concatenated fastq files have several gzip members
+				if not data and decompressor.unused_data:
+					data = decompressor.unused_data
+					yield decompressor.flush()
+					decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	yield decompressor.flush()
+
+
+def compute(fastq_file):
+	"""
+	Reads the (gzipped) fastq file and returns the QCStats
+	"""
+	stats = QCStats()
+	for text in iterate_text(fastq_file):
+		stats.update(text)
+	return stats
+
+
+def write_report(stats, filename, report_dir):
+	"""
+	Writes fastqc_data.txt, summary.txt and fastqc_report.html into report_dir
+	"""
+	results = modules(stats, filename)
+	if not os.path.isdir(report_dir):
+		os.makedirs(report_dir)
+	write_fastqc_data(results, os.path.join(report_dir, 'fastqc_data.txt'))
+	write_summary(results, filename, os.path.join(report_dir, 'summary.txt'))
+	write_html_report(results, filename, os.path.join(report_dir, 'fastqc_report.html'))
+
+
+def summary_path(fastq_file):
+	"""
+	The stored statistics for a (flowcell-specific) fastq file are kept next to it
+	"""
+	return fastqc_runner.output_dir(fastq_file)[:-len('_fastqc')] + '.qc_summary.npz'
+
+
+def flowcell_stats(fastq_file):
+	"""
+	Returns the statistics of a flowcell-specific fastq file, from its stored summary if that is still current.
+	Otherwise the file is read and the summary stored for next time.
+	"""
+	path = summary_path(fastq_file)
+	st = os.stat(fastq_file)
+	if os.path.isfile(path):
+		try:
+			stats, size, mtime = QCStats.load(path)
+			if size == st.st_size and mtime == st.st_mtime:
+				return stats
+		except (IOError, KeyError, ValueError):
+			pass
+	stats = compute(fastq_file)
+	stats.save(path, st.st_size, st.st_mtime)
+	return stats
+
+
+def run(fastq_file, parts = None):
+	"""
+	Runs the QC on a fastq file and writes the report directory where fastQC would.  Returns the fastq file path.
+	If parts is given, it is the list of flowcell-specific files which fastq_file is the concatenation of.  The report is then
+	made by merging the stored summaries of those files, so only the files with no summary yet (i.e. the new data) are read.
+	"""
+	filename = os.path.basename(fastq_file)
+	if parts and sum([os.path.getsize(p) for p in parts]) == os.path.getsize(fastq_file):
+		stats = QCStats()
+		for p in parts:
+			stats.merge(flowcell_stats(p))
+	else:
+		stats = compute(fastq_file)
+	write_report(stats, filename, fastqc_runner.output_dir(fastq_file))
+	return fastq_file
+
+
+def run_job(job):
+	return run(*job)
+
+
+def process_pool(workers):
+	"""
+	Returns the pool of worker processes (shared by all callers, so the number of QC processes stays bounded).
+	The pipeline creates it on the main thread, before its worker threads start, since forking from a thread can
+	deadlock the children on locks (e.g. those of the logging handlers) which other threads held at the time.
+	"""
+	global _process_pool
+	with _process_pool_lock:
+		if _process_pool is None:
+			_process_pool = multiprocessing.Pool(max(1, workers))
+		return _process_pool
+
+
+def run_all(fastq_files, workers, on_complete = None, parts = None):
+	"""
+	Runs the QC on the fastq files in worker processes.  on_complete(fastq_file) is called (in this thread) as each finishes.
+	parts optionally maps fastq files to the flowcell-specific files they were concatenated from (see run).
+	"""
+	if len(fastq_files) == 0:
+		return
+	parts = parts or {}
+	pool = process_pool(workers)
+	for fq in pool.imap_unordered(run_job, [(fq, parts.get(fq)) for fq in fastq_files]):
+		if on_complete:
+			on_complete(fq)
@@ -0,0 +1,69 @@
+"""
+A quick, provisional QC of a sample from a random subsample of its reads, available long before the full QC is done.
+
+The reads are sampled uniformly in a single streaming pass with a reservoir: each read gets a random key, and the
+reads with the smallest keys seen so far are kept.  That is done on whole blocks of records with numpy, and once the
+reservoir is full only the (few) reads with a key below the current largest key in the reservoir are looked at.
+The QC statistics of the sampled reads are computed with qc_engine.
+"""
+
+import os
+import shutil
+import numpy as np
+
+import qc_engine
+import fastqc_runner
+
+
+def reservoir_sample(fastq_file, n, seed = None):
+	"""
+	Returns the fastq text of n reads sampled uniformly from the (gzipped) fastq file (or all of them, if it has fewer)
+	"""
+	rng = np.random.RandomState(seed)
+	keys = np.zeros(0)
+	records = []
+	carry = ''
+	for text in qc_engine.iterate_text(fastq_file):
+		buf, line_starts, line_ends, carry = qc_engine.split_records(carry + text)
+		if len(line_starts) == 0:
+			continue
+		record_starts = line_starts[0::4]
+		record_ends = line_ends[3::4] + 1
+		record_keys = rng.random_sample(len(record_starts))
+		if len(keys) >= n:
+			candidates = np.flatnonzero(record_keys < keys.max())
+		else:
+			candidates = np.arange(len(record_starts))
+		if len(candidates) == 0:
+			continue
+		keys = np.concatenate([keys, record_keys[candidates]])
+		records.extend([buf[record_starts[i]:record_ends[i]].tobytes() for i in candidates])
+		if len(keys) > n:
+			keep = np.argpartition(keys, n - 1)[:n]
+			keys = keys[keep]
+			records = [records[i] for i in keep]
+	return ''.join(records)
+
+
+def report_dir(fastq_file, preview_dir):
+	return os.path.join(preview_dir, os.path.basename(fastqc_runner.output_dir(fastq_file)))
+
+
+def preview(fastq_file, n, preview_dir, seed = None):
+	"""
+	Writes a provisional QC report (in the same format as the full report) for the fastq file into preview_dir
+	"""
+	stats = qc_engine.QCStats()
+	stats.update(reservoir_sample(fastq_file, n, seed))
+	qc_engine.write_report(stats, os.path.basename(fastq_file), report_dir(fastq_file, preview_dir))
+
+
+def remove_preview(fastq_file, preview_dir):
+	"""
+	Removes the provisional report once the full QC has replaced it.  Returns True if there was one.
+	"""
+	d = report_dir(fastq_file, preview_dir)
+	if os.path.isdir(d):
+		shutil.rmtree(d)
+		return True
+	return False
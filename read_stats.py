@@ -0,0 +1,195 @@
+"""
+Per-sample read statistics (reads, bases, mean base quality and the fraction of bases >= Q30) collected while the
+lane-specific fastq files are concatenated.
+
+A ReadStatsObserver is passed to fastq_concat.concatenate as an observer.  It hands the compressed data to a helper
+thread, which inflates it and computes the statistics with numpy over whole blocks of records, so the copying
+thread is not held up by the decompression (zlib and numpy release the GIL while they work).  A thread rather than a
+process is used since the observers are created in the pipeline's worker threads, and forking a process from there
+can deadlock the child on locks (e.g. those of the logging handlers) which other threads held at the time.
+
+The results for a project are kept in a tab-delimited table in the project directory, which is available before
+fastQC starts.
+"""
+
+import os
+import zlib
+import logging
+import Queue
+import threading
+import numpy as np
+
+NEWLINE = ord('\n')
+
+# the most decompressed data handled at once, which bounds the memory used by the helper threads
+INFLATE_SIZE = 32*1024*1024
+
+# the most chunks of compressed data waiting for a helper thread, after which the copying thread waits
+MAX_PENDING_CHUNKS = 16
+
+# the offset of the quality scores in the fastq quality strings (Illumina 1.8+)
+PHRED_OFFSET = 33
+
+COLUMNS = ['sample', 'flowcell', 'read', 'reads', 'bases', 'mean_quality', 'q30_fraction', 'pairs_consistent']
+
+_table_locks = {}
+_table_locks_guard = threading.Lock()
+
+
+class ReadStats(object):
+	"""
+	Accumulates statistics over (uncompressed) fastq text passed to update(), which need not be split on record boundaries
+	"""
+	def __init__(self):
+		self.reads = 0
+		self.bases = 0
+		self.quality_sum = 0
+		self.q30_bases = 0
+		self.carry = ''
+
+	def update(self, text):
+		buf = np.frombuffer(self.carry + text, dtype=np.uint8)
+		line_ends = np.flatnonzero(buf == NEWLINE)
+		complete_records = len(line_ends) // 4
+		if complete_records == 0:
+			self.carry += text
+			return
+		end = line_ends[4*complete_records - 1] + 1
+		self.carry = buf[end:].tobytes()
+		line_ends = line_ends[:4*complete_records]
+		line_starts = np.concatenate([[0], line_ends[:-1] + 1])
+
+		# the sequence is the second line of each record and the qualities are the fourth
+		seq_lengths = line_ends[1::4] - line_starts[1::4]
+		quality_starts = line_starts[3::4]
+		quality_ends = line_ends[3::4]
+
+		# a mask of the bytes which are in quality lines (the lines do not overlap, so the running sum is only ever 0 or 1)
+		marker = np.zeros(end + 1, dtype=np.int8)
+		marker[quality_starts] = 1
+		marker[quality_ends] -= 1
+		in_quality = np.cumsum(marker[:end], dtype=np.int8).view(np.bool_)
+		qualities = buf[:end][in_quality]
+
+		self.reads += complete_records
+		self.bases += int(seq_lengths.sum())
+		self.quality_sum += int(qualities.sum(dtype=np.int64)) - PHRED_OFFSET*len(qualities)
+		self.q30_bases += int(np.count_nonzero(qualities >= PHRED_OFFSET + 30))
+
+	def result(self):
+		return {'reads': self.reads,
+			'bases': self.bases,
+			'mean_quality': float(self.quality_sum) / self.bases if self.bases else 0.0,
+			'q30_fraction': float(self.q30_bases) / self.bases if self.bases else 0.0}
+
+
+def inflate_and_count(chunks):
+	"""
+	Takes chunks of gzip data from the chunks queue until an empty chunk (or None, if cancelled), then returns the
+	statistics
+	"""
+	stats = ReadStats()
+	decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	while True:
+		data = chunks.get()
+		if data is None:
+			return None
+		if not data:
+			break
+		while data:
+			stats.update(decompressor.decompress(data, INFLATE_SIZE))
+			data = decompressor.unconsumed_tail
+			# the files are concatenated gzip files, so a new member (which needs a new decompressor) can start mid-chunk
+			if not data and decompressor.unused_data:
+				data = decompressor.unused_data
+				stats.update(decompressor.flush())
+				decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	stats.update(decompressor.flush())
+	return stats.result()
+
+
+class ReadStatsObserver(object):
+	"""
+	An observer (see fastq_concat.concatenate) which computes read statistics in a helper thread
+	"""
+	def __init__(self):
+		self.chunks = Queue.Queue(MAX_PENDING_CHUNKS)
+		self.stats = None
+		self.error = None
+		self.thread = threading.Thread(target = self.count)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def count(self):
+		try:
+			self.stats = inflate_and_count(self.chunks)
+		except Exception as ex:
+			self.error = ex
+			# keep taking chunks, so the copying thread is not blocked
+			while self.chunks.get():
+				pass
+
+	def update(self, data):
+		self.chunks.put(data)
+
+	def result(self):
+		"""
+		Signals the end of the data and waits for the statistics
+		"""
+		self.chunks.put('')
+		self.thread.join()
+		if self.error is not None:
+			raise self.error
+		return self.stats
+
+	def cancel(self):
+		self.chunks.put(None)
+		self.thread.join()
+
+
+class ReadStatsTable(object):
+	"""
+	The tab-delimited table of read statistics for a project, with a row per sample, flowcell and read
+	"""
+	def __init__(self, project_dir, table_name):
+		self.path = os.path.join(project_dir, table_name)
+		with _table_locks_guard:
+			self.lock = _table_locks.setdefault(os.path.realpath(self.path), threading.Lock())
+
+	def load(self):
+		rows = []
+		if os.path.isfile(self.path):
+			lines = open(self.path).read().splitlines()
+			for line in lines[1:]:
+				rows.append(dict(zip(COLUMNS, line.split('\t'))))
+		return rows
+
+	def add_sample(self, sample, flowcell, read_stats):
+		"""
+		read_stats maps the read number (1 or 2) to the statistics for that read.  Replaces any existing rows for the
+		sample and flowcell.  Returns False if the reads were paired and the read counts differ.
+		"""
+		read_counts = set([s['reads'] for s in read_stats.values()])
+		consistent = len(read_counts) == 1
+		if not consistent:
+			logging.warning('The R1 and R2 fastq files for sample %s have differing numbers of reads: %s' % (sample, dict([(r, s['reads']) for r, s in read_stats.items()])))
+		with self.lock:
+			rows = [r for r in self.load() if not (r['sample'] == sample and r['flowcell'] == flowcell)]
+			for read_num in sorted(read_stats.keys()):
+				s = read_stats[read_num]
+				rows.append({'sample': sample,
+						'flowcell': flowcell,
+						'read': 'R%s' % read_num,
+						'reads': s['reads'],
+						'bases': s['bases'],
+						'mean_quality': '%.2f' % s['mean_quality'],
+						'q30_fraction': '%.4f' % s['q30_fraction'],
+						'pairs_consistent': consistent})
+			rows.sort(key = lambda r: (r['sample'], r['flowcell'], r['read']))
+			tmp_path = self.path + '.tmp'
+			with open(tmp_path, 'w') as fout:
+				fout.write('\t'.join(COLUMNS) + '\n')
+				for r in rows:
+					fout.write('\t'.join([str(r[c]) for c in COLUMNS]) + '\n')
+			os.rename(tmp_path, self.path)
+		return consistent
@@ -7,6 +7,10 @@ import shutil
 from datetime import datetime as date
 from ConfigParser import SafeConfigParser
 
+# the permission fixer is shared with the pipeline, in the parent directory
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)))
+from permissions import correct_permissions
+
 
 def parse_config_file(current_dir):
 	"""
@@ -82,22 +86,6 @@ def create_delivery_locations(delivery_home, project_id_list):
 
 
 
-
-def correct_permissions(directory):
-	"""
-	Gives write privileges to the biocomp group (if not already there)
-	Recurses through all directories and files underneath the path passed as the argument
-	"""
-	logging.info('Giving 0775 permissions to all directories underneath %s' % directory)
-	os.chmod(directory, 0775)
-	for root, dirs, files in os.walk(directory):
-		for d in dirs:
-			os.chmod(os.path.join(root, d), 0775)
-		for f in files:
-			os.chmod(os.path.join(root, f), 0775)
-
-
-
 def setup_links(date_stamped_delivery_dir, origin_dir, project_id_list, sample_dir_prefix, fastqc_output_suffix):
 	"""
 	Creates symbolic links to the fastq and fastQC output directories from the project delivery location
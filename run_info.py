@@ -0,0 +1,44 @@
+"""
+Parses the RunInfo.xml file written by the instrument into the run directory.
+It describes the layout of the flowcell (lanes, surfaces, tiles) and the reads (cycles, index reads).
+"""
+
+import os
+import logging
+import xml.etree.ElementTree as ET
+
+
+class RunInfoException(Exception):
+	pass
+
+
+def parse_run_info(run_directory_path):
+	"""
+	Returns a dictionary describing the run and flowcell layout, as given by RunInfo.xml
+	"""
+	run_info_path = os.path.join(run_directory_path, 'RunInfo.xml')
+	logging.info('Parsing run information from %s' % run_info_path)
+	try:
+		root = ET.parse(run_info_path).getroot()
+	except (IOError, ET.ParseError) as ex:
+		raise RunInfoException('Could not parse %s: %s' % (run_info_path, ex))
+
+	run = root.find('Run')
+	layout = run.find('FlowcellLayout')
+	if layout is None:
+		raise RunInfoException('No FlowcellLayout element found in %s' % run_info_path)
+
+	info = {}
+	info['run_id'] = run.get('Id')
+	info['flowcell'] = run.findtext('Flowcell')
+	info['lane_count'] = int(layout.get('LaneCount'))
+	info['surface_count'] = int(layout.get('SurfaceCount', 1))
+	info['swath_count'] = int(layout.get('SwathCount', 1))
+	info['tile_count'] = int(layout.get('TileCount', 1))
+	info['reads'] = []
+	for read in run.find('Reads').findall('Read'):
+		info['reads'].append({'number': int(read.get('Number')),
+					'cycles': int(read.get('NumCycles')),
+					'is_index': read.get('IsIndexedRead') == 'Y'})
+	logging.info('Run information: %s' % info)
+	return info
@@ -0,0 +1,199 @@
+"""
+A parsed Illumina SampleSheet.csv.
+
+The file is read once and split into its sections.  Both the v1 format (bcl2fastq: [Header], [Reads], [Settings],
+[Data]) and the v2 format (BCL Convert: FileFormatVersion 2 in the [Header], samples in [BCLConvert_Data]) are
+handled.  The sample rows are kept as dicts keyed by the column names, with the v2 index columns renamed to the v1
+names (index, index2) so the rest of the pipeline does not need to care which format it was.
+
+The index sequences of the samples in each lane are compared with a pairwise Hamming distance matrix (numpy; see
+barcodes.py), so barcode collisions are found before the demux starts rather than after hours of bcl2fastq.
+"""
+
+import re
+import numpy as np
+
+import barcodes
+
+# only letters, numbers and underscores are allowed in sample and project names
+NAME_PATTERN = re.compile(r'^[a-z0-9_]+$', re.IGNORECASE)
+
+# the section holding the sample rows, for each format version
+DATA_SECTIONS = {1: 'Data', 2: 'BCLConvert_Data'}
+
+# v2 column names and their v1 equivalents
+V2_COLUMNS = {'Index': 'index', 'Index2': 'index2'}
+
+
+class SampleSheetException(Exception):
+	"""
+	A problem with the contents of the sample sheet, which the lab needs to fix
+	"""
+	pass
+
+
+class SampleSheetFormatError(Exception):
+	"""
+	The file is not a usable sample sheet (e.g. a section is missing)
+	"""
+	pass
+
+
+def split_line(line):
+	return [x.strip() for x in line.rstrip('\r\n').split(',')]
+
+
+def sample_name(row, sample_dir_prefix):
+	"""
+	Returns the row's Sample_Name or, if it has none (it is optional, and v2 sheets usually leave it out), its Sample_ID
+	without the prefix
+	"""
+	if row.get('Sample_Name'):
+		return row['Sample_Name']
+	sample_id = row.get('Sample_ID', '')
+	return sample_id[len(sample_dir_prefix):] if sample_id.startswith(sample_dir_prefix) else sample_id
+
+
+def row_is_valid(row, sample_dir_prefix):
+	"""
+	Checks that the row's fields are within our guidelines.  Returns a list of the problems (empty if there are none).
+	"""
+	problems = []
+	sample_id = row.get('Sample_ID', '')
+	name = sample_name(row, sample_dir_prefix)
+	project = row.get('Sample_Project', '')
+	if not NAME_PATTERN.match(name):
+		problems.append('Sample_Name "%s" has characters other than letters, numbers and underscores' % name)
+	if not sample_id.startswith(sample_dir_prefix):
+		problems.append('Sample_ID "%s" does not start with %s' % (sample_id, sample_dir_prefix))
+	elif sample_id[len(sample_dir_prefix):] != name:
+		problems.append('Sample_ID "%s" does not match Sample_Name "%s"' % (sample_id, name))
+	if not NAME_PATTERN.match(project):
+		problems.append('Sample_Project "%s" is missing or has characters other than letters, numbers and underscores' % project)
+	return problems
+
+
+class SampleSheet(object):
+
+	def __init__(self, path = None, text = None):
+		if text is None:
+			text = open(path).read()
+		self.path = path
+		self.sections = {}
+		self.section_order = []
+		self.parse(text)
+
+	def parse(self, text):
+		"""
+		Splits the file into its sections (in one pass), then reads the header and the sample rows
+		"""
+		current = None
+		for line in text.split('\n'):
+			stripped = line.strip().rstrip(',')
+			if stripped.startswith('[') and stripped.endswith(']'):
+				current = stripped[1:-1]
+				self.sections[current] = []
+				self.section_order.append(current)
+			elif current is not None and len(stripped) > 0:
+				self.sections[current].append(line.rstrip('\r'))
+
+		if 'Header' not in self.sections:
+			raise SampleSheetFormatError('Could not find the [Header] section')
+		self.header = {}
+		self.emails = {}
+		for line in self.sections['Header']:
+			fields = split_line(line)
+			if fields[0] == 'Email' and len(fields) > 1:
+				emails = [x for x in fields[2:] if len(x) > 0]
+				self.emails.setdefault(fields[1], []).extend(emails)
+			else:
+				self.header[fields[0]] = fields[1] if len(fields) > 1 else ''
+
+		try:
+			self.version = int(self.header.get('FileFormatVersion', 1))
+		except ValueError:
+			self.version = 1
+		data_section = DATA_SECTIONS.get(self.version, 'Data')
+		if data_section not in self.sections or len(self.sections[data_section]) == 0:
+			raise SampleSheetFormatError('Could not find the [%s] section' % data_section)
+		lines = self.sections[data_section]
+		self.columns = [V2_COLUMNS.get(c, c) for c in split_line(lines[0])]
+		self.rows = [dict(zip(self.columns, split_line(line))) for line in lines[1:]]
+
+		# v2 sheets may give the projects in the [Cloud_Data] section
+		if self.version == 2 and 'Cloud_Data' in self.sections:
+			cloud = self.section_table('Cloud_Data')
+			projects = dict([(r.get('Sample_ID'), r.get('ProjectName')) for r in cloud])
+			for r in self.rows:
+				if not r.get('Sample_Project') and projects.get(r.get('Sample_ID')):
+					r['Sample_Project'] = projects[r['Sample_ID']]
+
+		# indexes for the lookups
+		self.samples = {}
+		self.projects = {}
+		for r in self.rows:
+			self.samples.setdefault(r.get('Sample_ID'), []).append(r)
+			self.projects.setdefault(r.get('Sample_Project'), []).append(r)
+
+	def section_table(self, name):
+		"""
+		Returns the rows of a table-like section (a header line, then one line per row) as dicts
+		"""
+		lines = self.sections.get(name, [])
+		if len(lines) == 0:
+			return []
+		columns = split_line(lines[0])
+		return [dict(zip(columns, split_line(line))) for line in lines[1:]]
+
+	def project_ids(self):
+		return self.projects.keys()
+
+	def project_samples(self, sample_dir_prefix = ''):
+		"""
+		Returns a dict of project ID to the list of (unique) sample names in it (see sample_name)
+		"""
+		project_samples = {}
+		for p, rows in self.projects.items():
+			names = project_samples.setdefault(p, [])
+			for r in rows:
+				name = sample_name(r, sample_dir_prefix)
+				if name not in names:
+					names.append(name)
+		return project_samples
+
+	def invalid_rows(self, sample_dir_prefix):
+		"""
+		Returns a list of (line number in the data section, problems) for the rows which are not within our guidelines
+		"""
+		invalid = []
+		for i, r in enumerate(self.rows):
+			problems = row_is_valid(r, sample_dir_prefix)
+			if problems:
+				invalid.append((i + 1, problems))
+		return invalid
+
+	def index_collisions(self, min_distance):
+		"""
+		Returns a list of (lane, sample ID, sample ID, distance) for the pairs of samples in the same lane whose combined
+		(i7 + i5) index sequences are fewer than min_distance mismatches apart.  Rows without a Lane are in every lane.
+		"""
+		lanes = {}
+		for r in self.rows:
+			lanes.setdefault(r.get('Lane') or None, []).append(r)
+		if None in lanes and len(lanes) > 1:
+			shared = lanes.pop(None)
+			for lane in lanes:
+				lanes[lane].extend(shared)
+
+		collisions = []
+		for lane, rows in sorted(lanes.items()):
+			rows = [r for r in rows if r.get('index', '') + r.get('index2', '')]
+			if len(rows) < 2:
+				continue
+			codes = barcodes.encode([r.get('index', '') + r.get('index2', '') for r in rows])
+			distances = barcodes.hamming_distance_matrix(codes, codes)
+			first, second = np.nonzero(np.triu(distances < min_distance, 1))
+			for i, j in zip(first, second):
+				if rows[i].get('Sample_ID') != rows[j].get('Sample_ID'):
+					collisions.append((lane, rows[i].get('Sample_ID'), rows[j].get('Sample_ID'), int(distances[i, j])))
+		return collisions
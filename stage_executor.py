@@ -0,0 +1,103 @@
+"""
+A small dependency-graph executor for the per-sample and per-project processing steps.
+
+Tasks are added with the names of the tasks they depend on, and each task is started (in a bounded pool of worker threads)
+as soon as its dependencies are complete.  Most of the pipeline's work happens in external processes (fastqc, gsutil, etc.)
+or in I/O, so threads are enough to keep several of those running at once.
+
+If a task fails (raises an exception, or calls sys.exit), the tasks which depend on it are not run.  Tasks which do not
+depend on it carry on.
+"""
+
+import logging
+import traceback
+import Queue
+from multiprocessing.pool import ThreadPool
+
+
+class Task(object):
+	def __init__(self, name, func, args, depends_on):
+		self.name = name
+		self.func = func
+		self.args = args
+		self.depends_on = set(depends_on)
+
+
+def call_task(task, results):
+	"""
+	Runs the task and puts (name, success, result) on the results queue.  SystemExit is caught as well, since
+	the pipeline methods exit on errors, and an uncaught exception would be lost inside the pool
+	"""
+	try:
+		results.put((task.name, True, task.func(*task.args)))
+	except BaseException as ex:
+		logging.error('Task %s failed: %s\n%s' % (task.name, ex, traceback.format_exc()))
+		results.put((task.name, False, ex))
+
+
+class StageExecutor(object):
+
+	def __init__(self, workers):
+		self.workers = max(1, workers)
+		self.tasks = []
+		self.completed = set()
+
+	def add(self, name, func, args = (), depends_on = (), completed = False):
+		"""
+		Adds a task.  If completed is True (e.g. it completed in a previous, interrupted run), it is not run again but
+		still satisfies the dependencies of other tasks.
+		"""
+		if completed:
+			self.completed.add(name)
+		else:
+			self.tasks.append(Task(name, func, args, depends_on))
+
+	def run(self, on_complete = None):
+		"""
+		Runs all the tasks.  on_complete(name, result) is called (in this thread) as each task succeeds.
+		Returns the list of names of tasks which failed or were not run since a dependency failed.
+		"""
+		names = set([t.name for t in self.tasks]) | self.completed
+		for t in self.tasks:
+			missing = t.depends_on - names
+			if missing:
+				raise ValueError('Task %s depends on unknown task(s): %s' % (t.name, ', '.join(sorted(missing))))
+
+		pending = list(self.tasks)
+		failed = []
+		results = Queue.Queue()
+		running = 0
+		pool = ThreadPool(self.workers)
+		try:
+			while True:
+				# tasks whose dependencies failed can never run
+				blocked = [t for t in pending if t.depends_on & set(failed)]
+				while blocked:
+					for t in blocked:
+						logging.error('Not running task %s, since a task it depends on failed' % t.name)
+						pending.remove(t)
+						failed.append(t.name)
+					blocked = [t for t in pending if t.depends_on & set(failed)]
+
+				ready = [t for t in pending if t.depends_on <= self.completed]
+				for t in ready:
+					pending.remove(t)
+					logging.info('Starting task %s' % t.name)
+					pool.apply_async(call_task, (t, results))
+					running += 1
+
+				if running == 0:
+					break
+				name, success, result = results.get()
+				running -= 1
+				if success:
+					logging.info('Completed task %s' % name)
+					self.completed.add(name)
+					if on_complete:
+						on_complete(name, result)
+				else:
+					failed.append(name)
+		finally:
+			pool.close()
+			pool.join()
+		return failed
@@ -0,0 +1,133 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import sys
+import os
+import shutil
+import tempfile
+import time
+import unittest
+this_dir = os.path.dirname( os.path.abspath(__file__) )
+sys.path.append( os.path.join(os.path.dirname(this_dir), 'cron_job') )
+
+import run_registry
+
+
+class TestRunRegistry(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.instrument = os.path.join(self.tmp_dir, 'NS500749')
+		os.mkdir(self.instrument)
+		self.db = os.path.join(self.tmp_dir, 'runs.db')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_legacy_cache_is_imported_as_done(self):
+		old_run = os.path.join(self.instrument, 'old_run')
+		os.mkdir(old_run)
+		legacy_cache = os.path.join(self.tmp_dir, 'pipeline_cache')
+		with open(legacy_cache, 'w') as fout:
+			fout.write(old_run)
+		registry = run_registry.RunRegistry(self.db, legacy_cache = legacy_cache)
+		self.assertEqual(registry.get_state(os.path.realpath(old_run)), run_registry.DONE)
+		self.assertEqual(registry.scan_instrument(self.instrument), [])
+
+	def test_legacy_failed_runs_are_imported_as_failed(self):
+		done_run = os.path.join(self.instrument, 'done_run')
+		failed_run = os.path.join(self.instrument, 'failed_run')
+		new_run = os.path.join(self.instrument, 'new_run')
+		for d in [done_run, failed_run, new_run]:
+			os.mkdir(d)
+		for d in [done_run, failed_run]:
+			with open(os.path.join(d, 'in_progress.txt'), 'w') as fout:
+				fout.write('')
+		legacy_cache = os.path.join(self.tmp_dir, 'pipeline_cache')
+		with open(legacy_cache, 'w') as fout:
+			fout.write(done_run)
+		registry = run_registry.RunRegistry(self.db, legacy_cache = legacy_cache, 
+					instrument_dirs = [self.instrument], in_progress_file = 'in_progress.txt')
+		self.assertEqual(registry.get_state(os.path.realpath(done_run)), run_registry.DONE)
+		self.assertEqual(registry.get_state(os.path.realpath(failed_run)), run_registry.FAILED)
+		self.assertEqual(registry.scan_instrument(self.instrument), [os.path.realpath(new_run)])
+
+	def test_stale_directories_are_checked_less_often(self):
+		registry = run_registry.RunRegistry(self.db)
+		new_run = os.path.join(self.instrument, 'new_run')
+		os.mkdir(new_run)
+		path = registry.add(new_run, self.instrument, 0)
+		now = time.time()
+
+		# a recently discovered directory is checked every time
+		registry.not_ready(path, now)
+		self.assertEqual(registry.due_for_check(now), [path])
+
+		# once stale, the checks are spaced out by a growing interval
+		now += run_registry.STALE_TIME
+		registry.not_ready(path, now)
+		self.assertEqual(registry.due_for_check(now + 60), [])
+		self.assertEqual(registry.due_for_check(now + 120), [path])
+		registry.not_ready(path, now + 120)
+		self.assertEqual(registry.due_for_check(now + 120 + 239), [])
+		self.assertEqual(registry.due_for_check(now + 120 + 240), [path])
+
+		# the interval never grows past the maximum
+		for i in range(30):
+			registry.not_ready(path, now)
+		self.assertEqual(registry.due_for_check(now + run_registry.MAX_CHECK_INTERVAL), [path])
+
+	def test_older_registry_is_upgraded(self):
+		import sqlite3
+		connection = sqlite3.connect(self.db)
+		connection.execute('CREATE TABLE runs (path TEXT PRIMARY KEY, instrument TEXT, mtime REAL, state TEXT NOT NULL, returncode INTEGER, updated REAL)')
+		connection.execute('INSERT INTO runs VALUES (?,?,?,?,?,?)', ('/old_run', self.instrument, 0, run_registry.DISCOVERED, None, 0))
+		connection.commit()
+		connection.close()
+		registry = run_registry.RunRegistry(self.db)
+		self.assertEqual(registry.due_for_check(), ['/old_run'])
+
+	def test_reconnects_after_close(self):
+		registry = run_registry.RunRegistry(self.db)
+		new_run = os.path.join(self.instrument, 'new_run')
+		os.mkdir(new_run)
+		path = registry.add(new_run, self.instrument, 0)
+		registry.close()
+		self.assertEqual(registry.get_state(path), run_registry.DISCOVERED)
+
+	def test_new_directories_are_discovered_once(self):
+		registry = run_registry.RunRegistry(self.db)
+		new_run = os.path.join(self.instrument, 'new_run')
+		os.mkdir(new_run)
+		with open(os.path.join(self.instrument, 'not_a_dir.txt'), 'w') as fout:
+			fout.write('')
+		self.assertEqual(registry.scan_instrument(self.instrument), [os.path.realpath(new_run)])
+		self.assertEqual(registry.in_state(run_registry.DISCOVERED), [os.path.realpath(new_run)])
+
+		# force a re-listing, which should not report the directory again
+		registry.set_instrument_mtime(self.instrument, 0)
+		self.assertEqual(registry.scan_instrument(self.instrument), [])
+
+	def test_transitions_are_only_made_from_the_expected_state(self):
+		registry = run_registry.RunRegistry(self.db)
+		new_run = os.path.join(self.instrument, 'new_run')
+		os.mkdir(new_run)
+		path = registry.add(new_run, self.instrument, 0)
+		self.assertTrue(registry.transition(path, run_registry.DISCOVERED, run_registry.QUEUED))
+
+		# a second scanner (sharing the same database) cannot claim it again
+		other_registry = run_registry.RunRegistry(self.db)
+		self.assertFalse(other_registry.transition(path, run_registry.DISCOVERED, run_registry.QUEUED))
+
+		self.assertTrue(registry.transition(path, run_registry.QUEUED, run_registry.RUNNING))
+		self.assertTrue(registry.transition(path, run_registry.RUNNING, run_registry.FAILED, 1))
+		self.assertEqual(other_registry.get_state(path), run_registry.FAILED)
+
+	def test_unknown_state_raises_exception(self):
+		registry = run_registry.RunRegistry(self.db)
+		with self.assertRaises(run_registry.InvalidStateException):
+			registry.transition('/dummy', run_registry.DISCOVERED, 'foo')
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,122 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import sys
+import os
+import unittest
+import mock
+import time
+this_dir = os.path.dirname( os.path.abspath(__file__) )
+sys.path.append( os.path.join(os.path.dirname(this_dir), 'cron_job') )
+
+import scan
+
+
+class DummyProcess(object):
+	"""
+	Stands in for a Popen instance.  Finishes (with the given return code) after being polled 'polls' times
+	"""
+	def __init__(self, returncode, polls):
+		self.final_returncode = returncode
+		self.remaining_polls = polls
+		self.returncode = None
+
+	def poll(self):
+		self.remaining_polls -= 1
+		if self.remaining_polls <= 0:
+			self.returncode = self.final_returncode
+		return self.returncode
+
+
+class TestScheduler(unittest.TestCase):
+
+	def setUp(self):
+		self.params = {'max_concurrent_runs': '2', 'poll_interval': '0', 'smtp_server': 'dummy', 'smtp_port': '25'}
+
+	@mock.patch('scan.send_error_email')
+	@mock.patch('scan.launch_run')
+	def test_concurrency_is_bounded(self, mock_launch, mock_email):
+		running = []
+		max_seen = [0]
+		def launch(d, params, this_dir, subscribers):
+			p = DummyProcess(0, 2)
+			running.append(p)
+			max_seen[0] = max(max_seen[0], len([x for x in running if x.returncode is None]))
+			return p
+		mock_launch.side_effect = launch
+
+		finished = []
+		scan.schedule_runs(['/a', '/b', '/c', '/d', '/e'], self.params, '/dummy', [], [], finished.append)
+		self.assertEqual(sorted(finished), ['/a', '/b', '/c', '/d', '/e'])
+		self.assertEqual(max_seen[0], 2)
+		self.assertFalse(mock_email.called)
+
+	@mock.patch('scan.send_error_email')
+	@mock.patch('scan.launch_run')
+	def test_failure_does_not_hold_up_other_runs(self, mock_launch, mock_email):
+		# the first run fails after a single poll, while a slow run keeps going.  The third run should still be started and completed
+		processes = {'/fail': DummyProcess(1, 1), '/slow': DummyProcess(0, 5), '/next': DummyProcess(0, 1)}
+		mock_launch.side_effect = lambda d, params, this_dir, subscribers: processes[d]
+
+		finished = []
+		scan.schedule_runs(['/fail', '/slow', '/next'], self.params, '/dummy', [], ['comp@domain.org'], finished.append)
+		self.assertEqual(finished, ['/next', '/slow'])
+		mock_email.assert_called_once_with(['comp@domain.org'], '/fail', 'dummy', '25')
+
+	@mock.patch('scan.send_error_email')
+	@mock.patch('scan.launch_run')
+	def test_email_failure_does_not_stop_scheduler(self, mock_launch, mock_email):
+		import smtplib
+		mock_email.side_effect = smtplib.SMTPException('no server')
+		processes = {'/fail': DummyProcess(1, 1), '/next': DummyProcess(0, 2)}
+		mock_launch.side_effect = lambda d, params, this_dir, subscribers: processes[d]
+
+		finished = []
+		scan.schedule_runs(['/fail', '/next'], self.params, '/dummy', [], ['comp@domain.org'], finished.append)
+		self.assertEqual(finished, ['/next'])
+
+
+class TestClaimReadyDirs(unittest.TestCase):
+
+	def test_stale_directories_are_only_checked_when_due(self):
+		registry = mock.Mock()
+		registry.in_state.return_value = ['/stale', '/ready']
+		registry.due_for_check.return_value = ['/ready']
+		registry.transition.return_value = True
+		params = {'in_progress_file': 'in_progress.txt', 'target_file': 'RTAComplete.txt'}
+		with mock.patch('scan.is_ready', side_effect = lambda d, params: d == '/ready'):
+			self.assertEqual(scan.claim_ready_dirs(params, registry), ['/ready'])
+			self.assertFalse(registry.not_ready.called)
+
+			# a directory reported by the watcher is checked even if it is not due
+			self.assertEqual(scan.claim_ready_dirs(params, registry, ['/stale', '/ready']), ['/ready'])
+			registry.not_ready.assert_called_once_with('/stale')
+
+
+class TestForkedRun(unittest.TestCase):
+
+	def wait_for(self, run):
+		while run.poll() is None:
+			time.sleep(0.01)
+		return run.returncode
+
+	def test_exit_code_is_reported(self):
+		dummy_module = mock.Mock()
+		dummy_module.__file__ = 'dummy_script.py'
+		dummy_module.process.side_effect = SystemExit(3)
+		self.assertEqual(self.wait_for(scan.ForkedRun(dummy_module, ['-r', '/dummy'])), 3)
+
+	def test_successful_run(self):
+		dummy_module = mock.Mock()
+		dummy_module.__file__ = 'dummy_script.py'
+		self.assertEqual(self.wait_for(scan.ForkedRun(dummy_module, ['-r', '/dummy'])), 0)
+
+	def test_unexpected_exception_is_a_failure(self):
+		dummy_module = mock.Mock()
+		dummy_module.__file__ = 'dummy_script.py'
+		dummy_module.process.side_effect = ValueError('foo')
+		self.assertEqual(self.wait_for(scan.ForkedRun(dummy_module, ['-r', '/dummy'])), 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -2,6 +2,7 @@ import logging
 logging.disable(logging.CRITICAL)
 
 import unittest
+import json
 import mock
 import __builtin__
 from StringIO import StringIO
@@ -13,6 +14,7 @@ sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
 
 
 from process_sequencing_run import *
+import demux_backends
 
 
 class SampleSheetTests(unittest.TestCase):
@@ -141,50 +143,21 @@ class TestOutputDirCreation(unittest.TestCase):
 
 
 class TestFastQCCall(unittest.TestCase):
-	
-        def my_join(a,b):
-                return os.path.join(a,b)
-
-	@mock.patch('pipeline.subprocess.check_call')
-	@mock.patch('pipeline.os.path.join', side_effect = my_join)
-	@mock.patch('pipeline.os')		
-	def test_fastqc_calls_are_correct(self, mock_os, mock_join, mock_check_call_method):
-
-		project_id_list = ['Project_A', 'Project_B']
-		# this mocks the generator returned by os.walk() method.
-		mock_os.walk.return_value = [('/path/to/target/dir', ['Project_A', 'Project_B'], []),
-						('/path/to/target/dir/Project_A', ['Sample_A2', 'Sample_A1'], []),
-						('/path/to/target/dir/Project_A/Sample_A2', [], ['A2_1.final.fastq.gz', 'A2_2.final.fastq.gz']),
-						('/path/to/target/dir/Project_A/Sample_A1', [], ['A1_1.final.fastq.gz', 'A1_2.final.fastq.gz']),
-						('/path/to/target/dir/Project_B', ['Sample_B2', 'Sample_B1'], []),
-						('/path/to/target/dir/Project_B/Sample_B2', [], ['B2_1.final.fastq.gz', 'B2_2.final.fastq.gz']),
-						('/path/to/target/dir/Project_B/Sample_B1', [], ['B1_1.final.fastq.gz', 'B1_2.final.fastq.gz'])
-					]
-                expected_call_A = '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc /path/to/target/dir/Project_A/Sample_A1/A1_1.final.fastq.gz'
-		expected_call_B = '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc /path/to/target/dir/Project_A/Sample_A1/A1_2.final.fastq.gz'
-                expected_call_C = '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc /path/to/target/dir/Project_A/Sample_A2/A2_1.final.fastq.gz'
-                expected_call_D = '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc /path/to/target/dir/Project_A/Sample_A2/A2_2.final.fastq.gz'
-                expected_call_E = '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc /path/to/target/dir/Project_B/Sample_B1/B1_1.final.fastq.gz'
-                expected_call_F = '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc /path/to/target/dir/Project_B/Sample_B1/B1_2.final.fastq.gz'
-                expected_call_G = '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc /path/to/target/dir/Project_B/Sample_B2/B2_1.final.fastq.gz'
-                expected_call_H = '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc /path/to/target/dir/Project_B/Sample_B2/B2_2.final.fastq.gz'
-
-                calls = [mock.call(expected_call_A, shell=True),
-                        mock.call(expected_call_B, shell=True),
-                        mock.call(expected_call_C, shell=True),
-                	mock.call(expected_call_D, shell=True),
-                        mock.call(expected_call_E, shell=True),
-                        mock.call(expected_call_F, shell=True),
-                        mock.call(expected_call_G, shell=True),
-                        mock.call(expected_call_H, shell=True)]
 
+	@mock.patch('pipeline.fastqc_runner.run_all')
+	@mock.patch('pipeline.os.listdir')
+	def test_fastqc_calls_are_correct(self, mock_listdir, mock_run_all):
+		mock_listdir.return_value = ['A1_R2_.final.fastq.gz', 'A1_R1_.final.fastq.gz', 'A1_R1_.fc1.fastq.gz', 'A1_R1_.final_fastqc']
 		p = pipeline.Pipeline()
-		p.project_id_list = project_id_list
 		p.target_dir = '/path/to/target/dir'
-		p.config_params_dict = {'fastqc_path': '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc'}
-		p.run_fastqc()
-
-                mock_check_call_method.assert_has_calls(calls, any_order = True)
+		p.config_params_dict = {'fastqc_path': '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc', 'sample_dir_prefix': 'Sample_', 
+			'final_fastq_tag': 'final', 'fastqc_workers': '2', 'fastqc_batch_size': '2', 'preview_qc_dir': '.preview_qc'}
+		p.run_fastqc_for_sample('Project_A', 'A1')
+		mock_listdir.assert_called_once_with('/path/to/target/dir/Project_A/Sample_A1')
+		args = mock_run_all.call_args[0]
+		self.assertEqual(args[0], '/cccbstore-rc/projects/cccb/apps/FastQC/fastqc')
+		self.assertEqual(args[1], ['/path/to/target/dir/Project_A/Sample_A1/A1_R1_.final.fastq.gz', '/path/to/target/dir/Project_A/Sample_A1/A1_R2_.final.fastq.gz'])
+		self.assertEqual(args[2:], (2, 2))
 
 
 
@@ -577,6 +550,8 @@ class TestMultipleFlowcellFunctionality(unittest.TestCase):
 		This tests the case where the same sample is run on multiple flowcells-- need to merge the fastq files from them
 		'''
 		mock_os.path.isfile.return_value = True	
+		# the final fastq is a real file (it has already been merged with a previous flowcell), not a link
+		mock_os.path.islink.return_value = False
 		mock_sample_dir = '/path/to/original/Project_ABC/Sample_XX_1'
 
 		# mock there already being two prior flowcells run which had this sample
@@ -595,13 +570,147 @@ class TestMultipleFlowcellFunctionality(unittest.TestCase):
 		mock_new_fc_fastq = os.path.join(mock_sample_dir, 'XX_1_R1_.fc3.fastq.gz')
 		tmp_fastq_tag = 'tmp'
 		p = pipeline.Pipeline()
-		p.config_params_dict = {'sample_dir_prefix':'Sample_', 'tmp_fastq_tag': tmp_fastq_tag, 'final_fastq_tag': 'final'}
-		p.execute_call = mock.Mock()
-		p.merge_and_rename_fastq(mock_sample_dir, 1)
-		mock_cat_call = 'cat ' + mock_existing_final_fastq + ' ' + mock_new_fc_fastq + '> ' + mock_tmp_fastq
-		p.execute_call.assert_called_once_with(mock_cat_call)
-		mock_calls = [mock.call(mock_new_fastq, mock_new_fc_fastq), mock.call(mock_tmp_fastq, mock_existing_final_fastq)]
-		mock_rename.assert_has_calls(mock_calls)
+		p.config_params_dict = {'sample_dir_prefix':'Sample_', 'tmp_fastq_tag': tmp_fastq_tag, 'final_fastq_tag': 'final', 'flowcell_prefix': 'fc'}
+		with mock.patch('pipeline.fastq_concat') as mock_concat:
+			mock_concat.rollback_append.return_value = None
+			mock_concat.pending_merge.return_value = None
+			p.merge_and_rename_fastq(mock_sample_dir, 1)
+			# only the new flowcell's data is appended to the existing final fastq
+			mock_concat.start_merge.assert_called_once_with(mock_new_fc_fastq, mock_existing_final_fastq)
+			mock_concat.append_with_journal.assert_called_once_with([mock_new_fc_fastq], mock_existing_final_fastq)
+			mock_concat.finish_merge.assert_called_once_with(mock_existing_final_fastq)
+			self.assertFalse(mock_concat.concatenate.called)
+		mock_rename.assert_called_once_with(mock_new_fastq, mock_new_fc_fastq)
+
+
+	def test_merges_across_several_flowcells(self):
+		'''
+		Runs the merge for the same sample from three flowcells on real files
+		'''
+		import tempfile
+		import shutil
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			sample_dir = os.path.join(tmp_dir, 'Sample_XX_1')
+			os.mkdir(sample_dir)
+			p = pipeline.Pipeline()
+			p.config_params_dict = {'sample_dir_prefix':'Sample_', 'tmp_fastq_tag': 'tmp', 'final_fastq_tag': 'final', 'flowcell_prefix': 'fc'}
+			final_fastq = os.path.join(sample_dir, 'XX_1_R1_.final.fastq.gz')
+			for i, data in enumerate(['flowcell1', 'flowcell2', 'flowcell3']):
+				with open(os.path.join(sample_dir, 'XX_1_R1_.tmp.fastq.gz'), 'w') as fout:
+					fout.write(data)
+				p.merge_and_rename_fastq(sample_dir, 1)
+				self.assertEqual(open(os.path.join(sample_dir, 'XX_1_R1_.fc%d.fastq.gz' % (i+1))).read(), data)
+			self.assertFalse(os.path.islink(final_fastq))
+			self.assertEqual(open(final_fastq).read(), 'flowcell1flowcell2flowcell3')
+			self.assertEqual(sorted(os.listdir(sample_dir)), ['XX_1_R1_.fc1.fastq.gz', 'XX_1_R1_.fc2.fastq.gz', 'XX_1_R1_.fc3.fastq.gz', 'XX_1_R1_.final.fastq.gz'])
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_interrupted_merge_is_redone(self):
+		import tempfile
+		import shutil
+		import fastq_concat
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			sample_dir = os.path.join(tmp_dir, 'Sample_XX_1')
+			os.mkdir(sample_dir)
+			final_fastq = os.path.join(sample_dir, 'XX_1_R1_.final.fastq.gz')
+			fc3 = os.path.join(sample_dir, 'XX_1_R1_.fc3.fastq.gz')
+			with open(final_fastq, 'w') as fout:
+				fout.write('flowcell1flowcell2')
+			with open(fc3, 'w') as fout:
+				fout.write('flowcell3')
+			# a journal and partially-appended data, as left by a crash during the append
+			json.dump({'length': 18, 'sources': [fc3]}, open(fastq_concat.journal_path(final_fastq), 'w'))
+			with open(final_fastq, 'a') as fout:
+				fout.write('flow')
+			p = pipeline.Pipeline()
+			p.config_params_dict = {'sample_dir_prefix':'Sample_', 'tmp_fastq_tag': 'tmp', 'final_fastq_tag': 'final', 'flowcell_prefix': 'fc'}
+			p.merge_and_rename_fastq(sample_dir, 1)
+			self.assertEqual(open(final_fastq).read(), 'flowcell1flowcell2flowcell3')
+			self.assertFalse(os.path.exists(fastq_concat.journal_path(final_fastq)))
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_resumed_merge_is_not_repeated(self):
+		'''
+		An attempt which died at any point of the merge (after the rename, part-way through the append, or after the merge 
+		but before the task was checkpointed) is resumed without renaming or appending the new fastq twice
+		'''
+		import tempfile
+		import shutil
+		import fastq_concat
+		p = pipeline.Pipeline()
+		p.config_params_dict = {'sample_dir_prefix':'Sample_', 'tmp_fastq_tag': 'tmp', 'final_fastq_tag': 'final', 'flowcell_prefix': 'fc'}
+		def interrupted(stage):
+			tmp_dir = tempfile.mkdtemp()
+			sample_dir = os.path.join(tmp_dir, 'Sample_XX_1')
+			os.mkdir(sample_dir)
+			final_fastq = os.path.join(sample_dir, 'XX_1_R1_.final.fastq.gz')
+			for data in ['flowcell1', 'flowcell2']:
+				with open(os.path.join(sample_dir, 'XX_1_R1_.tmp.fastq.gz'), 'w') as fout:
+					fout.write(data)
+				p.merge_and_rename_fastq(sample_dir, 1)
+			with open(os.path.join(sample_dir, 'XX_1_R1_.tmp.fastq.gz'), 'w') as fout:
+				fout.write('flowcell3')
+			real_rename = os.rename
+			def rename_then_die(source, destination):
+				real_rename(source, destination)
+				if source.endswith('.tmp.fastq.gz'):
+					raise KeyboardInterrupt()
+			def append_part(sources, destination, **kwargs):
+				with open(destination, 'a') as fout:
+					fout.write('flow')
+				raise KeyboardInterrupt()
+			if stage == 'rename':
+				patches = [mock.patch('pipeline.os.rename', side_effect = rename_then_die)]
+			elif stage == 'append':
+				# the process dies part-way through the append, leaving the journal and the partial data
+				patches = [mock.patch('fastq_concat.concatenate', side_effect = append_part), mock.patch('fastq_concat.rollback_append')]
+			else:
+				patches = [mock.patch('fastq_concat.finish_merge', side_effect = KeyboardInterrupt())]
+			for patch in patches:
+				patch.start()
+			try:
+				self.assertRaises(KeyboardInterrupt, p.merge_and_rename_fastq, sample_dir, 1)
+			finally:
+				for patch in patches:
+					patch.stop()
+			return tmp_dir, sample_dir, final_fastq
+
+		for stage in ['rename', 'append', 'finish']:
+			tmp_dir, sample_dir, final_fastq = interrupted(stage)
+			try:
+				p.merge_and_rename_fastq(sample_dir, 1)
+				# and a later retry has nothing left to do
+				p.merge_and_rename_fastq(sample_dir, 1)
+				self.assertEqual(open(final_fastq).read(), 'flowcell1flowcell2flowcell3', stage)
+				self.assertEqual(sorted(os.listdir(sample_dir)), ['XX_1_R1_.fc1.fastq.gz', 'XX_1_R1_.fc2.fastq.gz', 'XX_1_R1_.fc3.fastq.gz', 'XX_1_R1_.final.fastq.gz'], stage)
+			finally:
+				shutil.rmtree(tmp_dir)
+
+	def test_resumed_first_flowcell(self):
+		import tempfile
+		import shutil
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			sample_dir = os.path.join(tmp_dir, 'Sample_XX_1')
+			os.mkdir(sample_dir)
+			# interrupted after the new fastq was renamed, but before the final fastq was linked
+			with open(os.path.join(sample_dir, 'XX_1_R1_.fc1.fastq.gz'), 'w') as fout:
+				fout.write('flowcell1')
+			p = pipeline.Pipeline()
+			p.config_params_dict = {'sample_dir_prefix':'Sample_', 'tmp_fastq_tag': 'tmp', 'final_fastq_tag': 'final', 'flowcell_prefix': 'fc'}
+			p.merge_and_rename_fastq(sample_dir, 1)
+			p.merge_and_rename_fastq(sample_dir, 1)
+			final_fastq = os.path.join(sample_dir, 'XX_1_R1_.final.fastq.gz')
+			self.assertTrue(os.path.islink(final_fastq))
+			self.assertEqual(open(final_fastq).read(), 'flowcell1')
+		finally:
+			shutil.rmtree(tmp_dir)
 
 
 	@mock.patch('pipeline.os.symlink')
@@ -614,8 +723,9 @@ class TestMultipleFlowcellFunctionality(unittest.TestCase):
 		'''
 		This tests the case where the same sample is run on multiple flowcells-- need to merge the fastq files from them
 		'''
-		mock_os.path.isfile.return_value = False # means no existing 'final' fastq file	
 		mock_sample_dir = '/path/to/original/Project_ABC/Sample_XX_1'
+		# only the new fastq from this demux exists- no existing 'final' fastq file
+		mock_os.path.isfile.side_effect = lambda x: x == os.path.join(mock_sample_dir, 'XX_1_R1_.tmp.fastq.gz')
 
 		# mock there being no prior flowcells run which had this sample
 		mock_glob.glob.return_value = []
@@ -631,8 +741,7 @@ class TestMultipleFlowcellFunctionality(unittest.TestCase):
 
 		tmp_fastq_tag = 'tmp'
 		p = pipeline.Pipeline()
-		p.config_params_dict = {'sample_dir_prefix':'Sample_', 'tmp_fastq_tag': tmp_fastq_tag, 'final_fastq_tag': 'final'}
-		p.execute_call = mock.Mock()
+		p.config_params_dict = {'sample_dir_prefix':'Sample_', 'tmp_fastq_tag': tmp_fastq_tag, 'final_fastq_tag': 'final', 'flowcell_prefix': 'fc'}
 		p.merge_and_rename_fastq(mock_sample_dir, 1)
 
 		mock_rename_calls = [mock.call(mock_new_fastq, mock_new_fc_fastq),]
@@ -643,5 +752,1578 @@ class TestMultipleFlowcellFunctionality(unittest.TestCase):
 
 
 
+class TestCheckpoints(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		self.run_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.run_dir)
+
+	def test_checkpoint_roundtrip(self):
+		p = pipeline.NextSeqPipeline(self.run_dir)
+		p.config_params_dict = {'checkpoint_file': 'checkpoint.json', 'demux_output_dir': '/path/to/bcl2fastq2_output'}
+		p.project_id_list = ['Project_X']
+		p.target_dir = '/path/to/target'
+		p.fc_index_map = {'Project_X': 2}
+		p.write_checkpoint('demux')
+		p.write_checkpoint('create_final_locations')
+
+		p2 = pipeline.NextSeqPipeline(self.run_dir, resume = True)
+		p2.config_params_dict = {'checkpoint_file': 'checkpoint.json'}
+		p2.load_checkpoint()
+		self.assertEqual(p2.completed_stages, ['demux', 'create_final_locations'])
+		self.assertEqual(p2.project_id_list, ['Project_X'])
+		self.assertEqual(p2.target_dir, '/path/to/target')
+		self.assertEqual(p2.fc_index_map, {'Project_X': 2})
+
+	@mock.patch('pipeline.Pipeline.upload_project')
+	@mock.patch('pipeline.Pipeline.write_project_descriptor_file')
+	@mock.patch('pipeline.Pipeline.run_fastqc_for_sample')
+	@mock.patch('pipeline.Pipeline.merge_sample_fastq_files')
+	@mock.patch('pipeline.Pipeline.concatenate_sample_fastq_files')
+	@mock.patch('pipeline.Pipeline.create_final_locations')
+	@mock.patch('pipeline.Pipeline.analyze_undetermined')
+	@mock.patch('pipeline.Pipeline.run_demux')
+	@mock.patch('pipeline.NextSeqPipeline.check_samplesheet')
+	@mock.patch('pipeline.Pipeline.parse_config_file')
+	def test_resume_starts_at_first_incomplete_stage(self, mock_config, mock_samplesheet, mock_demux, mock_undetermined, mock_locations, mock_concat, mock_merge, mock_fastqc, mock_descriptor, mock_upload):
+		output_dir = os.path.join(self.run_dir, 'bcl2fastq2_output')
+		os.mkdir(output_dir)
+		with open(os.path.join(self.run_dir, 'checkpoint.json'), 'w') as fout:
+			json.dump({'completed_stages': ['demux', 'undetermined_analysis', 'create_final_locations', 'concatenate:Project_X:A'], 'demux_output_dir': output_dir, 'state': {}}, fout)
+		mock_concat.return_value = ('B', [])
+		mock_upload.return_value = {'bucket': 'b', 'client_emails': []}
+
+		p = pipeline.NextSeqPipeline(self.run_dir, resume = True)
+		p.config_params_dict = {'checkpoint_file': 'checkpoint.json', 'demux_output_dir': 'bcl2fastq2_output', 'sample_dir_prefix': 'Sample_'}
+		p.project_to_email_mapping = {'Project_X': []}
+		p.project_id_list = ['Project_X']
+		p.project_to_sample_map = {'Project_X': ['A', 'B']}
+		p.target_dir = self.run_dir
+		p.run()
+
+		self.assertFalse(mock_demux.called)
+		self.assertFalse(mock_locations.called)
+		# only sample B still needed concatenating
+		mock_concat.assert_called_once_with('Project_X', os.path.join(output_dir, 'Project_X', 'Sample_B'))
+		self.assertEqual(mock_merge.call_count, 2)
+		self.assertTrue(mock_upload.called)
+		checkpoint = json.load(open(os.path.join(self.run_dir, 'checkpoint.json')))
+		self.assertEqual(checkpoint['completed_stages'][-2:], ['upload:Project_X', 'process_samples'])
+		self.assertEqual(checkpoint['state']['project_to_bucket_mapping'], {'Project_X': {'bucket': 'b', 'client_emails': []}})
+
+
+
+class TestFastqConcatenation(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+		self.sources = []
+		for i in range(3):
+			path = os.path.join(self.tmp_dir, 'L00%d.fastq.gz' % (i+1))
+			with open(path, 'wb') as fout:
+				fout.write(('lane%d' % (i+1)) * (1000 * (i+1)))
+			self.sources.append(path)
+		self.expected = ''.join([open(f, 'rb').read() for f in self.sources])
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def test_concatenate(self):
+		import fastq_concat
+		destination = os.path.join(self.tmp_dir, 'merged.fastq.gz')
+		self.assertEqual(fastq_concat.concatenate(self.sources, destination), len(self.expected))
+		self.assertEqual(open(destination, 'rb').read(), self.expected)
+
+	def test_append(self):
+		import fastq_concat
+		destination = os.path.join(self.tmp_dir, 'merged.fastq.gz')
+		fastq_concat.concatenate(self.sources[:1], destination)
+		fastq_concat.concatenate(self.sources[1:], destination, append = True)
+		self.assertEqual(open(destination, 'rb').read(), self.expected)
+
+	def test_failed_append_is_rolled_back(self):
+		import fastq_concat
+		destination = os.path.join(self.tmp_dir, 'final.fastq.gz')
+		with open(destination, 'wb') as fout:
+			fout.write('existing')
+		with self.assertRaises(OSError):
+			fastq_concat.append_with_journal([self.sources[0], os.path.join(self.tmp_dir, 'missing.fastq.gz')], destination)
+		self.assertEqual(open(destination, 'rb').read(), 'existing')
+		self.assertFalse(os.path.exists(fastq_concat.journal_path(destination)))
+
+	def test_fallback_to_buffered_copy(self):
+		import errno
+		import fastq_concat
+		def unsupported(fd_in, fd_out, count):
+			raise OSError(errno.ENOSYS, 'not supported')
+		destination = os.path.join(self.tmp_dir, 'merged.fastq.gz')
+		with mock.patch('fastq_concat.COPY_METHODS', [unsupported, fastq_concat.buffered_copy]):
+			fastq_concat.concatenate(self.sources, destination)
+		self.assertEqual(open(destination, 'rb').read(), self.expected)
+
+	def test_observers_with_kernel_copy(self):
+		import errno
+		import fastq_concat
+		class Collector(object):
+			def __init__(self):
+				self.data = ''
+			def update(self, data):
+				self.data += data
+		copied = []
+		def kernel_copy(fd_in, fd_out, count):
+			data = os.read(fd_in, min(count, 5))
+			os.write(fd_out, data)
+			copied.append(len(data))
+			return len(data)
+		def unsupported(fd_in, fd_out, count):
+			raise OSError(errno.ENOSYS, 'not supported')
+		destination = os.path.join(self.tmp_dir, 'merged.fastq.gz')
+		# the observers do not stop the kernel copy from being used
+		collector = Collector()
+		with mock.patch('fastq_concat.copy_file_range', kernel_copy):
+			fastq_concat.concatenate(self.sources, destination, observers = [collector])
+		self.assertEqual(sum(copied), len(self.expected))
+		self.assertEqual(collector.data, self.expected)
+		self.assertEqual(open(destination, 'rb').read(), self.expected)
+
+		# and they see the data of the buffered copy, if the kernel copy is not supported
+		collector = Collector()
+		with mock.patch('fastq_concat.copy_file_range', unsupported):
+			with mock.patch('fastq_concat.sendfile', unsupported):
+				fastq_concat.concatenate(self.sources, destination, observers = [collector])
+		self.assertEqual(collector.data, self.expected)
+		self.assertEqual(open(destination, 'rb').read(), self.expected)
+
+	def test_parallel_jobs(self):
+		import fastq_concat
+		jobs = [(self.sources, os.path.join(self.tmp_dir, 'R%d.fastq.gz' % r)) for r in (1, 2)]
+		self.assertEqual(fastq_concat.concatenate_all(jobs, 2), [len(self.expected)] * 2)
+		for sources, destination in jobs:
+			self.assertEqual(open(destination, 'rb').read(), self.expected)
+
+
+
+class TestChecksums(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def test_checksums_computed_during_concatenation(self):
+		import hashlib
+		import checksums
+		import fastq_concat
+		sources = []
+		for i in range(2):
+			sources.append(os.path.join(self.tmp_dir, 'L00%d.fastq.gz' % i))
+			with open(sources[-1], 'wb') as fout:
+				fout.write('lane%d' % i * 5000)
+		destination = os.path.join(self.tmp_dir, 'merged.fastq.gz')
+		c = checksums.Checksummer()
+		fastq_concat.concatenate_all([(sources, destination, [c])], 2)
+		result = c.result()
+		self.assertEqual(result['md5'], hashlib.md5(open(destination, 'rb').read()).hexdigest())
+		self.assertEqual(result['size'], os.path.getsize(destination))
+		self.assertEqual(result, checksums.file_checksums(destination))
+
+	def test_manifest_and_md5sum_file(self):
+		import checksums
+		manifest = checksums.ChecksumManifest(self.tmp_dir, 'checksums.json')
+		a = os.path.join(self.tmp_dir, 'Sample_A', 'A_R1_.tmp.fastq.gz')
+		manifest.set(a, {'md5': 'd41d8cd98f00b204e9800998ecf8427e', 'size': 0})
+		a_fc1 = os.path.join(self.tmp_dir, 'Sample_A', 'A_R1_.fc1.fastq.gz')
+		a_final = os.path.join(self.tmp_dir, 'Sample_A', 'A_R1_.final.fastq.gz')
+		manifest.rename(a, a_fc1)
+		manifest.copy(a_fc1, a_final)
+		self.assertEqual(sorted(json.load(open(os.path.join(self.tmp_dir, 'checksums.json'))).keys()), ['Sample_A/A_R1_.fc1.fastq.gz', 'Sample_A/A_R1_.final.fastq.gz'])
+		md5sum_path = os.path.join(self.tmp_dir, 'md5sums.txt')
+		missing = manifest.write_md5sum_file({a_final: 'A_R1.fastq.gz', os.path.join(self.tmp_dir, 'B_R1_.final.fastq.gz'): 'B_R1.fastq.gz'}, md5sum_path)
+		self.assertEqual(open(md5sum_path).read(), 'd41d8cd98f00b204e9800998ecf8427e  A_R1.fastq.gz\n')
+		self.assertEqual(len(missing), 1)
+
+	def test_merge_keeps_manifest_current(self):
+		import checksums
+		sample_dir = os.path.join(self.tmp_dir, 'Sample_XX_1')
+		os.mkdir(sample_dir)
+		p = pipeline.Pipeline()
+		p.config_params_dict = {'sample_dir_prefix':'Sample_', 'tmp_fastq_tag': 'tmp', 'final_fastq_tag': 'final', 'flowcell_prefix': 'fc', 'compute_checksums': '1', 'checksum_manifest': 'checksums.json'}
+		manifest = checksums.ChecksumManifest(self.tmp_dir, 'checksums.json')
+		final_fastq = os.path.join(sample_dir, 'XX_1_R1_.final.fastq.gz')
+		for data in ['flowcell1', 'flowcell2', 'flowcell3']:
+			new_fastq = os.path.join(sample_dir, 'XX_1_R1_.tmp.fastq.gz')
+			with open(new_fastq, 'w') as fout:
+				fout.write(data)
+			manifest.set(new_fastq, checksums.file_checksums(new_fastq))
+			p.merge_and_rename_fastq(sample_dir, 1)
+			self.assertEqual(manifest.get(final_fastq), checksums.file_checksums(final_fastq))
+		self.assertEqual(manifest.get(os.path.join(sample_dir, 'XX_1_R1_.fc2.fastq.gz'))['size'], len('flowcell2'))
+		self.assertEqual(manifest.get(os.path.join(sample_dir, 'XX_1_R1_.tmp.fastq.gz')), None)
+
+	def test_parse_object_listing(self):
+		import demux_cloud_upload
+		listing = """gs://bucket/Fastq_Files/A_R1.fastq.gz:
+	Creation time:		Mon, 01 May 2017 15:30:01 GMT
+	Content-Length:		1234
+	Content-Type:		application/octet-stream
+	Hash (crc32c):		AAAAAA==
+	Hash (md5):		1B2M2Y8AsgTpgAmY7PhCfg==
+	ETag:			CJCFmqPn4tMCEAE=
+gs://bucket/Fastq_Files/B_R1.fastq.gz:
+	Content-Length:		10
+	Component-Count:	2
+	Hash (crc32c):		BBBBBB==
+"""
+		objects = demux_cloud_upload.parse_object_listing(listing)
+		self.assertEqual(objects['gs://bucket/Fastq_Files/A_R1.fastq.gz'], {'size': 1234, 'crc32c': 'AAAAAA==', 'md5': '1B2M2Y8AsgTpgAmY7PhCfg=='})
+		self.assertEqual(objects['gs://bucket/Fastq_Files/B_R1.fastq.gz'], {'size': 10, 'crc32c': 'BBBBBB=='})
+
+	@mock.patch('demux_cloud_upload.subprocess.Popen')
+	def test_gsutil_engine(self, mock_popen):
+		import demux_cloud_upload
+		import cloud_uploader
+		process = mock.MagicMock()
+		process.returncode = 0
+		process.communicate.return_value = ('', '')
+		mock_popen.return_value = process
+		sample_dir = os.path.join(self.tmp_dir, 'Sample_XX_1')
+		os.mkdir(sample_dir)
+		fastq = os.path.join(sample_dir, 'XX_1_R1_.final.fastq.gz')
+		with open(fastq, 'w') as fout:
+			fout.write('flowcell1')
+		container = mock.MagicMock()
+		container.name = 'bucket'
+		params = {'final_symlinked_fastq_directory': 'fastq_symlinks', 'compute_checksums': '0', 'final_fastq_tag': 'final', 
+			'sample_dir_prefix': 'Sample_', 'cccb_emails': ['staff@x.org']}
+		manifest = cloud_uploader.UploadManifest(os.path.join(self.tmp_dir, 'manifest.json'), 'bucket')
+		demux_cloud_upload.upload_fastq_dir([fastq], self.tmp_dir, container, 'Fastq_Files', params, manifest)
+		# the metadata is set by the upload itself
+		cmd = mock_popen.call_args[0][0]
+		self.assertTrue(cmd.startswith('gsutil -h "Content-Disposition:attachment; filename=XX_1_R1_.final.fastq.gz" -h "x-goog-meta-flowcells:1" -h "x-goog-meta-sample:XX_1" cp '))
+		self.assertTrue(cmd.endswith('fastq_symlinks/XX_1_R1.fastq.gz gs://bucket/Fastq_Files/XX_1_R1.fastq.gz'))
+
+		# unchanged files are not sent again
+		mock_popen.reset_mock()
+		demux_cloud_upload.upload_fastq_dir([fastq], self.tmp_dir, container, 'Fastq_Files', params, manifest)
+		self.assertFalse(mock_popen.called)
+
+		# the access is granted with gsutil, not the storage API
+		demux_cloud_upload.give_permissions(None, container, [], ['a@x.org', 'staff@x.org'], params)
+		self.assertEqual(mock_popen.call_args[0][0], 'gsutil iam ch user:staff@x.org:roles/storage.objectAdmin user:a@x.org:roles/storage.objectViewer gs://bucket')
+
+	def test_md5_encoding(self):
+		import checksums
+		self.assertEqual(checksums.md5_hex_to_base64('d41d8cd98f00b204e9800998ecf8427e'), '1B2M2Y8AsgTpgAmY7PhCfg==')
+
+
+
+class TestStageExecutor(unittest.TestCase):
+
+	def test_tasks_run_after_dependencies(self):
+		import stage_executor
+		order = []
+		executor = stage_executor.StageExecutor(4)
+		executor.add('merge', order.append, ('merge',), ['concatenate'])
+		executor.add('concatenate', order.append, ('concatenate',))
+		executor.add('upload', order.append, ('upload',), ['merge', 'previous'])
+		executor.add('previous', None, completed = True)
+		completed = []
+		failed = executor.run(lambda name, result: completed.append(name))
+		self.assertEqual(failed, [])
+		self.assertEqual(order, ['concatenate', 'merge', 'upload'])
+		self.assertEqual(completed, ['concatenate', 'merge', 'upload'])
+
+	def test_failure_skips_dependents_only(self):
+		import stage_executor
+		def fail():
+			sys.exit(1)
+		ran = []
+		executor = stage_executor.StageExecutor(2)
+		executor.add('a1', fail)
+		executor.add('a2', ran.append, ('a2',), ['a1'])
+		executor.add('a3', ran.append, ('a3',), ['a2'])
+		executor.add('b1', ran.append, ('b1',))
+		executor.add('b2', ran.append, ('b2',), ['b1'])
+		failed = executor.run()
+		self.assertEqual(sorted(failed), ['a1', 'a2', 'a3'])
+		self.assertEqual(sorted(ran), ['b1', 'b2'])
+
+	def test_unknown_dependency(self):
+		import stage_executor
+		executor = stage_executor.StageExecutor(1)
+		executor.add('a', len, ('a',), ['missing'])
+		with self.assertRaises(ValueError):
+			executor.run()
+
+
+
+class TestShardedDemux(unittest.TestCase):
+
+	run_info_xml = """<?xml version="1.0"?>
+<RunInfo xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" Version="2">
+  <Run Id="150211_NS500749_0002_AH5GMMBGXX" Number="2">
+    <Flowcell>H5GMMBGXX</Flowcell>
+    <Instrument>NS500749</Instrument>
+    <Date>150211</Date>
+    <Reads>
+      <Read Number="1" NumCycles="76" IsIndexedRead="N" />
+      <Read Number="2" NumCycles="8" IsIndexedRead="Y" />
+      <Read Number="3" NumCycles="76" IsIndexedRead="N" />
+    </Reads>
+    <FlowcellLayout LaneCount="4" SurfaceCount="2" SwathCount="3" TileCount="12" SectionPerLane="3" LanePerSection="2" />
+  </Run>
+</RunInfo>
+"""
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def test_parse_run_info(self):
+		import run_info
+		with open(os.path.join(self.tmp_dir, 'RunInfo.xml'), 'w') as fout:
+			fout.write(self.run_info_xml)
+		info = run_info.parse_run_info(self.tmp_dir)
+		self.assertEqual(info['lane_count'], 4)
+		self.assertEqual(info['surface_count'], 2)
+		self.assertEqual([r['cycles'] for r in info['reads']], [76, 8, 76])
+		self.assertEqual([r['is_index'] for r in info['reads']], [False, True, False])
+
+	def test_shards_split_by_lane(self):
+		info = {'lane_count': 4, 'surface_count': 2}
+		self.assertEqual(demux_backends.plan_demux_shards(info, 2), ['s_[13]', 's_[24]'])
+		self.assertEqual(demux_backends.plan_demux_shards(info, 4), ['s_[1]', 's_[2]', 's_[3]', 's_[4]'])
+
+	def test_shards_split_by_surface(self):
+		info = {'lane_count': 2, 'surface_count': 2}
+		self.assertEqual(demux_backends.plan_demux_shards(info, 4), ['s_1_1', 's_1_2', 's_2_1', 's_2_2'])
+		# the requested number of shards, as long as there are enough lane surfaces
+		info = {'lane_count': 4, 'surface_count': 2}
+		self.assertEqual(demux_backends.plan_demux_shards(info, 5), ['s_1_1,s_3_2', 's_1_2,s_4_1', 's_2_1,s_4_2', 's_2_2', 's_3_1'])
+		info = {'lane_count': 4, 'surface_count': 1}
+		self.assertEqual(demux_backends.plan_demux_shards(info, 16), ['s_1_1', 's_2_1', 's_3_1', 's_4_1'])
+
+	def test_thread_counts(self):
+		# the threads of all the shards together do not exceed those available
+		self.assertEqual(demux_backends.demux_thread_counts(4, 32), (1, 6, 1))
+		self.assertEqual(demux_backends.demux_thread_counts(1, 32), (4, 24, 4))
+		self.assertEqual(demux_backends.demux_thread_counts(8, 4), (1, 1, 1))
+
+	def test_merge_shards(self):
+		import gzip
+		shard_1 = os.path.join(self.tmp_dir, 'shard_1')
+		shard_2 = os.path.join(self.tmp_dir, 'shard_2')
+		output_dir = os.path.join(self.tmp_dir, 'output')
+		os.makedirs(os.path.join(shard_1, 'Project_X', 'Sample_A'))
+		os.makedirs(os.path.join(shard_2, 'Project_X', 'Sample_A'))
+		os.mkdir(output_dir)
+		fq = os.path.join('Project_X', 'Sample_A', 'A_S1_L001_R1_001.fastq.gz')
+		for shard_dir, read in [(shard_1, '@r1\nACGT\n+\nFFFF\n'), (shard_2, '@r2\nTTTT\n+\nFFFF\n')]:
+			g = gzip.open(os.path.join(shard_dir, fq), 'wb')
+			g.write(read)
+			g.close()
+		demux_backends.merge_demux_shards([shard_2, shard_1], output_dir)
+		self.assertEqual(gzip.open(os.path.join(output_dir, fq)).read(), '@r1\nACGT\n+\nFFFF\n@r2\nTTTT\n+\nFFFF\n')
+		self.assertFalse(os.path.exists(os.path.join(shard_1, fq)))
+
+	def test_merge_stats(self):
+		import json
+		import undetermined_analysis
+		output_dir = os.path.join(self.tmp_dir, 'output')
+		os.mkdir(output_dir)
+		# lane 1 was split by surface between the two shards
+		shard_dirs = []
+		for i, reads in enumerate([100, 50]):
+			shard_dir = os.path.join(self.tmp_dir, 'shard_%d' % (i + 1))
+			os.makedirs(os.path.join(shard_dir, 'Stats'))
+			os.makedirs(os.path.join(shard_dir, 'Reports'))
+			stats = {'Flowcell': 'FC1',
+				'ReadInfosForLanes': [{'LaneNumber': 1, 'ReadInfos': [{'Number': 1, 'NumCycles': 76, 'IsIndexedRead': False}]}],
+				'ConversionResults': [{'LaneNumber': 1, 'TotalClustersPF': reads + 10,
+					'DemuxResults': [{'SampleId': 'A', 'SampleName': 'A', 'NumberReads': reads, 'Yield': reads * 76}],
+					'Undetermined': {'NumberReads': 10, 'Yield': 760}}],
+				'UnknownBarcodes': [{'Lane': 1, 'Barcodes': {'AAAA': 3 + i}}]}
+			json.dump(stats, open(os.path.join(shard_dir, 'Stats', 'Stats.json'), 'w'))
+			shard_dirs.append(shard_dir)
+		demux_backends.merge_demux_stats(shard_dirs, output_dir)
+		combined = json.load(open(os.path.join(output_dir, 'Stats', 'Stats.json')))
+		lane = combined['ConversionResults'][0]
+		self.assertEqual(lane['LaneNumber'], 1)
+		self.assertEqual(lane['TotalClustersPF'], 170)
+		self.assertEqual(lane['DemuxResults'], [{'SampleId': 'A', 'SampleName': 'A', 'NumberReads': 150, 'Yield': 150 * 76}])
+		self.assertEqual(lane['Undetermined']['NumberReads'], 20)
+		self.assertEqual(combined['ReadInfosForLanes'][0]['ReadInfos'][0]['NumCycles'], 76)
+		self.assertEqual(combined['UnknownBarcodes'], [{'Lane': 1, 'Barcodes': {'AAAA': 7}}])
+		self.assertTrue(os.path.isdir(os.path.join(output_dir, 'Reports', 'shard_2')))
+		self.assertEqual(undetermined_analysis.assigned_reads_per_lane(output_dir), {1: 150})
+
+	def test_previous_shards_removed(self):
+		output_dir = os.path.join(self.tmp_dir, 'output')
+		shard_root = os.path.join(output_dir, 'demux_shards')
+		os.makedirs(os.path.join(shard_root, 'shard_1', 'Project_X'))
+		os.makedirs(os.path.join(output_dir, 'Project_X', 'Sample_A'))
+		merged = os.path.join(output_dir, 'Project_X', 'Sample_A', 'A_S1_L001_R1_001.fastq.gz')
+		open(merged, 'w').write('partial')
+		demux_backends.remove_previous_shards(shard_root, output_dir)
+		self.assertFalse(os.path.exists(shard_root))
+		self.assertFalse(os.path.exists(merged))
+
+
+
+class TestRedemux(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def test_barcode_distances(self):
+		import barcodes
+		samples = barcodes.encode(['ACGTAC', 'TTGCAA'])
+		reads = barcodes.encode(['ACGTAC', 'ACGTAA', 'NCGTAC', 'GGGGGG', 'ACG'], 6)
+		self.assertEqual(barcodes.hamming_distance_matrix(reads, samples)[:,0].tolist(), [0, 1, 1, 5, 3])
+		self.assertEqual(barcodes.assign(reads, samples, 1).tolist(), [0, 0, 0, -1, -1])
+		self.assertEqual(barcodes.assign(reads, samples, 0).tolist(), [0, -1, -1, -1, -1])
+
+	def test_ambiguous_barcode_not_assigned(self):
+		import barcodes
+		samples = barcodes.encode(['AAAA', 'AATT'])
+		# one mismatch from each sample
+		self.assertEqual(barcodes.assign(barcodes.encode(['AAAT']), samples, 1).tolist(), [-1])
+
+	def test_header_barcode(self):
+		import barcodes
+		self.assertEqual(barcodes.header_barcode('@NS500749:2:H5GMMBGXX:1:11101:10000:1000 1:N:0:ATCACG+GTTACA\n'), 'ATCACGGTTACA')
+		self.assertEqual(barcodes.reverse_complement('ATCACGN'), 'NCGTGAT')
+
+	def test_redemux_undetermined(self):
+		import gzip
+		r1 = os.path.join(self.tmp_dir, 'Undetermined_S0_L001_R1_001.fastq.gz')
+		r2 = os.path.join(self.tmp_dir, 'Undetermined_S0_L001_R2_001.fastq.gz')
+		for path, read in [(r1, '1'), (r2, '2')]:
+			g = gzip.open(path, 'wb')
+			g.write('@a %s:N:0:ACGTAA\nAAAA\n+\nFFFF\n' % read)
+			g.write('@b %s:N:0:GGGGGG\nCCCC\n+\nFFFF\n' % read)
+			g.write('@c %s:N:0:TTGCAA\nGGGG\n+\nFFFF\n' % read)
+			g.close()
+		samples = [{'project': 'Project_X', 'sample_id': 'Sample_A', 'sample_name': 'A', 'number': 1, 'barcode': 'ACGTAC'},
+				{'project': 'Project_X', 'sample_id': 'Sample_B', 'sample_name': 'B', 'number': 2, 'barcode': 'TTGCAA'}]
+		counts = demux_backends.redemux_undetermined(r1, samples, self.tmp_dir, 1, 2)
+		self.assertEqual(counts.tolist(), [1, 1, 1])
+		sample_a = os.path.join(self.tmp_dir, 'Project_X', 'Sample_A')
+		self.assertEqual(gzip.open(os.path.join(sample_a, 'A_S1_L001_R1_001.fastq.gz')).read(), '@a 1:N:0:ACGTAA\nAAAA\n+\nFFFF\n')
+		self.assertEqual(gzip.open(os.path.join(sample_a, 'A_S1_L001_R2_001.fastq.gz')).read(), '@a 2:N:0:ACGTAA\nAAAA\n+\nFFFF\n')
+		self.assertEqual(gzip.open(r1).read(), '@b 1:N:0:GGGGGG\nCCCC\n+\nFFFF\n')
+		self.assertFalse(os.path.exists(r1 + '.redemux.tmp'))
+
+	def test_redemux_is_not_repeated(self):
+		import gzip
+		r1 = os.path.join(self.tmp_dir, 'Undetermined_S0_L001_R1_001.fastq.gz')
+		g = gzip.open(r1, 'wb')
+		g.write('@a 1:N:0:ACGTAA\nAAAA\n+\nFFFF\n@b 1:N:0:GGGGGG\nCCCC\n+\nFFFF\n')
+		g.close()
+		sample_a = os.path.join(self.tmp_dir, 'Project_X', 'Sample_A')
+		os.makedirs(sample_a)
+		fq = os.path.join(sample_a, 'A_S1_L001_R1_001.fastq.gz')
+		g = gzip.open(fq, 'wb')
+		g.write('@x 1:N:0:ACGTAC\nTTTT\n+\nFFFF\n')
+		g.close()
+		samples = [{'project': 'Project_X', 'sample_id': 'Sample_A', 'sample_name': 'A', 'number': 1, 'barcode': 'ACGTAC'}]
+		expected = '@x 1:N:0:ACGTAC\nTTTT\n+\nFFFF\n@a 1:N:0:ACGTAA\nAAAA\n+\nFFFF\n'
+
+		# interrupted after the sample file was replaced, but before the undetermined file was
+		with mock.patch('demux_backends.finish_redemux_commit') as mock_finish:
+			demux_backends.redemux_undetermined(r1, samples, self.tmp_dir, 1, 2)
+		self.assertTrue(os.path.isfile(r1 + '.redemux.commit'))
+		os.rename(fq + '.redemux.tmp', fq)
+		demux_backends.redemux_undetermined(r1, samples, self.tmp_dir, 1, 2)
+		self.assertEqual(gzip.open(fq).read(), expected)
+		self.assertEqual(gzip.open(r1).read(), '@b 1:N:0:GGGGGG\nCCCC\n+\nFFFF\n')
+		self.assertFalse(os.path.exists(r1 + '.redemux.commit'))
+
+		# running it again does not add the reads twice
+		demux_backends.redemux_undetermined(r1, samples, self.tmp_dir, 1, 2)
+		self.assertEqual(gzip.open(fq).read(), expected)
+
+	def test_samples_numbered_once(self):
+		pipeline = mock.MagicMock()
+		pipeline.samplesheet_rows = [{'Lane': '1', 'Sample_ID': 'A', 'Sample_Name': '', 'Sample_Project': 'P', 'index': 'AAAA'},
+				{'Lane': '1', 'Sample_ID': 'B', 'Sample_Name': 'B', 'Sample_Project': 'P', 'index': 'CCCC'},
+				{'Lane': '2', 'Sample_ID': 'A', 'Sample_Name': '', 'Sample_Project': 'P', 'index': 'AAAA'}]
+		samples = demux_backends.UndeterminedRedemuxBackend(pipeline).get_samples()
+		self.assertEqual([(s['sample_name'], s['number'], s['lane']) for s in samples], [('A', 1, 1), ('B', 2, 1), ('A', 1, 2)])
+
+	def test_unknown_backend(self):
+		with self.assertRaises(SystemExit):
+			demux_backends.get_backend('not_a_demuxer')
+
+
+
+class TestUndeterminedAnalysis(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		import gzip
+		self.tmp_dir = tempfile.mkdtemp()
+		self.fq = os.path.join(self.tmp_dir, 'Undetermined_S0_L001_R1_001.fastq.gz')
+		g = gzip.open(self.fq, 'wb')
+		for i, index in enumerate(['AAAA+CCCC']*3 + ['GGGG+TTTT']*2 + ['AAAA+TTTT', 'GGGG+GGGG']):
+			g.write('@r%d 1:N:0:%s\nACGT\n+\nFFFF\n' % (i, index))
+		g.close()
+		# sample A is AAAA+GGGG (so the i5 in the reads is reverse-complemented), sample B is GGGG+TTTT
+		self.samples = [('Sample_A', 'AAAA', 'GGGG'), ('Sample_B', 'GGGG', 'TTTT')]
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def test_count_indexes(self):
+		import undetermined_analysis
+		# a small chunk size, so records are split across chunks
+		codes, counts, i7_length, i5_length = undetermined_analysis.count_indexes(self.fq, 37)
+		observed = dict((undetermined_analysis.decode_sequence(c, 8), n) for c, n in zip(codes, counts))
+		self.assertEqual(observed, {'AAAACCCC': 3, 'GGGGTTTT': 2, 'AAAATTTT': 1, 'GGGGGGGG': 1})
+		self.assertEqual((i7_length, i5_length), (4, 4))
+
+	def test_explain_indexes(self):
+		import undetermined_analysis
+		explanations = undetermined_analysis.explain_indexes([('AAAA', 'CCCC'), ('AAAA', 'TTTT'), ('ACAA', 'GGGG'), ('CACA', 'CACA')], self.samples, 2)
+		self.assertEqual(explanations[0], 'Sample_A: i5 (index2) is reverse-complemented')
+		self.assertEqual(explanations[1], 'index hopping between Sample_A (i7) and Sample_B (i5)')
+		self.assertEqual(explanations[2], '1 mismatch(es) from Sample_A')
+		self.assertEqual(explanations[3], '')
+
+	def test_hopping(self):
+		import undetermined_analysis
+		codes, counts, i7_length, i5_length = undetermined_analysis.count_indexes(self.fq)
+		# AAAA+TTTT and GGGG+GGGG are combinations of the two samples' indexes
+		self.assertEqual(undetermined_analysis.count_hopped_reads(codes, counts, self.samples, i7_length, i5_length), 2)
+
+	def test_reports(self):
+		import undetermined_analysis
+		rows = [{'Sample_ID': s, 'index': i7, 'index2': i5} for s, i7, i5 in self.samples]
+		os.mkdir(os.path.join(self.tmp_dir, 'Stats'))
+		json.dump({'ConversionResults': [{'LaneNumber': 1, 'DemuxResults': [{'NumberReads': 98}]}]}, open(os.path.join(self.tmp_dir, 'Stats', 'Stats.json'), 'w'))
+		barcode_report = os.path.join(self.tmp_dir, 'barcodes.tsv')
+		hopping_report = os.path.join(self.tmp_dir, 'hopping.tsv')
+		undetermined_analysis.analyze(self.tmp_dir, rows, barcode_report, hopping_report)
+		barcode_lines = open(barcode_report).read().splitlines()
+		self.assertEqual(barcode_lines[1].split('\t')[:4], ['1', 'AAAA', 'CCCC', '3'])
+		self.assertEqual(open(hopping_report).read().splitlines()[1].split('\t'), ['1', '7', '98', '2', '0.02000'])
+
+	def test_reports_without_stats(self):
+		import undetermined_analysis
+		rows = [{'Sample_ID': s, 'index': i7, 'index2': i5} for s, i7, i5 in self.samples]
+		hopping_report = os.path.join(self.tmp_dir, 'hopping.tsv')
+		undetermined_analysis.analyze(self.tmp_dir, rows, os.path.join(self.tmp_dir, 'barcodes.tsv'), hopping_report)
+		# the rate is not known, rather than 100%
+		self.assertEqual(open(hopping_report).read().splitlines()[1].split('\t'), ['1', '7', 'NA', '2', 'NA'])
+
+
+
+class TestReadStats(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def write_fastq(self, path, records):
+		import gzip
+		handle = gzip.open(path, 'wb')
+		for i, (seq, qual) in enumerate(records):
+			handle.write('@read%d 1:N:0:ACGT\n%s\n+\n%s\n' % (i, seq, qual))
+		handle.close()
+
+	def test_stats_split_across_chunks(self):
+		import read_stats
+		text = '@r1\nACGT\n+\nII#I\n@r2\nAC\n+\n##\n'
+		for split in range(len(text)):
+			stats = read_stats.ReadStats()
+			stats.update(text[:split])
+			stats.update(text[split:])
+			result = stats.result()
+			self.assertEqual((result['reads'], result['bases']), (2, 6))
+			self.assertAlmostEqual(result['mean_quality'], (40*3 + 2*3)/6.0)
+			self.assertAlmostEqual(result['q30_fraction'], 0.5)
+
+	def test_stats_computed_during_concatenation(self):
+		import read_stats
+		import fastq_concat
+		sources = []
+		for lane in range(3):
+			sources.append(os.path.join(self.tmp_dir, 'L00%d.fastq.gz' % lane))
+			self.write_fastq(sources[-1], [('ACGTN', 'IIII#')] * (1000 * (lane + 1)))
+		observer = read_stats.ReadStatsObserver()
+		fastq_concat.concatenate(sources, os.path.join(self.tmp_dir, 'merged.fastq.gz'), observers = [observer])
+		result = observer.result()
+		self.assertEqual(result['reads'], 6000)
+		self.assertEqual(result['bases'], 30000)
+		self.assertAlmostEqual(result['q30_fraction'], 0.8)
+
+	def test_observer_errors(self):
+		import zlib
+		import read_stats
+		observer = read_stats.ReadStatsObserver()
+		for i in range(2 * read_stats.MAX_PENDING_CHUNKS):
+			observer.update('not gzip data')
+		with self.assertRaises(zlib.error):
+			observer.result()
+		observer = read_stats.ReadStatsObserver()
+		observer.update('not gzip data')
+		observer.cancel()
+		self.assertFalse(observer.thread.is_alive())
+
+	def test_table_flags_mismatched_pairs(self):
+		import read_stats
+		table = read_stats.ReadStatsTable(self.tmp_dir, 'read_stats.tsv')
+		stats = {'reads': 10, 'bases': 500, 'mean_quality': 35.0, 'q30_fraction': 0.9}
+		self.assertTrue(table.add_sample('A', 'fc1', {1: stats, 2: stats}))
+		self.assertFalse(table.add_sample('B', 'fc1', {1: stats, 2: dict(stats, reads = 9)}))
+		# a repeated sample replaces its earlier rows
+		self.assertTrue(table.add_sample('A', 'fc1', {1: stats, 2: stats}))
+		rows = table.load()
+		self.assertEqual([(r['sample'], r['read'], r['pairs_consistent']) for r in rows], [('A', 'R1', 'True'), ('A', 'R2', 'True'), ('B', 'R1', 'False'), ('B', 'R2', 'False')])
+
+
+
+class TestFastQCRunner(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+		# a stand-in for fastqc which records its arguments and creates the report directories
+		self.fastqc = os.path.join(self.tmp_dir, 'fastqc')
+		self.log = os.path.join(self.tmp_dir, 'calls.txt')
+		with open(self.fastqc, 'w') as fout:
+			fout.write('#!/bin/bash\necho "$@" >> %s\nshift 2\nfor f in "$@"; do mkdir -p ${f%%.fastq.gz}_fastqc; done\n' % self.log)
+		os.chmod(self.fastqc, 0755)
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def test_files_are_batched(self):
+		import fastqc_runner
+		files = [os.path.join(self.tmp_dir, 'S%d_R1_.final.fastq.gz' % i) for i in range(5)]
+		completed = []
+		fastqc_runner.run_all(self.fastqc, files, 2, 2, on_complete = completed.append)
+		calls = sorted(open(self.log).read().splitlines())
+		self.assertEqual(calls, sorted(['-t 2 %s %s' % tuple(files[0:2]), '-t 2 %s %s' % tuple(files[2:4]), '-t 1 %s' % files[4]]))
+		self.assertEqual(sorted(completed), files)
+		self.assertTrue(all([os.path.isdir(fastqc_runner.output_dir(f)) for f in files]))
+
+	def test_failure_exits(self):
+		p = pipeline.Pipeline()
+		p.config_params_dict = {'fastqc_path': 'false', 'fastqc_workers': '2', 'fastqc_batch_size': '2'}
+		with self.assertRaises(SystemExit):
+			p.run_fastqc_on_files([os.path.join(self.tmp_dir, 'A_R1_.final.fastq.gz')])
+
+
+
+class TestFastQCCache(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+		self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def make_report(self, fq, size):
+		import fastqc_runner
+		os.mkdir(fastqc_runner.output_dir(fq))
+		with open(os.path.join(fastqc_runner.output_dir(fq), 'fastqc_data.txt'), 'w') as fout:
+			fout.write('x' * size)
+
+	def test_store_restore_and_evict(self):
+		import shutil
+		import fastqc_cache
+		import fastqc_runner
+		cache = fastqc_cache.FastQCCache(self.cache_dir, 250)
+		files = []
+		for i in range(3):
+			files.append(os.path.join(self.tmp_dir, 'S%d_R1_.final.fastq.gz' % i))
+			open(files[-1], 'w').write('fastq%d' % i)
+			self.make_report(files[-1], 100)
+		keys = [cache.key(f) for f in files]
+		cache.store(keys[0], fastqc_runner.outputs(files[0]))
+		cache.store(keys[1], fastqc_runner.outputs(files[1]))
+		os.utime(cache.entry_path(keys[0]), (1, 1))
+		cache.store(keys[2], fastqc_runner.outputs(files[2]))
+		# the least recently used entry was evicted to stay under the limit
+		self.assertFalse(os.path.isdir(cache.entry_path(keys[0])))
+
+		shutil.rmtree(fastqc_runner.output_dir(files[1]))
+		self.assertTrue(cache.restore(keys[1], fastqc_runner.outputs(files[1])))
+		self.assertEqual(len(open(os.path.join(fastqc_runner.output_dir(files[1]), 'fastqc_data.txt')).read()), 100)
+		self.assertFalse(cache.restore(keys[0], fastqc_runner.outputs(files[0])))
+
+		# the same content under a checksum key, or a changed file, gives a different key
+		self.assertNotEqual(cache.key(files[1], {'md5': 'abc', 'size': 6}), keys[1])
+		self.assertEqual(cache.key(files[1], {'md5': 'abc', 'size': 6}), cache.key(files[1], {'md5': 'abc', 'size': 6}))
+		# the reports of another QC engine are kept apart
+		other = fastqc_cache.FastQCCache(self.cache_dir, 250, 'native:0.11.5')
+		self.assertNotEqual(other.key(files[1]), keys[1])
+
+	def test_cache_hit_skips_fastqc(self):
+		import fastqc_runner
+		fq = os.path.join(self.tmp_dir, 'A_R1_.final.fastq.gz')
+		open(fq, 'w').write('fastq')
+		p = pipeline.Pipeline()
+		p.config_params_dict = {'fastqc_path': 'false', 'fastqc_workers': '1', 'fastqc_batch_size': '1', 'fastqc_cache_dir': self.cache_dir}
+		cache = p.fastqc_cache()
+		self.make_report(fq, 10)
+		cache.store(cache.key(fq), fastqc_runner.outputs(fq))
+		# fastqc_path would fail if it were run
+		p.run_fastqc_on_files([fq])
+		self.assertTrue(os.path.isfile(os.path.join(fastqc_runner.output_dir(fq), 'fastqc_data.txt')))
+
+		# with the native engine, the fastQC report is not used
+		p.config_params_dict['qc_backend'] = 'native'
+		self.assertNotEqual(p.fastqc_cache().key(fq), cache.key(fq))
+
+
+
+class TestQCEngine(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def write_fastq(self, path, records, mode = 'wb'):
+		import gzip
+		handle = gzip.open(path, mode)
+		for i, (seq, qual) in enumerate(records):
+			handle.write('@read%d 1:N:0:ACGT\n%s\n+\n%s\n' % (i, seq, qual))
+		handle.close()
+
+	def test_statistics(self):
+		import qc_engine
+		stats = qc_engine.QCStats()
+		text = '@r1\nACGTN\n+\nIIII#\n@r2\nGGCC\n+\n5555\n'
+		stats.update(text[:20])
+		stats.update(text[20:])
+		self.assertEqual(stats.reads, 2)
+		self.assertEqual(list(stats.position_bases[0]), [1, 0, 1, 0, 0])
+		self.assertEqual(list(stats.position_bases[4]), [0, 0, 0, 0, 1])
+		self.assertEqual(stats.position_quality[0, 40], 1)
+		self.assertEqual(stats.position_quality[0, 20], 1)
+		self.assertEqual([i for i, c in enumerate(stats.lengths) if c], [4, 5])
+		self.assertEqual(stats.sequence_gc[50], 1)
+		self.assertEqual(stats.sequence_gc[100], 1)
+		# (40*4 + 2) // 5
+		self.assertEqual(stats.sequence_quality[32], 1)
+
+	def test_report_is_parsed_like_fastqc(self):
+		import qc_engine
+		import parse_fastqc_data
+		sample_dir = os.path.join(self.tmp_dir, 'Sample_A')
+		os.mkdir(sample_dir)
+		fq = os.path.join(sample_dir, 'A_R1_.final.fastq.gz')
+		# two gzip members, as the concatenated files have
+		self.write_fastq(fq, [('ACGTACGTAC', 'IIIIIIIIII')] * 500)
+		self.write_fastq(fq, [('TTGGCCAATT', 'IIIII#####')] * 500, 'ab')
+		qc_engine.run(fq)
+		report_dir = os.path.join(sample_dir, 'A_R1_.final_fastqc')
+		self.assertTrue(os.path.isfile(os.path.join(report_dir, 'fastqc_report.html')))
+		parse_fastqc_data.parse(self.tmp_dir)
+		table = open(os.path.join(self.tmp_dir, 'fastqc_output.tsv')).read().splitlines()
+		row = dict(zip(table[0].split('\t'), table[1].split('\t')))
+		self.assertEqual(row['Total Sequences'], '1000')
+		self.assertEqual(row['Sequence length'], '10')
+		self.assertEqual(row['Sequence Length Distribution'], 'pass')
+		self.assertEqual(row['Overrepresented sequences'], 'fail')
+
+	def test_merged_flowcells_use_stored_summaries(self):
+		import shutil
+		import qc_engine
+		sample_dir = os.path.join(self.tmp_dir, 'Sample_A')
+		os.mkdir(sample_dir)
+		p = pipeline.Pipeline()
+		p.config_params_dict = {'final_fastq_tag': 'final', 'flowcell_prefix': 'fc'}
+		final = os.path.join(sample_dir, 'A_R1_.final.fastq.gz')
+		fc1 = os.path.join(sample_dir, 'A_R1_.fc1.fastq.gz')
+		fc2 = os.path.join(sample_dir, 'A_R1_.fc2.fastq.gz')
+		self.write_fastq(fc1, [('ACGTACGTAC', 'IIIIIIIIII')] * 300)
+		os.symlink(fc1, final)
+		qc_engine.run(final, p.flowcell_fastq_files(final))
+		self.assertTrue(os.path.isfile(qc_engine.summary_path(fc1)))
+
+		# the second flowcell is appended to the final file
+		self.write_fastq(fc2, [('GGGGCCCCAA', '#####IIIII')] * 200)
+		os.remove(final)
+		shutil.copy(fc1, final)
+		open(final, 'ab').write(open(fc2, 'rb').read())
+		self.assertEqual(p.flowcell_fastq_files(final), [fc1, fc2])
+		original_compute = qc_engine.compute
+		read_files = []
+		def compute(fq):
+			read_files.append(fq)
+			return original_compute(fq)
+		with mock.patch('qc_engine.compute', side_effect = compute):
+			qc_engine.run(final, p.flowcell_fastq_files(final))
+		self.assertEqual(read_files, [fc2])
+		merged = open(os.path.join(sample_dir, 'A_R1_.final_fastqc', 'fastqc_data.txt')).read()
+		os.remove(qc_engine.summary_path(fc1))
+		qc_engine.run(final)
+		self.assertEqual(merged, open(os.path.join(sample_dir, 'A_R1_.final_fastqc', 'fastqc_data.txt')).read())
+
+
+
+class TestQCPreview(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def write_fastq(self, path, n):
+		import gzip
+		handle = gzip.open(path, 'wb')
+		for i in range(n):
+			handle.write('@read%d\nACGTACGTAC\n+\nIIIIIIIIII\n' % i)
+		handle.close()
+
+	def test_reservoir_sample(self):
+		import qc_preview
+		fq = os.path.join(self.tmp_dir, 'A.fastq.gz')
+		self.write_fastq(fq, 5000)
+		with mock.patch('qc_engine.INFLATE_SIZE', 4096):
+			sample = qc_preview.reservoir_sample(fq, 100, seed = 1).splitlines()
+		names = sample[0::4]
+		self.assertEqual(len(names), 100)
+		self.assertEqual(len(set(names)), 100)
+		self.assertEqual(sample[1::4], ['ACGTACGTAC'] * 100)
+		# reads from all through the file are sampled
+		self.assertTrue(max([int(x[len('@read'):]) for x in names]) > 2500)
+		self.assertEqual(len(qc_preview.reservoir_sample(fq, 10000).splitlines()), 4 * 5000)
+
+	def test_preview_replaced_by_full_qc(self):
+		import qc_engine
+		sample_dir = os.path.join(self.tmp_dir, 'Project_A', 'Sample_A')
+		os.makedirs(sample_dir)
+		fq = os.path.join(sample_dir, 'A_R1_.final.fastq.gz')
+		self.write_fastq(fq, 300)
+		p = pipeline.Pipeline()
+		p.target_dir = self.tmp_dir
+		p.config_params_dict = {'sample_dir_prefix': 'Sample_', 'final_fastq_tag': 'final', 'preview_reads': '100', 
+				'preview_qc_dir': '.preview_qc', 'preview_summary_file': 'fastqc_preview.tsv'}
+		p.preview_sample('Project_A', 'A')
+		summary = open(os.path.join(self.tmp_dir, 'Project_A', 'fastqc_preview.tsv')).read().splitlines()
+		row = dict(zip(summary[0].split('\t'), summary[1].split('\t')))
+		self.assertEqual(row['Total Sequences'], '100')
+		qc_engine.run(fq)
+		p.replace_previews([fq])
+		self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'Project_A', '.preview_qc')), [])
+		self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'Project_A', 'fastqc_preview.tsv')))
+
+
+
+class TestPermissions(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def mode(self, path):
+		import stat
+		return stat.S_IMODE(os.lstat(path).st_mode)
+
+	def test_fix_skips_correct_entries(self):
+		import permissions
+		for d in ['a/x', 'b', 'c']:
+			os.makedirs(os.path.join(self.tmp_dir, d))
+		for f in ['a/x/1.txt', 'b/2.txt', '3.txt']:
+			open(os.path.join(self.tmp_dir, f), 'w').close()
+		os.chmod(self.tmp_dir, 0700)
+		for d in ['a', 'a/x', 'b', 'c']:
+			os.chmod(os.path.join(self.tmp_dir, d), 0775)
+		for f in ['a/x/1.txt', 'b/2.txt', '3.txt']:
+			os.chmod(os.path.join(self.tmp_dir, f), 0600)
+		target = os.path.join(self.tmp_dir, 'c', 'target.txt')
+		open(target, 'w').close()
+		os.chmod(target, 0600)
+		os.symlink(target, os.path.join(self.tmp_dir, 'b', 'link'))
+		os.symlink(os.path.join(self.tmp_dir, 'missing'), os.path.join(self.tmp_dir, 'b', 'dangling'))
+
+		checked, changed = permissions.fix(self.tmp_dir, workers = 4)
+		# the root, 4 directories, 4 files and the link's target (the dangling link is skipped)
+		self.assertEqual(checked, 10)
+		self.assertEqual(changed, 5)
+		self.assertEqual(self.mode(self.tmp_dir), 0775)
+		for f in ['a/x/1.txt', 'b/2.txt', '3.txt', 'c/target.txt']:
+			self.assertEqual(self.mode(os.path.join(self.tmp_dir, f)), 0664)
+		self.assertEqual(permissions.fix(self.tmp_dir), (10, 0))
+
+	def test_link_targets_outside_the_tree(self):
+		import tempfile
+		import shutil
+		import permissions
+		outside_dir = tempfile.mkdtemp()
+		try:
+			target = os.path.join(outside_dir, 'A_R1_.fc1.fastq.gz')
+			open(target, 'w').close()
+			os.chmod(target, 0600)
+			os.symlink(target, os.path.join(self.tmp_dir, 'A_R1.fastq.gz'))
+			permissions.fix(self.tmp_dir)
+			self.assertEqual(self.mode(target), 0664)
+		finally:
+			shutil.rmtree(outside_dir)
+
+	def test_created_with_umask(self):
+		import permissions
+		previous = permissions.set_creation_umask()
+		try:
+			os.mkdir(os.path.join(self.tmp_dir, 'd'))
+			open(os.path.join(self.tmp_dir, 'd', 'f'), 'w').close()
+			os.chmod(self.tmp_dir, 0775)
+			# nothing needs a chmod
+			self.assertEqual(permissions.fix(self.tmp_dir), (3, 0))
+		finally:
+			os.umask(previous)
+
+	def test_created_with_mode(self):
+		import permissions
+		d = os.path.join(self.tmp_dir, 'd')
+		os.mkdir(d)
+		fd = permissions.open_with_mode(os.path.join(d, 'f'), os.O_WRONLY | os.O_CREAT, 0775)
+		os.close(fd)
+		self.assertEqual(self.mode(os.path.join(d, 'f')), 0775)
+		self.assertTrue('chmod calls saved' in permissions.summary())
+
+
+
+class TestSampleSheet(unittest.TestCase):
+
+	v1_text = """[Header]\r
+IEMFileVersion,4\r
+Email,Project_X,a@b.org,c@d.org\r
+Email,Project_Y,e@f.org\r
+\r
+[Reads]\r
+75\r
+[Data]\r
+Sample_ID,Sample_Name,Sample_Plate,Sample_Well,I7_Index_ID,index,I5_Index_ID,index2,Sample_Project,Description\r
+Sample_XX,XX,,,A001,ATCACGAT,B001,AGGCTATA,Project_X,\r
+Sample_YY,YY,,,A002,CGATGTAT,B002,GCCTCTAT,Project_X,\r
+Sample_ZZ,ZZ,,,A003,TTAGGCAT,B003,AGGATAGG,Project_Y,\r
+"""
+
+	v2_text = """[Header]
+FileFormatVersion,2
+Email,Project_X,a@b.org
+[BCLConvert_Settings]
+BarcodeMismatchesIndex1,1
+[BCLConvert_Data]
+Lane,Sample_ID,Index,Index2
+1,Sample_XX,ATCACGAT,AGGCTATA
+1,Sample_YY,ATCACGAT,AGGCTATT
+2,Sample_YY,ATCACGAT,AGGCTATT
+[Cloud_Data]
+Sample_ID,ProjectName,LibraryName
+Sample_XX,Project_X,XX
+Sample_YY,Project_X,YY
+"""
+
+	def test_v1_sheet(self):
+		import samplesheet
+		sheet = samplesheet.SampleSheet(text = self.v1_text)
+		self.assertEqual(sheet.version, 1)
+		self.assertEqual(sheet.emails, {'Project_X': ['a@b.org', 'c@d.org'], 'Project_Y': ['e@f.org']})
+		self.assertEqual(sheet.project_samples(), {'Project_X': ['XX', 'YY'], 'Project_Y': ['ZZ']})
+		self.assertEqual(sheet.samples['Sample_YY'][0]['index2'], 'GCCTCTAT')
+		self.assertEqual(sheet.invalid_rows('Sample_'), [])
+		self.assertEqual(sheet.index_collisions(3), [])
+
+	def test_v2_sheet_and_collisions(self):
+		import samplesheet
+		sheet = samplesheet.SampleSheet(text = self.v2_text)
+		self.assertEqual(sheet.version, 2)
+		self.assertEqual(sheet.rows[0]['index'], 'ATCACGAT')
+		self.assertEqual(sheet.rows[0]['Sample_Project'], 'Project_X')
+		# there is no Sample_Name, so the Sample_ID (without the prefix) is used
+		self.assertEqual(sheet.invalid_rows('Sample_'), [])
+		self.assertEqual(sheet.project_samples('Sample_'), {'Project_X': ['XX', 'YY']})
+		# only lane 1 has both samples
+		self.assertEqual(sheet.index_collisions(3), [('1', 'Sample_XX', 'Sample_YY', 1)])
+		self.assertEqual(sheet.index_collisions(1), [])
+
+	def test_invalid_rows_and_missing_sections(self):
+		import samplesheet
+		text = self.v1_text.replace('Sample_YY,YY', 'Sample_Y-Y,Y-Y').replace('Sample_ZZ,ZZ', 'ZZ,ZZ')
+		invalid = samplesheet.SampleSheet(text = text).invalid_rows('Sample_')
+		self.assertEqual([i for i, problems in invalid], [2, 3])
+		with self.assertRaises(samplesheet.SampleSheetFormatError):
+			samplesheet.SampleSheet(text = '[Header]\nEmail,Project_X,a@b.org\n')
+
+	def test_large_sheet(self):
+		import time
+		import random
+		import samplesheet
+		random.seed(0)
+		lines = ['[Header]', 'Email,Project_X,a@b.org', '[Data]', 'Sample_ID,Sample_Name,index,index2,Sample_Project']
+		for i in range(1000):
+			i7 = ''.join([random.choice('ACGT') for k in range(10)])
+			i5 = ''.join([random.choice('ACGT') for k in range(10)])
+			lines.append('Sample_S%d,S%d,%s,%s,Project_X' % (i, i, i7, i5))
+		lines.append('Sample_dup,dup,%s,%s,Project_X' % tuple(lines[4].split(',')[2:4]))
+		start = time.time()
+		sheet = samplesheet.SampleSheet(text = '\n'.join(lines))
+		collisions = sheet.index_collisions(3)
+		self.assertTrue(time.time() - start < 2)
+		self.assertTrue((None, 'Sample_S0', 'Sample_dup', 0) in collisions)
+
+	@mock.patch('pipeline.os')
+	def test_collision_rejected_before_demux(self, mock_os):
+		mock_os.path.isfile.return_value = True
+		text = self.v1_text.replace('CGATGTAT,B002,GCCTCTAT', 'ATCACGAT,B002,AGGCTATT')
+		with mock.patch('__builtin__.open', mock.mock_open(read_data = text)):
+			p = pipeline.NextSeqPipeline('/path/to/dummy')
+			p.config_params_dict = {'sample_dir_prefix': 'Sample_', 'min_index_distance': '3'}
+			with self.assertRaises(pipeline.SampleSheetException):
+				p.check_samplesheet()
+
+
+
+class TestPreflight(unittest.TestCase):
+
+	run_info_xml = """<?xml version="1.0"?>
+<RunInfo Version="2">
+  <Run Id="170101_NB000000_0001_AHXXXXXXXX" Number="1">
+    <Flowcell>HXXXXXXXX</Flowcell>
+    <Reads>
+      <Read Number="1" NumCycles="75" IsIndexedRead="N" />
+      <Read Number="2" NumCycles="8" IsIndexedRead="Y" />
+    </Reads>
+    <FlowcellLayout LaneCount="4" SurfaceCount="2" SwathCount="3" TileCount="12" />
+  </Run>
+</RunInfo>
+"""
+
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.mkdtemp()
+		self.run_dir = os.path.join(self.tmp_dir, 'run')
+		os.mkdir(self.run_dir)
+		with open(os.path.join(self.run_dir, 'RunInfo.xml'), 'w') as fout:
+			fout.write(self.run_info_xml)
+		self.tool = os.path.join(self.tmp_dir, 'tool')
+		open(self.tool, 'w').close()
+		os.chmod(self.tool, 0755)
+		self.credentials = os.path.join(self.tmp_dir, 'credentials.json')
+		with open(self.credentials, 'w') as fout:
+			fout.write('{"client_id": "abc", "secret": "xyz"}')
+		self.params = {'demux_output_dir': 'output', 
+				'destination_path': os.path.join(self.tmp_dir, 'projects'), 
+				'delivery_home': self.tmp_dir, 
+				'demux_path': self.tool, 
+				'fastqc_path': self.tool,
+				'preflight_clusters_per_tile': '1000',
+				'preflight_bytes_per_base': '0.5',
+				'preflight_min_free_gb': '0'}
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def test_estimate(self):
+		import preflight
+		import run_info
+		info = run_info.parse_run_info(self.run_dir)
+		self.assertEqual(preflight.estimate_output_bytes(info, 1000, 0.5), 4 * 2 * 3 * 12 * 1000 * 83 / 2)
+
+	@mock.patch('preflight.check_on_path')
+	def test_checks_pass(self, mock_on_path):
+		import preflight
+		mock_on_path.return_value = []
+		# the gsutil engine does not need an access token
+		problems = preflight.run_checks(self.run_dir, self.params, {'credential_file': self.credentials, 'access_token_command': 'false'})
+		self.assertEqual(problems, [])
+		self.assertEqual(mock_on_path.call_args[0], ('gsutil',))
+		# the output directory is not created by the checks
+		self.assertFalse(os.path.exists(os.path.join(self.run_dir, 'output')))
+
+	@mock.patch('preflight.check_on_path')
+	def test_problems_found(self, mock_on_path):
+		import preflight
+		mock_on_path.return_value = []
+		self.params['preflight_clusters_per_tile'] = '1e15'
+		self.params['fastqc_path'] = os.path.join(self.tmp_dir, 'missing')
+		with open(self.credentials, 'w') as fout:
+			fout.write('{"client_id": "abc"')
+		problems = preflight.run_checks(self.run_dir, self.params, {'credential_file': self.credentials, 'access_token_command': 'false', 'upload_engine': 'native'})
+		self.assertTrue(any(['Not enough space' in p for p in problems]))
+		self.assertTrue(any(['fastQC' in p for p in problems]))
+		self.assertTrue(any(['credential file' in p for p in problems]))
+		self.assertTrue(any(['access token' in p for p in problems]))
+
+		# once the stages after the demux are complete, only the demux needs checking
+		problems = preflight.run_checks(self.run_dir, self.params, {}, completed_stages = ['process_samples'])
+		self.assertEqual(len(problems), 1)
+		self.assertTrue('Not enough space' in problems[0])
+
+	@mock.patch('preflight.check_on_path')
+	def test_native_engine_does_not_need_gsutil(self, mock_on_path):
+		import preflight
+		mock_on_path.return_value = ['gsutil was not found on the PATH']
+		cloud_params = {'credential_file': self.credentials, 'access_token_command': 'echo abc', 'upload_engine': 'native'}
+		self.assertEqual(preflight.run_checks(self.run_dir, self.params, cloud_params), [])
+		self.assertFalse(mock_on_path.called)
+
+	@mock.patch('preflight.tempfile.mkstemp')
+	def test_unwritable_location(self, mock_mkstemp):
+		import preflight
+		mock_mkstemp.side_effect = OSError(13, 'Permission denied')
+		problems = preflight.check_writable(os.path.join(self.tmp_dir, 'a', 'new_dir'))
+		self.assertEqual(len(problems), 1)
+		# the nearest existing directory is tried
+		self.assertEqual(mock_mkstemp.call_args[1]['dir'], self.tmp_dir)
+
+
+
+class FakeStorage(object):
+	"""
+	Stands in for the storage JSON API: keeps the uploaded objects in memory, and can fail some requests
+	"""
+	def __init__(self):
+		import threading
+		self.objects = {}
+		self.metadata = {}
+		self.sessions = {}
+		self.generations = {}
+		self.policy = {'bindings': [], 'etag': 'CAE='}
+		self.failures = []
+		self.requests = []
+		self.lock = threading.Lock()
+
+	class Response(object):
+		def __init__(self, status_code, body = None, headers = None):
+			self.status_code = status_code
+			self.body = body
+			self.headers = headers or {}
+			self.text = json.dumps(body)
+
+		def json(self):
+			return self.body
+
+	def resource(self, name):
+		import hashlib
+		import base64
+		data = self.objects[name]
+		return {'name': name, 'size': str(len(data)), 'generation': str(self.generations.get(name, 1)), 
+			'md5Hash': base64.b64encode(hashlib.md5(data).digest())}
+
+	def store(self, name, data):
+		# each write of an object makes a new generation of it
+		self.objects[name] = data
+		self.generations[name] = self.generations.get(name, 0) + 1
+
+	def request(self, method, url, headers = None, params = None, data = None):
+		with self.lock:
+			self.requests.append((method, url, dict(headers or {}), params))
+			if self.failures and self.failures[0](method, url, headers or {}):
+				self.failures.pop(0)
+				return self.Response(503)
+		if hasattr(data, 'read'):
+			data = data.read()
+		if method == 'POST' and params and params['uploadType'] == 'multipart':
+			boundary = headers['Content-Type'].split('boundary=')[1]
+			parts = [p.split('\r\n\r\n', 1)[1][:-2] for p in data.split('--' + boundary)[1:-1]]
+			resource = json.loads(parts[0])
+			self.store(resource['name'], parts[1])
+			self.metadata[resource['name']] = resource
+			return self.Response(200, self.resource(resource['name']))
+		if method == 'POST' and params and params['uploadType'] == 'resumable':
+			self.metadata[params['name']] = json.loads(data)
+			session_url = 'https://session/%d' % len(self.sessions)
+			self.sessions[session_url] = [params['name'], '', int(headers['X-Upload-Content-Length'])]
+			return self.Response(200, {}, {'Location': session_url})
+		if method == 'PUT' and url in self.sessions:
+			name, received, size = self.sessions[url]
+			content_range = headers['Content-Range'][len('bytes '):]
+			if not content_range.startswith('*'):
+				start = int(content_range.split('-')[0])
+				received = received[:start] + data
+				self.sessions[url][1] = received
+			if len(received) == size:
+				self.store(name, received)
+				return self.Response(200, self.resource(name))
+			return self.Response(308, None, {'Range': 'bytes=0-%d' % (len(received) - 1)} if received else {})
+		if url.endswith('/iam'):
+			conditional = lambda policy: any(['condition' in b for b in policy.get('bindings', [])])
+			if method == 'GET':
+				if conditional(self.policy) and int((params or {}).get('optionsRequestedPolicyVersion', 1)) < 3:
+					return self.Response(400)
+				return self.Response(200, json.loads(json.dumps(self.policy)))
+			policy = json.loads(data)
+			if conditional(policy) and policy.get('version', 1) < 3:
+				return self.Response(400)
+			if policy.get('etag') != self.policy['etag']:
+				return self.Response(412)
+			policy['etag'] = self.policy['etag'] + 'x'
+			self.policy = policy
+			return self.Response(200, policy)
+		if method == 'PATCH':
+			import urllib
+			name = urllib.unquote(url.split('/o/')[1])
+			if name not in self.objects:
+				return self.Response(404)
+			self.metadata.setdefault(name, {}).update(json.loads(data))
+			return self.Response(200, {})
+		if method == 'POST' and url.endswith('/compose'):
+			import urllib
+			name = urllib.unquote(url.split('/o/')[1][:-len('/compose')])
+			sources = [x['name'] for x in json.loads(data)['sourceObjects']]
+			if any([x not in self.objects for x in sources]):
+				return self.Response(404)
+			self.store(name, ''.join([self.objects[x] for x in sources]))
+			self.metadata[name] = json.loads(data)['destination']
+			return self.Response(200, self.resource(name))
+		if method == 'POST' and url.endswith('/batch/storage/v1'):
+			import re
+			import urllib
+			boundary = headers['Content-Type'].split('boundary=')[1]
+			responses = []
+			for part in data.split('--' + boundary)[1:-1]:
+				content_id = re.search('Content-ID: <(\\d+)>', part).group(1)
+				name = urllib.unquote(re.search('PATCH /storage/v1/b/[^/]+/o/(\\S+) HTTP', part).group(1))
+				status = 404
+				if name in self.objects:
+					self.metadata.setdefault(name, {}).update(json.loads(part.split('\r\n\r\n')[2].strip()))
+					status = 200
+				responses.append('--batch_response\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\nHTTP/1.1 %d OK\r\n\r\n{}\r\n' % (content_id, status))
+			response = self.Response(200, None, {'Content-Type': 'multipart/mixed; boundary=batch_response'})
+			response.text = ''.join(responses) + '--batch_response--'
+			return response
+		if method == 'GET' and url.endswith('/o'):
+			prefix = (params or {}).get('prefix', '')
+			return self.Response(200, {'items': [self.resource(n) for n in sorted(self.objects) if n.startswith(prefix)]})
+		if method == 'DELETE':
+			import urllib
+			self.objects.pop(urllib.unquote(url.split('/o/')[1]), None)
+			return self.Response(204)
+		return self.Response(404)
+
+	def __call__(self):
+		return self
+
+
+class TestCloudUploader(unittest.TestCase):
+
+	def setUp(self):
+		import tempfile
+		import cloud_uploader
+		self.tmp_dir = tempfile.mkdtemp()
+		self.storage = FakeStorage()
+		self.token = mock.MagicMock()
+		self.token.get.return_value = 'abc'
+		cloud_uploader.BACKOFF = 0
+		self.uploader = cloud_uploader.Uploader('bucket', self.token, workers = 3, chunk_size = cloud_uploader.CHUNK_UNIT, session_factory = self.storage)
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmp_dir)
+
+	def write(self, name, size):
+		path = os.path.join(self.tmp_dir, name)
+		with open(path, 'wb') as fout:
+			fout.write(os.urandom(size))
+		return path
+
+	def test_upload_all(self):
+		import cloud_uploader
+		small = self.write('small.txt', 100)
+		large = self.write('large.fastq.gz', int(2.5 * cloud_uploader.CHUNK_UNIT))
+		# a single thread, so the order in which the files are started is the order of the requests
+		self.uploader.workers = 1
+		results = self.uploader.upload_all([(small, 'a/small.txt'), (large, 'a/large.fastq.gz')])
+		self.assertEqual(sorted([r['name'] for r in results]), ['a/large.fastq.gz', 'a/small.txt'])
+		self.assertEqual(self.storage.objects['a/small.txt'], open(small, 'rb').read())
+		self.assertEqual(self.storage.objects['a/large.fastq.gz'], open(large, 'rb').read())
+		# the largest file is started first, and the large file was sent in 3 chunks
+		self.assertEqual(self.storage.requests[0][3]['name'], 'a/large.fastq.gz')
+		self.assertEqual(len([r for r in self.storage.requests if r[0] == 'PUT']), 3)
+		self.assertTrue(all([r[2]['Authorization'] == 'Bearer abc' for r in self.storage.requests]))
+
+	def test_failed_chunk_resumes(self):
+		import cloud_uploader
+		large = self.write('large.fastq.gz', 3 * cloud_uploader.CHUNK_UNIT)
+		# the second chunk fails once
+		self.storage.failures.append(lambda method, url, headers: headers.get('Content-Range', '').startswith('bytes %d-' % cloud_uploader.CHUNK_UNIT))
+		info = self.uploader.upload_file(large, 'large.fastq.gz')
+		self.assertEqual(info['size'], 3 * cloud_uploader.CHUNK_UNIT)
+		self.assertEqual(self.storage.objects['large.fastq.gz'], open(large, 'rb').read())
+		# only the failed chunk was sent again (after asking the session how much it had)
+		sent = [r[2]['Content-Range'] for r in self.storage.requests if r[0] == 'PUT']
+		self.assertEqual(len([x for x in sent if not x.startswith('bytes */')]), 4)
+
+	def test_composite_upload_continues_after_failure(self):
+		import cloud_uploader
+		unit = cloud_uploader.CHUNK_UNIT
+		large = self.write('large.fastq.gz', 4 * unit + 100)
+		state_dir = os.path.join(self.tmp_dir, 'state')
+		uploader = cloud_uploader.Uploader('bucket', self.token, workers = 1, chunk_size = unit, session_factory = self.storage,
+						composite_threshold = 2 * unit, state_dir = state_dir)
+		# the last part is refused (with an error not worth retrying), so the first attempt fails
+		last_part = cloud_uploader.PART_NAME % ('large.fastq.gz', 4)
+		orig_request = self.storage.request
+		def failing_request(method, url, headers = None, params = None, data = None):
+			if params and params.get('name') == last_part:
+				return FakeStorage.Response(403, {})
+			return orig_request(method, url, headers, params, data)
+		self.storage.request = failing_request
+		with self.assertRaises(cloud_uploader.UploadException):
+			uploader.upload_all([(large, 'large.fastq.gz')])
+		self.assertEqual(len(os.listdir(state_dir)), 1)
+		self.assertEqual(len([x for x in self.storage.objects if x.startswith(cloud_uploader.PART_PREFIX)]), 4)
+
+		# the next attempt only uploads the missing part
+		self.storage.request = orig_request
+		self.storage.requests = []
+		results = uploader.upload_all([(large, 'large.fastq.gz')])
+		self.assertEqual(results[0]['size'], 4 * unit + 100)
+		self.assertEqual(self.storage.objects['large.fastq.gz'], open(large, 'rb').read())
+		started = [r[3]['name'] for r in self.storage.requests if r[0] == 'POST' and r[3]]
+		self.assertEqual(started, [cloud_uploader.PART_NAME % ('large.fastq.gz', 4)])
+		# the parts and the state are removed once composed
+		self.assertEqual(self.storage.objects.keys(), ['large.fastq.gz'])
+		self.assertEqual(os.listdir(state_dir), [])
+
+	def test_parts_removed(self):
+		import cloud_uploader
+		unit = cloud_uploader.CHUNK_UNIT
+		large = self.write('large.fastq.gz', 4 * unit + 100)
+		uploader = cloud_uploader.Uploader('bucket', self.token, workers = 2, chunk_size = unit, session_factory = self.storage,
+						composite_threshold = 2 * unit, state_dir = os.path.join(self.tmp_dir, 'state'))
+		# a part left by an earlier upload of another file is removed when the next composite upload starts
+		self.storage.objects[cloud_uploader.PART_NAME % ('old.fastq.gz', 0)] = 'abc'
+		# a failed compose removes the parts
+		orig_request = self.storage.request
+		def failing_compose(method, url, headers = None, params = None, data = None):
+			if url.endswith('/compose'):
+				return FakeStorage.Response(403, {})
+			return orig_request(method, url, headers, params, data)
+		self.storage.request = failing_compose
+		with self.assertRaises(cloud_uploader.UploadException):
+			uploader.upload_all([(large, 'large.fastq.gz')])
+		self.assertEqual(self.storage.objects.keys(), [])
+
+	def test_metadata_set_at_upload(self):
+		import cloud_uploader
+		unit = cloud_uploader.CHUNK_UNIT
+		small = self.write('small.txt', 100)
+		large = self.write('large.fastq.gz', 2 * unit + 100)
+		huge = self.write('huge.fastq.gz', 5 * unit)
+		self.uploader.composite_threshold = 3 * unit
+		metadata = {'contentDisposition': 'attachment; filename=x', 'metadata': {'sample': 'X'}}
+		self.uploader.upload_all([(small, 'small.txt', metadata), (large, 'large.fastq.gz', metadata), (huge, 'huge.fastq.gz', metadata)])
+		for name in ['small.txt', 'large.fastq.gz', 'huge.fastq.gz']:
+			self.assertEqual(self.storage.metadata[name]['contentDisposition'], 'attachment; filename=x')
+			self.assertEqual(self.storage.metadata[name]['metadata'], {'sample': 'X'})
+		self.assertEqual(self.storage.metadata['small.txt']['contentType'], 'text/plain')
+		self.assertEqual(self.storage.objects['small.txt'], open(small, 'rb').read())
+		# no separate metadata requests
+		self.assertFalse(any([r[0] == 'PATCH' for r in self.storage.requests]))
+
+	def test_fastq_metadata(self):
+		import demux_cloud_upload
+		sample_dir = os.path.join(self.tmp_dir, 'Sample_XX')
+		os.mkdir(sample_dir)
+		for name in ['XX_R1_.fc1.fastq.gz', 'XX_R1_.fc2.fastq.gz', 'XX_R1_.final.fastq.gz']:
+			open(os.path.join(sample_dir, name), 'w').close()
+		params = {'sample_dir_prefix': 'Sample_', 'final_fastq_tag': 'final', 'flowcell_prefix': 'fc'}
+		metadata = demux_cloud_upload.fastq_metadata(os.path.join(sample_dir, 'XX_R1_.final.fastq.gz'), {'md5': 'abc', 'size': 0}, params)
+		self.assertEqual(metadata['contentDisposition'], 'attachment; filename=XX_R1_.final.fastq.gz')
+		self.assertEqual(metadata['metadata'], {'sample': 'XX', 'flowcells': '2', 'md5': 'abc'})
+
+	def test_composites_need_crc32c(self):
+		import sys
+		import checksums
+		import demux_cloud_upload
+		container = mock.MagicMock()
+		container.name = 'bucket'
+		params = {'compute_checksums': '1', 'upload_composite_threshold_mb': '1'}
+		with mock.patch('checksums.HAVE_CRC32C', False):
+			self.assertEqual(demux_cloud_upload.get_uploader(container, None, params).composite_threshold, sys.maxint)
+		with mock.patch('checksums.HAVE_CRC32C', True):
+			self.assertEqual(demux_cloud_upload.get_uploader(container, None, params).composite_threshold, 1024 * 1024)
+
+	def test_batch_metadata_update(self):
+		import cloud_uploader
+		cloud_uploader.MAX_BATCH_SIZE = 2
+		try:
+			for i in range(3):
+				self.storage.objects['obj %d' % i] = 'data'
+			self.uploader.patch_metadata_batch([('obj %d' % i, {'contentDisposition': 'attachment'}) for i in range(3)])
+		finally:
+			cloud_uploader.MAX_BATCH_SIZE = 100
+		self.assertEqual(len(self.storage.requests), 2)
+		for i in range(3):
+			self.assertEqual(self.storage.metadata['obj %d' % i], {'contentDisposition': 'attachment'})
+
+	def test_unchanged_files_skipped(self):
+		import cloud_uploader
+		a = self.write('a.txt', 100)
+		b = self.write('b.txt', 200)
+		manifest = cloud_uploader.UploadManifest(os.path.join(self.tmp_dir, 'manifest.json'), 'bucket')
+		self.uploader.upload_all([(a, 'x/a.txt'), (b, 'x/b.txt')], manifest)
+
+		# a new attempt (with the manifest read again from its file, and checked against a listing of the bucket) sends nothing
+		self.storage.requests = []
+		manifest = cloud_uploader.UploadManifest(os.path.join(self.tmp_dir, 'manifest.json'), 'bucket')
+		self.assertEqual(manifest.check_remote([cloud_uploader.object_info(r) for r in self.uploader.list_objects()]), [])
+		self.storage.requests = []
+		results = self.uploader.upload_all([(a, 'x/a.txt'), (b, 'x/b.txt')], manifest)
+		self.assertEqual(self.storage.requests, [])
+		self.assertEqual(sorted([(r['name'], r['size']) for r in results]), [('x/a.txt', 100), ('x/b.txt', 200)])
+
+		# only the changed file is sent, and the records of another bucket are not used
+		self.write('b.txt', 300)
+		results = self.uploader.upload_all([(a, 'x/a.txt'), (b, 'x/b.txt')], manifest)
+		self.assertEqual(len(self.storage.requests), 1)
+		self.assertEqual(self.storage.objects['x/b.txt'], open(b, 'rb').read())
+		self.assertEqual(manifest.entry('x/b.txt')['size'], 300)
+		other = cloud_uploader.UploadManifest(os.path.join(self.tmp_dir, 'manifest.json'), 'other-bucket')
+		self.assertFalse(other.unchanged(a, 'x/a.txt'))
+
+	def test_remote_changes_sent_again(self):
+		import cloud_uploader
+		a = self.write('a.txt', 100)
+		b = self.write('b.txt', 200)
+		c = self.write('c.txt', 300)
+		jobs = [(a, 'x/a.txt'), (b, 'x/b.txt'), (c, 'x/c.txt')]
+		manifest = cloud_uploader.UploadManifest(os.path.join(self.tmp_dir, 'manifest.json'), 'bucket')
+		self.uploader.upload_all(jobs, manifest)
+
+		# one object is removed, and another is overwritten (with the same content, but as a new generation)
+		del self.storage.objects['x/a.txt']
+		self.storage.store('x/b.txt', self.storage.objects['x/b.txt'])
+		manifest = cloud_uploader.UploadManifest(os.path.join(self.tmp_dir, 'manifest.json'), 'bucket')
+		self.assertEqual(manifest.check_remote([cloud_uploader.object_info(r) for r in self.uploader.list_objects()]), ['x/a.txt', 'x/b.txt'])
+		self.storage.requests = []
+		self.uploader.upload_all(jobs, manifest)
+		self.assertEqual(len(self.storage.requests), 2)
+		self.assertEqual(self.storage.generations, {'x/a.txt': 2, 'x/b.txt': 3, 'x/c.txt': 1})
+		self.assertEqual(self.storage.objects['x/a.txt'], open(a, 'rb').read())
+
+		# a bucket which was just created has none of the objects
+		manifest.forget()
+		self.assertFalse(manifest.unchanged(c, 'x/c.txt'))
+		self.assertEqual(cloud_uploader.UploadManifest(os.path.join(self.tmp_dir, 'manifest.json'), 'bucket').entry('x/c.txt'), None)
+
+	def test_expired_token_refreshed(self):
+		small = self.write('small.txt', 100)
+		responses = [FakeStorage.Response(401), FakeStorage.Response(200, {'name': 'small.txt', 'size': '100'})]
+		session = mock.MagicMock()
+		session.request.side_effect = lambda *args, **kwargs: responses.pop(0)
+		self.uploader.session_factory = lambda: session
+		self.token.refresh.return_value = 'def'
+		info = self.uploader.upload_file(small, 'small.txt')
+		self.assertEqual(info['size'], 100)
+		self.token.refresh.assert_called_once_with('abc')
+		self.assertEqual(session.request.call_args[1]['headers']['Authorization'], 'Bearer def')
+
+
+
+class TestBucketAccess(unittest.TestCase):
+
+	def setUp(self):
+		import bucket_access
+		import cloud_uploader
+		self.storage = FakeStorage()
+		token = mock.MagicMock()
+		token.get.return_value = 'abc'
+		client = cloud_uploader.Uploader('bucket', token, session_factory = self.storage)
+		self.access = bucket_access.BucketAccess(client)
+
+	def members(self, role):
+		return [b['members'] for b in self.storage.policy['bindings'] if b['role'] == role]
+
+	def test_only_differences_applied(self):
+		import bucket_access
+		# a member added by hand, which is left alone
+		self.storage.policy['bindings'].append({'role': bucket_access.READER_ROLE, 'members': ['user:other@x.org']})
+		self.assertTrue(self.access.grant('bucket', ['a@x.org', 'staff@x.org'], ('staff@x.org',)))
+		self.assertEqual(self.members(bucket_access.READER_ROLE), [['user:a@x.org', 'user:other@x.org']])
+		self.assertEqual(self.members(bucket_access.OWNER_ROLE), [['user:staff@x.org']])
+		self.assertEqual([r[0] for r in self.storage.requests], ['GET', 'PUT'])
+
+		# nothing has changed, so the policy is only read
+		self.storage.requests = []
+		self.assertFalse(self.access.grant('bucket', ['staff@x.org', 'a@x.org'], ('staff@x.org',)))
+		self.assertEqual([r[0] for r in self.storage.requests], ['GET'])
+
+		# another client is added, and none are removed
+		self.storage.requests = []
+		self.assertTrue(self.access.grant('bucket', ['b@x.org', 'staff@x.org'], ('staff@x.org',)))
+		self.assertEqual(self.members(bucket_access.READER_ROLE), [['user:a@x.org', 'user:b@x.org', 'user:other@x.org']])
+		self.assertEqual([r[0] for r in self.storage.requests], ['GET', 'PUT'])
+
+	def test_conditional_bindings_kept(self):
+		import bucket_access
+		condition = {'role': bucket_access.READER_ROLE, 'members': ['user:other@x.org'], 'condition': {'title': 'expires'}}
+		self.storage.policy.update({'version': 3, 'bindings': [condition]})
+		self.assertTrue(self.access.grant('bucket', ['a@x.org'], ()))
+		self.assertEqual(self.storage.requests[0][3], {'optionsRequestedPolicyVersion': 3})
+		self.assertEqual(self.storage.policy['version'], 3)
+		self.assertEqual(self.storage.policy['bindings'], [condition, {'role': bucket_access.READER_ROLE, 'members': ['user:a@x.org']}])
+
+	def test_recreated_bucket(self):
+		import bucket_access
+		self.assertTrue(self.access.grant('bucket', ['a@x.org'], ()))
+		# the bucket is deleted and created again with the same name, without any bindings
+		self.storage.policy['bindings'] = []
+		self.assertTrue(self.access.grant('bucket', ['a@x.org'], ()))
+		self.assertEqual(self.members(bucket_access.READER_ROLE), [['user:a@x.org']])
+
+	def test_policy_changed_in_between(self):
+		import bucket_access
+		orig_request = self.storage.request
+		def changing_request(method, url, headers = None, params = None, data = None):
+			response = orig_request(method, url, headers, params, data)
+			if method == 'GET' and len(self.storage.requests) == 1:
+				# someone else changes the policy after it is read
+				self.storage.policy['etag'] = 'changed'
+			return response
+		self.storage.request = changing_request
+		self.assertTrue(self.access.grant('bucket', ['a@x.org'], ()))
+		self.assertEqual([r[0] for r in self.storage.requests], ['GET', 'PUT', 'GET', 'PUT'])
+		self.assertEqual(self.members(bucket_access.READER_ROLE), [['user:a@x.org']])
+
+
+
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,237 @@
+"""
+Analysis of the reads which bcl2fastq could not assign to a sample (Undetermined_S0_L00N_R1_001.fastq.gz).
+
+The index sequences are taken from the fastq headers and counted per lane.  To keep this fast enough for a full
+NextSeq run, the headers are handled in large blocks with numpy: each index sequence is encoded as an integer
+(base 6, one digit per base) and the blocks are counted with np.unique, so there is no Python-level work per read.
+
+The most common undetermined indexes are then compared against the samples in the SampleSheet.csv to flag likely
+mistakes (reverse-complemented or swapped i7/i5 indexes, typos), and index-hopping is estimated from the reads whose
+i7 and i5 each belong to a sample, but not to the same one.
+"""
+
+import os
+import re
+import glob
+import gzip
+import json
+import logging
+import numpy as np
+
+import barcodes
+
+# digits used for encoding.  0 is reserved for padding, so sequences of different lengths do not collide
+DIGITS = np.zeros(256, dtype=np.int64)
+for i, b in enumerate(barcodes.BASES):
+	DIGITS[ord(b)] = i + 1
+	DIGITS[ord(b.lower())] = i + 1
+BASE = len(barcodes.BASES) + 1
+
+# the amount of decompressed fastq data handled at once
+CHUNK_SIZE = 64*1024*1024
+
+
+def encode_sequences(seqs, length):
+	"""
+	seqs is a numpy array of byte strings (dtype S).  Returns an int64 array with each sequence encoded as a base-6 integer.
+	"""
+	if len(seqs) == 0:
+		return np.zeros(0, dtype=np.int64)
+	seqs = seqs.astype('S%d' % length)
+	m = np.frombuffer(seqs.tobytes(), dtype=np.uint8).reshape(len(seqs), length)
+	powers = BASE ** np.arange(length - 1, -1, -1, dtype=np.int64)
+	return DIGITS[m].dot(powers)
+
+
+def decode_sequence(code, length):
+	bases = []
+	for i in range(length):
+		code, digit = divmod(int(code), BASE)
+		if digit > 0:
+			bases.append(barcodes.BASES[digit - 1])
+	return ''.join(reversed(bases))
+
+
+def reduce_counts(codes, counts):
+	"""
+	Sums the counts of identical codes.  Returns (unique codes, counts)
+	"""
+	if len(codes) == 0:
+		return codes, counts
+	order = np.argsort(codes, kind='mergesort')
+	codes = codes[order]
+	counts = counts[order]
+	unique_codes, starts = np.unique(codes, return_index=True)
+	return unique_codes, np.add.reduceat(counts, starts)
+
+
+def iterate_headers(fastq_path, chunk_size = CHUNK_SIZE):
+	"""
+	Yields numpy arrays (dtype S) of the header lines of the fastq file, one array per chunk of the file
+	"""
+	handle = gzip.open(fastq_path, 'rb')
+	carry = ''
+	line_number = 0
+	while True:
+		data = handle.read(chunk_size)
+		if not data:
+			break
+		lines = (carry + data).split('\n')
+		# the last element is an incomplete line (or empty, if the chunk ended on a newline)
+		carry = lines.pop()
+		first_header = (-line_number) % 4
+		line_number += len(lines)
+		headers = lines[first_header::4]
+		if len(headers) > 0:
+			yield np.array(headers)
+	if carry and line_number % 4 == 0:
+		yield np.array([carry])
+	handle.close()
+
+
+def count_indexes(fastq_path, chunk_size = CHUNK_SIZE):
+	"""
+	Counts the index sequences found in the headers of a fastq file.
+	Returns a tuple of (codes, counts, i7 length, i5 length)
+	"""
+	all_codes = np.zeros(0, dtype=np.int64)
+	all_counts = np.zeros(0, dtype=np.int64)
+	i7_length = None
+	i5_length = None
+	for headers in iterate_headers(fastq_path, chunk_size):
+		index_field = np.char.rpartition(np.char.rstrip(headers), ':')[:, 2]
+		if i7_length is None:
+			first = index_field[0].split('+')
+			i7_length = len(first[0])
+			i5_length = len(first[1]) if len(first) > 1 else 0
+		indexes = np.char.replace(index_field, '+', '')
+		codes, counts = np.unique(encode_sequences(indexes, i7_length + i5_length), return_counts=True)
+		all_codes, all_counts = reduce_counts(np.concatenate([all_codes, codes]), np.concatenate([all_counts, counts.astype(np.int64)]))
+	return all_codes, all_counts, i7_length or 0, i5_length or 0
+
+
+def sample_variants(samples):
+	"""
+	samples is a list of (sample ID, i7, i5) tuples.  Returns a dictionary mapping the index pairs that would be
+	seen if a sample's indexes were mis-entered to a description of the likely mistake.
+	"""
+	variants = {}
+	rc = barcodes.reverse_complement
+	for sample_id, i7, i5 in samples:
+		candidates = [((i7, rc(i5)), 'i5 (index2) is reverse-complemented'),
+				((rc(i7), i5), 'i7 (index) is reverse-complemented'),
+				((rc(i7), rc(i5)), 'i7 and i5 are reverse-complemented'),
+				((i5, i7), 'i7 and i5 are swapped'),
+				((rc(i5), rc(i7)), 'i7 and i5 are swapped and reverse-complemented')]
+		for pair, description in candidates:
+			if pair != (i7, i5):
+				variants.setdefault(pair, '%s: %s' % (sample_id, description))
+	return variants
+
+
+def explain_indexes(index_pairs, samples, max_mismatches):
+	"""
+	Returns a list of explanations (empty strings if there is none) for each of the (i7, i5) index pairs
+	"""
+	variants = sample_variants(samples)
+	i7_to_sample = dict((i7, s) for s, i7, i5 in samples)
+	i5_to_sample = dict((i5, s) for s, i7, i5 in samples)
+	sample_codes = barcodes.encode([i7 + i5 for s, i7, i5 in samples])
+	observed_codes = barcodes.encode([i7 + i5 for i7, i5 in index_pairs], sample_codes.shape[1])
+	distances = barcodes.hamming_distance_matrix(observed_codes, sample_codes)
+
+	explanations = []
+	for k, pair in enumerate(index_pairs):
+		i7, i5 = pair
+		if pair in variants:
+			explanations.append(variants[pair])
+		elif i7 in i7_to_sample and i5 in i5_to_sample and len(i5) > 0:
+			explanations.append('index hopping between %s (i7) and %s (i5)' % (i7_to_sample[i7], i5_to_sample[i5]))
+		elif len(samples) > 0 and distances[k].min() <= max_mismatches:
+			nearest = distances[k].argmin()
+			explanations.append('%d mismatch(es) from %s' % (distances[k, nearest], samples[nearest][0]))
+		else:
+			explanations.append('')
+	return explanations
+
+
+def count_hopped_reads(codes, counts, samples, i7_length, i5_length):
+	"""
+	Returns the number of reads whose i7 and i5 each belong to a sample, but not to the same sample.
+	"""
+	if i5_length == 0 or len(samples) == 0:
+		return 0
+	split = BASE ** i5_length
+	sample_i7 = encode_sequences(np.array([i7 for s, i7, i5 in samples]), i7_length)
+	sample_i5 = encode_sequences(np.array([i5 for s, i7, i5 in samples]), i5_length)
+	sample_pairs = sample_i7 * split + sample_i5
+	i7_codes = codes // split
+	i5_codes = codes % split
+	hopped = np.in1d(i7_codes, sample_i7) & np.in1d(i5_codes, sample_i5) & ~np.in1d(codes, sample_pairs)
+	return int(counts[hopped].sum())
+
+
+def assigned_reads_per_lane(demux_output_dir):
+	"""
+	Returns a dictionary of lane number to the number of reads bcl2fastq assigned to samples, from Stats/Stats.json
+	"""
+	stats_path = os.path.join(demux_output_dir, 'Stats', 'Stats.json')
+	if not os.path.isfile(stats_path):
+		logging.warning('No demux statistics found at %s' % stats_path)
+		return {}
+	stats = json.load(open(stats_path))
+	lane_counts = {}
+	for lane in stats.get('ConversionResults', []):
+		lane_counts[lane['LaneNumber']] = sum([s.get('NumberReads', 0) for s in lane.get('DemuxResults', [])])
+	return lane_counts
+
+
+def analyze(demux_output_dir, samplesheet_rows, barcode_report, hopping_report, top_n = 50, max_mismatches = 2):
+	"""
+	Runs the analysis for each lane's undetermined R1 fastq file in demux_output_dir and writes two tab-delimited reports:
+		barcode_report: the top_n undetermined index pairs per lane, with likely explanations
+		hopping_report: the number of hopped reads and the hopping rate per lane
+	"""
+	samples = [(r['Sample_ID'], r.get('index', ''), r.get('index2', '')) for r in samplesheet_rows]
+	assigned = assigned_reads_per_lane(demux_output_dir)
+	undetermined_files = sorted(glob.glob(os.path.join(demux_output_dir, 'Undetermined_S0_L*_R1_001.fastq.gz')))
+	if len(undetermined_files) == 0:
+		logging.info('No undetermined fastq files found in %s' % demux_output_dir)
+		return
+
+	barcode_lines = ['\t'.join(['lane', 'index', 'index2', 'reads', 'fraction_of_undetermined', 'explanation'])]
+	hopping_lines = ['\t'.join(['lane', 'undetermined_reads', 'assigned_reads', 'hopped_reads', 'hopping_rate'])]
+	for fq in undetermined_files:
+		lane = int(re.search(r'_L(\d{3})_', os.path.basename(fq)).group(1))
+		logging.info('Counting the index sequences of the undetermined reads in %s' % fq)
+		codes, counts, i7_length, i5_length = count_indexes(fq)
+		total = int(counts.sum())
+		if total == 0:
+			continue
+
+		top = np.argsort(counts)[::-1][:top_n]
+		index_pairs = []
+		for code in codes[top]:
+			seq = decode_sequence(code, i7_length + i5_length)
+			index_pairs.append((seq[:i7_length], seq[i7_length:]))
+		explanations = explain_indexes(index_pairs, samples, max_mismatches)
+		for (i7, i5), count, explanation in zip(index_pairs, counts[top], explanations):
+			barcode_lines.append('\t'.join(map(str, [lane, i7, i5, count, '%.4f' % (float(count)/total), explanation])))
+			if explanation and not explanation.startswith('index hopping') and float(count)/total > 0.01:
+				logging.warning('Lane %d: %d undetermined reads with index %s+%s.  Likely cause: %s' % (lane, count, i7, i5, explanation))
+
+		hopped = count_hopped_reads(codes, counts, samples, i7_length, i5_length)
+		if lane not in assigned:
+			# without the demux statistics (e.g. from bcl-convert), the rate cannot be calculated
+			hopping_lines.append('\t'.join(map(str, [lane, total, 'NA', hopped, 'NA'])))
+			logging.info('Lane %d: %d undetermined reads, %d from index hopping' % (lane, total, hopped))
+			continue
+		assigned_reads = assigned[lane]
+		rate = float(hopped) / (hopped + assigned_reads) if hopped + assigned_reads > 0 else 0.0
+		hopping_lines.append('\t'.join(map(str, [lane, total, assigned_reads, hopped, '%.5f' % rate])))
+		logging.info('Lane %d: %d undetermined reads, %d from index hopping (rate %.5f)' % (lane, total, hopped, rate))
+
+	with open(barcode_report, 'w') as fout:
+		fout.write('\n'.join(barcode_lines) + '\n')
+	with open(hopping_report, 'w') as fout:
+		fout.write('\n'.join(hopping_lines) + '\n')